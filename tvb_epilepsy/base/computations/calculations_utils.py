@@ -1,5 +1,6 @@
 
 from scipy.optimize import root
+from scipy.sparse import issparse
 import numpy as np
 
 from tvb_epilepsy.base.utils import warning, raise_import_error, initialize_logger, shape_to_size
@@ -755,14 +756,17 @@ def calc_fx1z_2d_x1neg_zpos_jac(x1, z, x0, yc, Iext1, K, w, ix0, iE, a=A_DEF, b=
 
         tau = np.divide(tau1, tau0)
 
+        if issparse(w):
+            return eqtn_fx1z_2d_zpos_jac_sparse(x1, K, w, ix0, iE, a, b, tau)
+
         no_x0 = len(ix0)
         no_e = len(iE)
 
         i_x0 = np.ones((no_x0, 1))
-        i_e = np.ones((no_e, 1))
 
         jac_e_x0e = np.diag(np.multiply(tau[:, iE], - 4.0).flatten())
-        jac_e_x1o = -np.dot(np.dot(i_e, np.multiply(tau[:, iE], K[:, iE])), w[iE][:, ix0])
+        # d fz_i / d x1_j = - tau_i * K_i * w_ij, for i in iE and j in ix0
+        jac_e_x1o = -np.multiply(np.multiply(tau[:, iE], K[:, iE]).T, w[iE][:, ix0])
         jac_x0_x0e = np.zeros((no_x0, no_e))
         jac_x0_x1o = (np.diag(np.multiply(tau[:, ix0],
                                     (4 + 3 * np.multiply(a[:, ix0], np.power(x1[:, ix0], 2))
@@ -900,6 +904,25 @@ def calc_fz_jac_square_taylor(zeq, yc, Iext1, K, w, a=A_DEF, b=B_DEF, d=D_DEF, t
         return eqtn_fz_square_taylor(zeq, yc, Iext1, K, w, tau1, tau0)
 
 
+def calc_fz_jac_square_taylor_batch(zeq, yc, Iext1, K, w, tau1=TAU1_DEF, tau0=TAU0_DEF):
+
+    # Numeric only computation of the Jacobians of a batch of configurations,
+    # with zeq of shape (batch size, n_regions), and any other parameter being broadcastable to that shape:
+    zeq = np.array(zeq, dtype="float64")
+    if zeq.ndim != 2:
+        raise_value_error("zeq has to be an array of shape (batch size, n_regions), not " + str(zeq.shape) + "!")
+
+    yc, Iext1, K, tau1, tau0 = [np.broadcast_to(np.array(p, dtype="float64"), zeq.shape)
+                                for p in (yc, Iext1, K, tau1, tau0)]
+
+    w = np.array(w, dtype="float64")
+    if w.shape[-2:] != (zeq.shape[1], zeq.shape[1]) or w.ndim not in (2, 3):
+        raise_value_error("w has to be an array of shape (n_regions, n_regions) or (batch size, n_regions, n_regions),"
+                          " not " + str(w.shape) + "!")
+
+    return eqtn_fz_square_taylor_batch(zeq, yc, Iext1, K, w, tau1, tau0)
+
+
 def calc_fpop2(x2, y2=0.0, z=0.0, g=0.0, Iext2=I_EXT2_DEF, s=S_DEF, tau1=TAU1_DEF, tau2=1.0, x2_neg=None, shape=None,
                calc_mode="non_symbol"):
 
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.sparse import issparse, diags, csr_matrix
 
 from tvb_epilepsy.base.constants import A_DEF, B_DEF, D_DEF, SLOPE_DEF, S_DEF, GAMMA_DEF, I_EXT1_DEF, I_EXT2_DEF, \
                                         YC_DEF, TAU0_DEF, TAU1_DEF, TAU2_DEF
@@ -20,6 +21,17 @@ def else_ydot0_2d(x1, z, slope, d):
     return slope - d * x1 + 0.6 * np.power(z - 4.0, 2)
 
 
+def sparse_sum(w, axis=None):
+    # Sum of a scipy.sparse matrix along an axis, as a flat numpy array
+    return np.asarray(w.sum(axis=axis)).flatten()
+
+
+def is_zero_connectivity(w):
+    if issparse(w):
+        return w.nnz == 0 or not(np.any(w.data))
+    return np.all(w == 0.0)
+
+
 def eqtn_coupling(x1, K, w, ix, jx):
     # Only difference coupling for the moment.
     # TODO: Extend for different coupling forms
@@ -28,6 +40,12 @@ def eqtn_coupling(x1, K, w, ix, jx):
 
     x1, K = assert_arrays([x1, K], (1, x1.size))
 
+    if issparse(w):
+        # Sparse connectivity: sum_j{w_ij * (x1_j - x1_i)} = sum_j{w_ij * x1_j} - x1_i * sum_j{w_ij}
+        w = w.tocsr()[ix][:, jx]
+        coupling = np.multiply(K[:, ix], w.dot(x1[0, jx]) - np.multiply(x1[0, ix], sparse_sum(w, axis=1)))
+        return np.reshape(coupling, shape)
+
     i_n = np.ones((len(ix), 1), dtype='float32')
     j_n = np.ones((len(jx), 1), dtype='float32')
 
@@ -44,12 +62,35 @@ def eqtn_coupling_diff(K, w, ix, jx):
 
     K = np.reshape(K, (K.size,))
 
+    if issparse(w):
+        # Sparse connectivity: a sparse Jacobian with K_i * w_ij off the diagonal, and -K_i * sum_j{w_ij} on it
+        ix = np.array(ix)
+        w = w.tocsr()[ix][:, jx]
+        dcoupl_dx1 = diags(K[ix]).dot(w)
+        # The diagonal elements, i.e., where the "from" and "to" regions coincide, replace any w_ii terms:
+        regions, iix, ijx = np.intersect1d(ix, jx, return_indices=True)
+        diagonal = -np.multiply(K[regions], sparse_sum(w[iix], axis=1)) - np.multiply(K[regions], w[iix, ijx].A1)
+        return (dcoupl_dx1 + csr_matrix((diagonal, (iix, ijx)), shape=w.shape)).tocsr()
+
     if K.dtype == "object" or w.dtype == "object":
-        dtype = "object"
-    else:
-        dtype = K.dtype
+        return eqtn_coupling_diff_object(K, w, ix, jx)
+
+    # Off diagonal elements: K_i * w_ij
+    ix = np.array(ix, dtype="i").flatten()
+    jx = np.array(jx, dtype="i").flatten()
+    dcoupl_dx1 = np.multiply(np.expand_dims(K[ix], 1), w[np.ix_(ix, jx)]).astype(K.dtype)
+
+    # Diagonal elements, i.e., where the "from" and "to" regions coincide: -K_i * sum_j{w_ij}
+    regions, iix, ijx = np.intersect1d(ix, jx, return_indices=True)
+    dcoupl_dx1[iix, ijx] = -np.multiply(K[regions], np.sum(w[np.ix_(regions, jx)], axis=1))
+
+    return dcoupl_dx1
+
+
+def eqtn_coupling_diff_object(K, w, ix, jx):
+    # Element by element version of eqtn_coupling_diff, for symbolic (object) arrays
 
-    dcoupl_dx1 = np.empty((len(ix), len(jx)), dtype=dtype)
+    dcoupl_dx1 = np.empty((len(ix), len(jx)), dtype="object")
 
     for ii in ix:
         for ij in jx:
@@ -105,7 +146,7 @@ def eqtn_x0cr_r(Iext1, yc, a, b, d, x1_rest, x1_cr, x0_rest, x0_cr, zmode=np.arr
 def eqtn_x0(x1, z, zmode=np.array("lin"), z_pos=True, K=None, w=None, coupl=None):
 
     if coupl is None:
-        if np.all(K == 0.0) or np.all(w == 0.0) or (K is None) or (w is None):
+        if np.all(K == 0.0) or is_zero_connectivity(w) or (K is None) or (w is None):
             coupl = 0.0
         else:
             from tvb_epilepsy.base.computations.calculations_utils import calc_coupling
@@ -144,19 +185,40 @@ def eqtn_fx1_2d_taylor_lin(x1, x_taylor, z, yc, Iext1, a, b, d, tau1):
             + 2 * np.multiply(x_taylor, b))), tau1)
 
 
-def eqtn_jac_x1_2d(x1, z, slope, a, b, d, tau1, x1_neg=True):
+def eqtn_jac_x1_2d_diag(x1, z, slope, a, b, d, tau1, x1_neg=True):
+
+    # The derivatives of fx1 of every region with respect to its own x1 and z
 
     # Correspondance with EpileptorDP2D
     b = b - d
 
-    jac_x1 = np.diag(
-        np.multiply(np.where(x1_neg, np.multiply(-3.0 * np.multiply(a, x1) + 2.0 * np.multiply(b, 1.0), x1),
-                             + else_ydot0_2d(x1, z, slope, d)), tau1).flatten())
+    jac_x1 = np.multiply(np.where(x1_neg, np.multiply(-3.0 * np.multiply(a, x1) + 2.0 * b, x1),
+                                  else_ydot0_2d(x1, z, slope, d) - np.multiply(d, x1)), tau1)
 
-    jac_z = - np.diag(np.multiply(np.ones(x1.shape, dtype=x1.dtype) +
-                                  np.where(x1_neg, 0.0, 1.2 * np.multiply(z - 4.0, x1)), tau1).flatten())
+    jac_z = np.multiply(-1.0 + np.where(x1_neg, 0.0, 1.2 * np.multiply(z - 4.0, x1)), tau1)
 
-    return np.concatenate([jac_x1, jac_z], axis=1)
+    return jac_x1, jac_z
+
+
+def eqtn_jac_x1_6d_diag(x1, z, x2, slope, a, b, tau1, x1_neg=True):
+
+    # The derivatives of fx1 of every region with respect to its own x1, z and x2 (the one with respect to y1 is tau1)
+
+    jac_x1 = np.multiply(np.where(x1_neg, np.multiply(-3.0 * np.multiply(a, x1) + 2.0 * b, x1),
+                                  else_ydot0_6d(x2, z, slope)), tau1)
+
+    jac_z = np.multiply(-1.0 + np.where(x1_neg, 0.0, 1.2 * np.multiply(z - 4.0, x1)), tau1)
+
+    jac_x2 = np.multiply(np.where(x1_neg, 0.0, -x1), tau1)
+
+    return jac_x1, jac_z, jac_x2
+
+
+def eqtn_jac_x1_2d(x1, z, slope, a, b, d, tau1, x1_neg=True):
+
+    jac_x1, jac_z = eqtn_jac_x1_2d_diag(x1, z, slope, a, b, d, tau1, x1_neg)
+
+    return np.concatenate([np.diag(jac_x1.flatten()), np.diag(jac_z.flatten())], axis=1)
 
 
 def eqtn_fx1z_diff(x1, K, w, ix, jx, a, b, d, tau1, tau0, zmode=np.array("lin")):  # , z_pos=True
@@ -180,13 +242,30 @@ def eqtn_fx1z_diff(x1, K, w, ix, jx, a, b, d, tau1, tau0, zmode=np.array("lin"))
 
     dfx1_3_dx1 = 3 * np.multiply(np.power(x1[ix], 2.0), a[ix]) + 2 * np.multiply(x1[ix], d[ix] - b[ix])
 
-    fx1z_diff = np.empty_like(dcoupl_dx, dtype=dcoupl_dx.dtype)
-    for xi in ix:
-        for xj in jx:
-            if xj == xi:
-                fx1z_diff[xi, xj] = np.multiply(dfx1_3_dx1[xi] + dfx1_1_dx1[xi] - dcoupl_dx[xi, xj], tau[xi])
-            else:
-                fx1z_diff[xi, xj] = np.multiply(- dcoupl_dx[xi, xj], tau[xi])
+    if issparse(dcoupl_dx):
+        # Sparse connectivity: the diagonal terms are added where the "from" and "to" regions coincide
+        regions, iix, ijx = np.intersect1d(ix, jx, return_indices=True)
+        fx1z_diff = csr_matrix(((dfx1_3_dx1 + dfx1_1_dx1)[iix], (iix, ijx)), shape=dcoupl_dx.shape) - dcoupl_dx
+        return diags(tau[ix]).dot(fx1z_diff).tocsr()
+
+    if dcoupl_dx.dtype == "object":
+        # Symbolic (object) arrays are filled element by element
+        fx1z_diff = np.empty_like(dcoupl_dx, dtype=dcoupl_dx.dtype)
+        for xi in ix:
+            for xj in jx:
+                if xj == xi:
+                    fx1z_diff[xi, xj] = np.multiply(dfx1_3_dx1[xi] + dfx1_1_dx1[xi] - dcoupl_dx[xi, xj], tau[xi])
+                else:
+                    fx1z_diff[xi, xj] = np.multiply(- dcoupl_dx[xi, xj], tau[xi])
+        return fx1z_diff
+
+    # Off diagonal elements: -dcoupl_ij * tau_i
+    ix = np.array(ix, dtype="i").flatten()
+    fx1z_diff = np.multiply(- dcoupl_dx, np.expand_dims(tau[ix], 1)).astype(dcoupl_dx.dtype)
+
+    # Diagonal elements: (dfx1_i - dcoupl_ii) * tau_i
+    regions, iix, ijx = np.intersect1d(ix, np.array(jx, dtype="i").flatten(), return_indices=True)
+    fx1z_diff[iix, ijx] = np.multiply(dfx1_3_dx1[iix] + dfx1_1_dx1[iix] - dcoupl_dx[iix, ijx], tau[regions])
 
     return fx1z_diff
 
@@ -199,7 +278,7 @@ def eqtn_fy1(x1, yc, y1, d, tau1):
 def eqtn_fz(x1, z, x0, tau1, tau0, zmode=np.array("lin"), z_pos=True, K=None, w=None, coupl=None):
 
     if coupl is None:
-        if np.all(K == 0.0) or np.all(w == 0.0) or (K is None) or (w is None):
+        if np.all(K == 0.0) or is_zero_connectivity(w) or (K is None) or (w is None):
             coupl = 0.0
         else:
             from tvb_epilepsy.base.computations.calculations_utils import calc_coupling
@@ -216,31 +295,40 @@ def eqtn_fz(x1, z, x0, tau1, tau0, zmode=np.array("lin"), z_pos=True, K=None, w=
         raise_value_error('zmode is neither "lin" nor "sig"')
 
 
-def eqtn_jac_fz_2d(x1, z, tau1, tau0, zmode=np.array("lin"), z_pos=True, K=None, w=None):
+def eqtn_jac_fz_2d_diag(x1, z, tau1, tau0, zmode=np.array("lin"), z_pos=True):
 
-    tau = np.divide(tau1, tau0)
+    # The derivatives of fz of every region with respect to its own x1 and z, without the coupling terms
 
-    jac_z = - np.ones(z.shape, dtype=z.dtype)
+    tau = np.divide(tau1, tau0)
 
     if zmode == 'lin':
 
         jac_x1 = 4.0 * np.ones(z.shape, dtype=z.dtype)
 
-        if not (z_pos):
-            jac_z -= 0.7 * np.power(z, 6.0)
+        jac_z = -1.0 - np.where(z_pos, 0.0, 0.7 * np.power(z, 6.0))
 
     elif zmode == 'sig':
-        jac_x1 = np.divide(30 * np.power(np.exp(1), (-10.0 * (x1 + 0.5))),
-                           1 + np.power(np.exp(1), (-10.0 * (x1 + 0.5))))
+        exp_fun = np.power(np.exp(1), (-10.0 * (x1 + 0.5)))
+        jac_x1 = np.divide(30 * exp_fun, np.power(1 + exp_fun, 2))
+
+        jac_z = - np.ones(z.shape, dtype=z.dtype)
+
     else:
         raise_value_error('zmode is neither "lin" nor "sig"')
 
+    return np.multiply(jac_x1, tau), np.multiply(jac_z, tau)
+
+
+def eqtn_jac_fz_2d(x1, z, tau1, tau0, zmode=np.array("lin"), z_pos=True, K=None, w=None):
+
+    tau = np.divide(tau1, tau0)
+
+    jac_x1, jac_z = eqtn_jac_fz_2d_diag(x1, z, tau1, tau0, zmode, z_pos)
+
     # Assuming that wii = 0
-    jac_x1 += np.multiply(K, np.sum(w, 1))
-    jac_x1 = np.diag(jac_x1.flatten()) - np.multiply(np.repeat(np.reshape(K, (x1.size, 1)), x1.size, axis=1), w)
-    jac_x1 *= np.repeat(np.reshape(tau, (x1.size, 1)), x1.size, axis=1)
+    jac_x1 = np.diag((jac_x1 + np.multiply(np.multiply(K, np.sum(w, 1)), tau)).flatten()) - \
+             np.multiply(np.repeat(np.reshape(np.multiply(K, tau), (x1.size, 1)), x1.size, axis=1), w)
 
-    jac_z *= tau
     jac_z = np.diag(jac_z.flatten())
 
     return np.concatenate([jac_x1, jac_z], axis=1)
@@ -262,7 +350,8 @@ def eqtn_fx1z_2d_zpos_jac(x1, K, w, ix0, iE, a, b, d, tau1, tau0):
     tau = np.divide(tau1, tau0)
 
     jac_e_x0e = np.diag(np.multiply(tau[:, iE], (- 4 * i_e.T)).flatten())
-    jac_e_x1o = -np.dot(np.dot(i_e, np.multiply(tau[:, iE], K[:, iE])), w[iE][:, ix0])
+    # d fz_i / d x1_j = - tau_i * K_i * w_ij, for i in iE and j in ix0
+    jac_e_x1o = -np.multiply(np.multiply(tau[:, iE], K[:, iE]).T, w[iE][:, ix0])
     jac_x0_x0e = np.zeros((no_x0, no_e), dtype="float32")
     jac_x0_x1o = (np.diag(np.multiply(tau[:, ix0],
                                       (4 + 3 * np.multiply(a[:, ix0], np.power(x1[:, ix0], 2))
@@ -279,6 +368,27 @@ def eqtn_fx1z_2d_zpos_jac(x1, K, w, ix0, iE, a, b, d, tau1, tau0):
     return jac
 
 
+def eqtn_fx1z_2d_zpos_jac_sparse(x1, K, w, ix0, iE, a, b, tau):
+
+    # Same as eqtn_fx1z_2d_zpos_jac for a scipy.sparse connectivity w, with b already corresponding to EpileptorDP2D.
+    # The Jacobian is returned dense, as it is meant for scipy.optimize.root
+
+    x1, K, a, b, tau = [np.array(p).flatten() for p in (x1, K, a, b, tau)]
+    tau_K = np.multiply(tau, K)
+    w = w.tocsr()
+    w_x0 = w[ix0]
+
+    jac = np.zeros((x1.size, x1.size), dtype=x1.dtype)
+    jac[iE, iE] = -4.0 * tau[iE]
+    jac[np.ix_(iE, ix0)] = -diags(tau_K[iE]).dot(w[iE][:, ix0]).toarray()
+    jac[np.ix_(ix0, ix0)] = \
+        np.diag(np.multiply(tau[ix0], 4 + 3 * np.multiply(a[ix0], np.power(x1[ix0], 2)) - 2 * np.multiply(b[ix0], x1[ix0])
+                            + np.multiply(K[ix0], sparse_sum(w_x0, axis=1)))) - \
+        diags(tau_K[ix0]).dot(w_x0[:, ix0]).toarray()
+
+    return jac
+
+
 def eqtn_fx1y1_6d_diff_x1(x1, a, b, tau1):
 
     return np.multiply(np.multiply(-3 * np.multiply(x1, a) + 2 * b, x1), tau1)
@@ -326,13 +436,75 @@ def eqtn_fK(K_var, K, tau1, tau0):
     return np.divide(np.multiply(-K_var + K, tau1), tau0)
 
 
+def _eqtn_pmode_xp(z, g, pmode, diff=False):
+    # The xp of pmode, the interval [xp1, xp2] it is scaled from,
+    # and, if diff, its derivatives with respect to z and g
+
+    dxp_dz = 0.0
+    dxp_dg = 0.0
+
+    if pmode == 'g':
+        xp = 1.0 / (1.0 + np.exp(1) ** (-10 * (g + 0.0)))
+        if diff:
+            dxp_dg = 10.0 * xp * (1.0 - xp)
+        xp1 = 0  # -0.175
+        xp2 = 1  # 0.025
+
+    elif pmode == 'z':
+        xp = 1.0 / (1.0 + np.exp(1) ** (-10 * (z - 3.00)))
+        if diff:
+            dxp_dz = 10.0 * xp * (1.0 - xp)
+        xp1 = 0
+        xp2 = 1
+
+    elif pmode == 'z*g':
+        xp = z * g
+        dxp_dz = g
+        dxp_dg = z
+        xp1 = -0.7
+        xp2 = 0.1
+
+    else:
+        return None
+
+    return xp, xp1, xp2, dxp_dz, dxp_dg
+
+
+def eqtn_slope_Iext2(z, g, pmode, slope, Iext2):
+    # The targets of the slope and Iext2 state variables of EpileptorDPrealistic, depending on pmode,
+    # i.e., interval_scaling(xp, xp1, target, xp2, p) = p + (xp - xp2) * (target - p) / (xp1 - xp2)
+
+    pmode_xp = _eqtn_pmode_xp(z, g, pmode)
+    if pmode_xp is None:
+        return slope, Iext2
+    xp, xp1, xp2 = pmode_xp[:3]
+
+    slope_eq = slope + (xp - xp2) * (1.0 - slope) / (xp1 - xp2)
+    Iext2_eq = Iext2 + (xp - xp2) * (0.0 - Iext2) / (xp1 - xp2)
+
+    return slope_eq, Iext2_eq
+
+
+def eqtn_slope_Iext2_diff(z, g, pmode, slope, Iext2):
+    # The derivatives of slope_eq and Iext2_eq of eqtn_slope_Iext2 with respect to z and g
+
+    pmode_xp = _eqtn_pmode_xp(z, g, pmode, diff=True)
+    if pmode_xp is None:
+        return 0.0, 0.0, 0.0, 0.0
+    xp1, xp2, dxp_dz, dxp_dg = pmode_xp[1:]
+
+    dslope_dxp = (1.0 - slope) / (xp1 - xp2)
+    dIext2_dxp = (0.0 - Iext2) / (xp1 - xp2)
+
+    return dslope_dxp * dxp_dz, dslope_dxp * dxp_dg, dIext2_dxp * dxp_dz, dIext2_dxp * dxp_dg
+
+
 def eqtn_fparams_vars(x0_var, slope_var, Iext1_var, Iext2_var, K_var, x0, slope, Iext1, Iext2, K, tau1, tau0,
                       pmode="const", z=None, g=None):
 
     fx0 = eqtn_fx0(x0_var, x0, tau1)
 
-    from tvb_epilepsy.tvb_api.epileptor_models import EpileptorDPrealistic
-    slope_eq, Iext2_eq = EpileptorDPrealistic.fun_slope_Iext2(z, g, pmode, slope, Iext2)
+    slope_eq, Iext2_eq = eqtn_slope_Iext2(z, g, pmode, slope, Iext2)
 
     fslope = eqtn_fslope(slope_var, slope_eq, tau1)
 
@@ -409,6 +581,10 @@ def eqtn_fz_square_taylor(zeq, yc, Iext1, K, w, tau1, tau0):
     n_regions = zeq.size
 
     tau = np.divide(tau1, tau0)
+
+    if issparse(w):
+        return eqtn_fz_square_taylor_sparse(zeq, yc, Iext1, K, w, tau)
+
     tau = np.repeat(tau.T, n_regions, 1)
 
     # The z derivative of the function
@@ -436,3 +612,50 @@ def eqtn_fz_square_taylor(zeq, yc, Iext1, K, w, tau1, tau0):
         pass
 
     return np.multiply(fz_jac, tau)
+
+
+def eqtn_fz_square_taylor_sparse(zeq, yc, Iext1, K, w, tau):
+
+    # Same as eqtn_fz_square_taylor for a scipy.sparse connectivity w, returning a sparse Jacobian
+    # with the sparsity pattern of w, plus the diagonal
+
+    zeq, yc, Iext1, K, tau = [np.array(p).flatten() for p in (zeq, yc, Iext1, K, tau)]
+
+    dfz = -np.divide(0.5, np.power(2.0 * (zeq - yc - Iext1) + 64.0 / 27.0, 0.5))
+
+    # Diagonal elements: -1 + dfz_i * (4 + K_i * sum_j_not_i{wij})
+    # Off diagonal elements: -K_i * wij_not_i * dfz_j_not_i
+    fz_jac = diags(-1.0 + np.multiply(dfz, 4.0 + np.multiply(K, sparse_sum(w, axis=1)))) - \
+             diags(K).dot(w.tocsr()).dot(diags(dfz))
+
+    try:
+        if np.any([np.any(np.isnan(fz_jac.data)), np.any(np.isinf(fz_jac.data))]):
+            raise_value_error("nan or inf values in dfz")
+    except:
+        pass
+
+    return diags(tau).dot(fz_jac).tocsr()
+
+
+def eqtn_fz_square_taylor_batch(zeq, yc, Iext1, K, w, tau1, tau0):
+
+    # Same as eqtn_fz_square_taylor, but for a batch of B configurations stacked along the first axis:
+    # zeq, yc, Iext1, K, tau1, tau0 are arrays of shape (B, n_regions),
+    # w is either a common (n_regions, n_regions) connectivity, or a (B, n_regions, n_regions) stack of them
+
+    n_regions = zeq.shape[1]
+
+    tau = np.divide(tau1, tau0)
+
+    # The z derivative of the function
+    # x1 = F(z) = -4/3 -1/2*sqrt(2(z-yc-Iext1)+64/27)
+    dfz = -np.divide(0.5, np.power(2.0 * (zeq - yc - Iext1) + 64.0 / 27.0, 0.5))
+
+    # Off diagonal elements: -K_i * wij_not_i * dfz_j_not_i
+    fz_jac = -np.multiply(np.multiply(K[:, :, np.newaxis], dfz[:, np.newaxis, :]), w)
+
+    # Diagonal elements: -1 + dfz_i * (4 + K_i * sum_j_not_i{wij})
+    diag_indices = np.arange(n_regions)
+    fz_jac[:, diag_indices, diag_indices] += -1.0 + np.multiply(dfz, 4.0 + np.multiply(K, np.sum(w, axis=-1)))
+
+    return np.multiply(fz_jac, tau[:, :, np.newaxis])
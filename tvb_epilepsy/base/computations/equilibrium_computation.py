@@ -2,15 +2,22 @@
 Module to compute the resting equilibrium point of a Virtual Epileptic Patient module
 """
 
+import hashlib
+from collections import OrderedDict
+
 import numpy
+from scipy.linalg import lu_factor, lu_solve
 from scipy.optimize import root
+from scipy.sparse import issparse, diags, bmat
+from scipy.sparse.linalg import splu
 
 from tvb_epilepsy.base.constants import X1_DEF, X1_EQ_CR_DEF, SYMBOLIC_CALCULATIONS_FLAG, A_DEF, B_DEF, D_DEF, \
-                                        SLOPE_DEF, S_DEF, GAMMA_DEF
+                                        SLOPE_DEF, S_DEF, GAMMA_DEF, LINTAYLOR_LU_CACHE_SIZE
 from tvb_epilepsy.base.utils import assert_arrays, warning, raise_value_error, raise_not_implemented_error, \
                                     initialize_logger
 from tvb_epilepsy.base.computations.calculations_utils import calc_x0, calc_fx1, calc_fx1z, calc_fy1, calc_fz, calc_fg,\
                                                   calc_coupling, calc_dfun, calc_fx1z_2d_x1neg_zpos_jac, calc_fx1z_diff
+from tvb_epilepsy.base.computations.equations_utils import sparse_sum
 
 logger = initialize_logger(__name__)
 
@@ -68,7 +75,12 @@ def calc_eq_x1(yc, Iext1, x0, K, w, a=A_DEF, b=B_DEF, d=D_DEF, zmode=numpy.array
     fx1z = lambda x1: calc_fx1z(x1, x0, K, w, yc, Iext1, a=a, b=b, d=d, tau1=1.0, tau0=1.0, model=model, zmode=zmode,
                                 shape=(Iext1.size, ))
 
-    jac = lambda x1: calc_fx1z_diff(x1, K, w, a, b, d, tau1=1.0, tau0=1.0, model=model, zmode=zmode)
+    def jac(x1):
+        fx1z_diff = calc_fx1z_diff(x1, K, w, a, b, d, tau1=1.0, tau0=1.0, model=model, zmode=zmode)
+        # scipy.optimize.root needs a dense Jacobian, also for a sparse connectivity
+        if issparse(fx1z_diff):
+            fx1z_diff = fx1z_diff.toarray()
+        return fx1z_diff
 
     sol = root(fx1z, -1.5*numpy.ones((Iext1.size, )), jac=jac, method='lm', tol=10 ** (-12), callback=None, options=None)
     #args=(y2eq[ii], zeq[ii], g_eq[ii], Iext2[ii], s, tau1, tau2, x2_neg)  method='hybr'
@@ -319,7 +331,81 @@ def eq_x1_hypo_x0_optimize_jac(x, ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1,a=A_DE
     return calc_fx1z_2d_x1neg_zpos_jac(x1EQ, zEQ, x0, yc, Iext1,  K, w, ix0, iE, a=a, b=b, d=d, tau1=1.0, tau0=1.0)
 
 
-def eq_x1_hypo_x0_optimize(ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1, a=A_DEF, b=B_DEF, d=D_DEF, slope=SLOPE_DEF):
+class X1EqOptimizeParameters(object):
+
+    # The parameters of the eq_x1_hypo_x0_optimize problem, validated, broadcast and converted to contiguous float64
+    # arrays once per solve, together with all quantities that do not change between iterations
+    # (i.e., the connectivity row sums and the constant blocks of the Jacobian).
+    # Its fun and jac methods are the fast equivalents of eq_x1_hypo_x0_optimize_fun and eq_x1_hypo_x0_optimize_jac
+    # for tau1 = tau0 = 1, "lin" zmode and x1 < 0, that do no checks at all on every call of the solver.
+
+    def __init__(self, ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1, a=A_DEF, b=B_DEF, d=D_DEF, slope=SLOPE_DEF):
+
+        n_regions = x1EQ.size
+
+        x1EQ, zEQ, yc, Iext1, K, a, b, d, slope = assert_arrays([x1EQ, zEQ, yc, Iext1, K, a, b, d, slope],
+                                                                 (n_regions, ))
+
+        x0 = assert_arrays([x0], (len(ix0), ))
+
+        w = assert_arrays([w], (n_regions, n_regions))
+
+        self.ix0 = numpy.array(ix0, dtype="i").flatten()
+        self.iE = numpy.array(iE, dtype="i").flatten()
+
+        # Working vectors, holding the fixed x1EQ values of the iE regions and the fixed x0 values of the ix0 regions
+        self.x1 = numpy.array(x1EQ, dtype="float64").flatten()
+        self.x0 = numpy.zeros((n_regions, ), dtype="float64")
+        self.x0[self.ix0] = numpy.array(x0, dtype="float64").flatten()
+        self.z = numpy.array(zEQ, dtype="float64").flatten()
+
+        # Coefficients of z = yc + Iext1 + x1 * (-a * x1 ** 2 + (b - d) * x1) for the ix0 regions
+        # (calc_eq_z for the "2d" model and x1 < 0)
+        self.yc_Iext1 = numpy.array(yc + Iext1, dtype="float64").flatten()[self.ix0]
+        self.a = numpy.array(a, dtype="float64").flatten()[self.ix0]
+        self.b = numpy.array(b - d, dtype="float64").flatten()[self.ix0]
+
+        # coupling = K * (w.dot(x1) - x1 * sum(w, axis=1))
+        self.K = numpy.array(K, dtype="float64").flatten()
+        if issparse(w):
+            self.w = w.astype("float64").tocsr()
+            w_x0_x0 = self.w[self.ix0][:, self.ix0].toarray()
+            w_e_x0 = self.w[self.iE][:, self.ix0].toarray()
+        else:
+            self.w = numpy.ascontiguousarray(w, dtype="float64")
+            w_x0_x0 = self.w[numpy.ix_(self.ix0, self.ix0)]
+            w_e_x0 = self.w[numpy.ix_(self.iE, self.ix0)]
+        self.w_sum = numpy.array(sparse_sum(self.w, axis=1), dtype="float64").flatten()
+
+        # Jacobian with respect to the unknowns (x1 at ix0, x0 at iE):
+        # only the diagonal of the (ix0, ix0) block depends on x1
+        K_x0 = self.K[self.ix0]
+        self.jac0 = numpy.zeros((n_regions, n_regions), dtype="float64")
+        self.jac0[numpy.ix_(self.iE, self.iE)] = -4.0 * numpy.eye(self.iE.size)
+        self.jac0[numpy.ix_(self.iE, self.ix0)] = -self.K[self.iE][:, numpy.newaxis] * w_e_x0
+        self.jac0[numpy.ix_(self.ix0, self.ix0)] = -K_x0[:, numpy.newaxis] * w_x0_x0
+        self.jac0_diag = self.jac0[self.ix0, self.ix0] + 4.0 + K_x0 * self.w_sum[self.ix0]
+
+    def fun(self, x):
+
+        x1_x0 = x[self.ix0]
+        self.x1[self.ix0] = x1_x0
+        self.z[self.ix0] = self.yc_Iext1 + x1_x0 * (-self.a * x1_x0 ** 2 + self.b * x1_x0)
+        self.x0[self.iE] = x[self.iE]
+
+        return 4.0 * (self.x1 - self.x0) - self.z - self.K * (self.w.dot(self.x1) - self.x1 * self.w_sum)
+
+    def jac(self, x):
+
+        x1_x0 = x[self.ix0]
+        jac = numpy.array(self.jac0)
+        jac[self.ix0, self.ix0] = self.jac0_diag + 3.0 * self.a * x1_x0 ** 2 - 2.0 * self.b * x1_x0
+
+        return jac
+
+
+def eq_x1_hypo_x0_optimize(ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1, a=A_DEF, b=B_DEF, d=D_DEF, slope=SLOPE_DEF,
+                           xinit=None):
 
     x1EQ, zEQ, yc, Iext1, K, a, b, d, slope = assert_arrays([x1EQ, zEQ, yc, Iext1, K, a, b, d, slope], (x1EQ.size, ))
 
@@ -327,23 +413,38 @@ def eq_x1_hypo_x0_optimize(ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1, a=A_DEF, b=B
 
     w = assert_arrays([w], (x1EQ.size, x1EQ.size))
 
-    xinit = numpy.zeros(x1EQ.shape, dtype=x1EQ.dtype)
+    # Solve in double precision, even for single precision inputs, so that the solver converges within tol,
+    # instead of iterating on the rounding errors of the residual. The solution is returned in the input's type.
+    x1_type = x1EQ.dtype
+    # Validate and prepare the parameters once, instead of on every residual and Jacobian evaluation
+    parameters = X1EqOptimizeParameters(ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1, a, b, d, slope)
+
+    if xinit is None:
 
-    #Set initial conditions for the optimization algorithm, by ignoring coupling (=0)
-    # fz = 4 * (x1 - x0_values) - z -coupling = 0
-    #x0init = x1 - z/4
-    xinit[iE] = calc_x0(x1EQ[iE], zEQ[iE], K=0.0, w=0.0, zmode=numpy.array("lin"), z_pos=True, shape=None)
-    #x1eqinit = x0 + z / 4
-    xinit[ix0] = x0 + zEQ[ix0] / 4.0
+        xinit = numpy.zeros(x1EQ.shape, dtype="float64")
+
+        #Set initial conditions for the optimization algorithm, by ignoring coupling (=0)
+        # fz = 4 * (x1 - x0_values) - z -coupling = 0
+        #x0init = x1 - z/4
+        xinit[iE] = calc_x0(x1EQ[iE], zEQ[iE], K=0.0, w=0.0, zmode=numpy.array("lin"), z_pos=True, shape=None)
+        #x1eqinit = x0 + z / 4
+        xinit[ix0] = x0 + zEQ[ix0] / 4.0
+
+    else:
+        # A given initial guess (e.g., a previous solution for a neighbouring set of parameters, for continuation)
+        # must have the layout of the solution: x1 equilibria at ix0 and model x0 values at iE
+        xinit = numpy.array(xinit, dtype="float64").flatten()
+        if xinit.shape != x1EQ.shape:
+            raise_value_error("xinit shape " + str(xinit.shape) + " is not equal to x1EQ shape " + str(x1EQ.shape) +
+                              "!")
 
     #Solve:
-    sol = root(eq_x1_hypo_x0_optimize_fun, xinit,
-               args=(ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1, a, b, d, slope),
-               method='lm', jac=eq_x1_hypo_x0_optimize_jac, tol=10**(-12), callback=None, options=None) #method='hybr'
+    sol = root(parameters.fun, xinit, method='lm', jac=parameters.jac, tol=10**(-12), callback=None,
+               options=None) #method='hybr'
 
     if sol.success:
         x1EQ[ix0] = sol.x[ix0]
-        x0sol = sol.x[iE]
+        x0sol = sol.x[iE].astype(x1_type)
         if numpy.any([numpy.any(numpy.isnan(sol.x)), numpy.any(numpy.isinf(sol.x))]):
             raise_value_error("nan or inf values in solution x\n" + sol.message)
         else:
@@ -360,69 +461,166 @@ def eq_x1_hypo_x0_linTaylor(ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1, a=A_DEF, b=
 
     w = assert_arrays([w], (x1EQ.size, x1EQ.size))
 
-    no_x0 = len(ix0)
+    x1EQ, x0sol = eq_x1_hypo_x0_linTaylor_batch(ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1)
+
+    #Return also the solution of x0s for the regions of fixed e_values (equilibria):
+    return x1EQ.flatten(), x0sol.flatten()
+
+
+def eq_x1_hypo_x0_linTaylor_batch(ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1):
+
+    # Multiple right hand sides' version of eq_x1_hypo_x0_linTaylor, for n_samples sets of equilibria and x0 values,
+    # i.e., x1EQ, zEQ of shape (n_samples, n_regions) and x0 of shape (n_samples, len(ix0)),
+    # which share the same connectivity w, global coupling K and split of regions into ix0 and iE ones.
+    # yc and Iext1 are broadcast to the shape of x1EQ.
+    # The matrix of the linear system depends only on the latter, and its LU factorization is cached and reused
+    # (see linTaylor_lu), so that all samples are solved together by a multiple right hand sides' triangular solve.
+
+    ix0 = numpy.array(ix0, dtype="i").flatten()
+    iE = numpy.array(iE, dtype="i").flatten()
+    x1_type = x1EQ.dtype
+    x1EQ = numpy.array(x1EQ, dtype=x1_type)
+    n_samples, n_regions = x1EQ.shape
     no_e = len(iE)
 
-    n_regions = no_e + no_x0
+    yc, Iext1 = [numpy.broadcast_to(p, x1EQ.shape) for p in (yc, Iext1)]
+    K = numpy.array(K).flatten()
+    if K.size == 1:
+        K = K * numpy.ones((n_regions, ))
 
     # The equilibria of the nodes of fixed epileptogenicity
     x1_eq = x1EQ[:, iE]
     z_eq = zEQ[:, iE]
 
-    #Prepare linear system to solve:
+    #The point of the linear Taylor expansion
+    x1LIN = def_x1lin(X1_DEF, X1_EQ_CR_DEF, n_regions).astype(x1_type).flatten()
 
-    x1_type = x1EQ.dtype
+    # Solve the system for all right hand sides at once
+    x = linTaylor_lu_solve(linTaylor_lu(ix0, iE, K, w, x1LIN, x1_type),
+                           linTaylor_rhs(ix0, iE, x1_eq, z_eq, x0, K, w, yc, Iext1, x1LIN).astype(x1_type))
+    if numpy.any([numpy.any(numpy.isnan(x)), numpy.any(numpy.isinf(x))]):
+        raise_value_error("nan or inf values in solution x")
 
-    #The point of the linear Taylor expansion
-    x1LIN = def_x1lin(X1_DEF, X1_EQ_CR_DEF, n_regions).astype(x1_type)
+    # Unpack solution:
+    # The equilibria of the regions with fixed e_values have not changed:
+    # The equilibria of the regions with fixed x0_values:
+    x1EQ[:, ix0] = x[no_e:].T
+
+    #Return also the solution of x0s for the regions of fixed e_values (equilibria):
+    return x1EQ, x[:no_e].T.astype(x1_type)
+
+
+def linTaylor_rhs(ix0, iE, x1_eq, z_eq, x0, K, w, yc, Iext1, x1LIN):
+
+    # The right hand sides of the linear system of eq_x1_hypo_x0_linTaylor, one column per sample
+
+    if issparse(w):
+        w = w.tocsr()
+    w_e_to_e = w[iE][:, iE]
+    w_e_to_x0 = w[ix0][:, iE]
 
     # For regions of fixed equilibria:
-    ii_e = numpy.ones((1, no_e), dtype=x1_type)
-    we_to_e = numpy.expand_dims(numpy.sum(w[iE][:, iE] * (numpy.dot(ii_e.T, x1_eq) -
-                                                          numpy.dot(x1_eq.T, ii_e)), axis=1), 1).T.astype(x1_type)
-    wx0_to_e = x1_eq * numpy.expand_dims(numpy.sum(w[ix0][:, iE], axis=0), 0).astype(x1_type)
-    be = 4.0 * x1_eq - z_eq - K[:, iE] * (we_to_e - wx0_to_e)
+    if issparse(w):
+        rows_sum_e_to_e = sparse_sum(w_e_to_e, axis=1)
+        cols_sum_e_to_x0 = sparse_sum(w_e_to_x0, axis=0)
+    else:
+        rows_sum_e_to_e = numpy.sum(w_e_to_e, axis=1)
+        cols_sum_e_to_x0 = numpy.sum(w_e_to_x0, axis=0)
+    we_to_e = w_e_to_e.dot(x1_eq.T).T - x1_eq * rows_sum_e_to_e
+    wx0_to_e = x1_eq * cols_sum_e_to_x0
+    be = 4.0 * x1_eq - z_eq - K[iE] * (we_to_e - wx0_to_e)
 
     # For regions of fixed x0_values:
-    ii_x0 = numpy.ones((1, no_x0), dtype=x1_type)
-    we_to_x0 = numpy.expand_dims(numpy.sum(w[ix0][:, iE] * numpy.dot(ii_x0.T, x1_eq), axis=1), 1).T.astype(x1_type)
-    bx0 = - 4.0 * x0 - yc[:, ix0] - Iext1[:, ix0] - 2.0 * x1LIN[:, ix0] ** 3 - 2.0 * x1LIN[:, ix0] ** 2 \
-          - K[:, ix0] * we_to_x0
+    we_to_x0 = w_e_to_x0.dot(x1_eq.T).T
+    bx0 = - 4.0 * x0 - yc[:, ix0] - Iext1[:, ix0] - 2.0 * x1LIN[ix0] ** 3 - 2.0 * x1LIN[ix0] ** 2 \
+          - K[ix0] * we_to_x0
+
+    # Concatenate B vectors:
+    return -numpy.concatenate((be, bx0), axis=1).T
+
+
+def linTaylor_matrix(ix0, iE, K, w, x1LIN, x1_type):
+
+    # The matrix of the linear system of eq_x1_hypo_x0_linTaylor, which is sparse for a sparse connectivity
+
+    no_x0 = len(ix0)
+    no_e = len(iE)
+
+    if issparse(w):
+        w = w.tocsr()
+    w_x0_to_e = w[iE][:, ix0]
+    w_x0_to_x0 = w[ix0][:, ix0]
+    if issparse(w):
+        cols_sum_x0_to_x0 = sparse_sum(w_x0_to_x0, axis=0)
+    else:
+        cols_sum_x0_to_x0 = numpy.sum(w_x0_to_x0, axis=0)
 
-    # Concatenate B vector:
-    b = -numpy.concatenate((be, bx0), axis=1).T.astype(x1_type)
+    # From-to x0_values-fixed regions (diagonal)
+    ax0_to_x0_diag = 4.0 + 3.0 * x1LIN[ix0] ** 2 + 4.0 * x1LIN[ix0] + K[ix0] * cols_sum_x0_to_x0
+
+    if issparse(w):
+        return bmat([[diags(-4.0 * numpy.ones((no_e, ))), -diags(K[iE]).dot(w_x0_to_e)],
+                     [None, diags(ax0_to_x0_diag) - diags(K[ix0]).dot(w_x0_to_x0)]], format="csc", dtype="float64")
 
     # From-to Epileptogenicity-fixed regions
-    # ae_to_e = -4 * numpy.eye( no_e, dtype=numpy.float32 )
     ae_to_e = -4 * numpy.diag(numpy.ones((no_e,))).astype(x1_type)
 
     # From x0_values-fixed regions to Epileptogenicity-fixed regions
-    ax0_to_e = -numpy.dot(K[:, iE].T, ii_x0) * w[iE][:, ix0]
+    ax0_to_e = -numpy.expand_dims(K[iE], 1) * w_x0_to_e
 
     # From Epileptogenicity-fixed regions to x0_values-fixed regions
     ae_to_x0 = numpy.zeros((no_x0, no_e), dtype=x1_type)
 
     # From-to x0_values-fixed regions
-    ax0_to_x0 = numpy.diag( (4.0 + 3.0 * x1LIN[:, ix0] ** 2 + 4.0 * x1LIN[:, ix0] +
-                K[0, ix0] * numpy.expand_dims(numpy.sum(w[ix0][:, ix0], axis=0), 0)).T[:, 0]) - \
-                numpy.dot(K[:, ix0].T, ii_x0) * w[ix0][:, ix0]
+    ax0_to_x0 = numpy.diag(ax0_to_x0_diag) - numpy.expand_dims(K[ix0], 1) * w_x0_to_x0
 
     # Concatenate A matrix
-    a = numpy.concatenate((numpy.concatenate((ae_to_e, ax0_to_e), axis=1),
-                           numpy.concatenate((ae_to_x0, ax0_to_x0), axis=1)), axis=0).astype(x1_type)
+    return numpy.concatenate((numpy.concatenate((ae_to_e, ax0_to_e), axis=1),
+                              numpy.concatenate((ae_to_x0, ax0_to_x0), axis=1)), axis=0).astype(x1_type)
 
-    # Solve the system
-    x = numpy.dot(numpy.linalg.inv(a), b).T
-    if numpy.any([numpy.any(numpy.isnan(x)), numpy.any(numpy.isnan(x))]):
-        raise_value_error("nan or inf values in solution x")
 
-    # Unpack solution:
-    # The equilibria of the regions with fixed e_values have not changed:
-    # The equilibria of the regions with fixed x0_values:
-    x1EQ[0, ix0] = x[0, no_e:]
+# A least recently used cache of the LU factorizations of the linTaylor system's matrices:
+_linTaylor_lu_cache = OrderedDict()
 
-    #Return also the solution of x0s for the regions of fixed e_values (equilibria):
-    return x1EQ.flatten(), x[0, :no_e].flatten()
+
+def linTaylor_lu(ix0, iE, K, w, x1LIN, x1_type):
+
+    # The LU factorization of the matrix of the linear system of eq_x1_hypo_x0_linTaylor,
+    # cached for each (split of regions into ix0 and iE, K, w) by a digest of their values,
+    # so that it is computed only once, even if w is modified in place in between:
+
+    key = hashlib.sha1()
+    for p in (numpy.array(ix0, dtype="i"), numpy.array(iE, dtype="i"), numpy.array(K, dtype=x1_type)):
+        key.update(numpy.ascontiguousarray(p))
+    if issparse(w):
+        w = w.tocsr()
+        for p in (w.data, w.indices, w.indptr):
+            key.update(numpy.ascontiguousarray(p))
+    else:
+        key.update(numpy.ascontiguousarray(w))
+    key.update(str(w.shape) + str(numpy.dtype(x1_type)))
+    key = key.hexdigest()
+
+    lu = _linTaylor_lu_cache.pop(key, None)
+    if lu is None:
+        a = linTaylor_matrix(ix0, iE, K, w, x1LIN, x1_type)
+        if issparse(a):
+            lu = splu(a)
+        else:
+            lu = lu_factor(a)
+        while len(_linTaylor_lu_cache) >= LINTAYLOR_LU_CACHE_SIZE:
+            _linTaylor_lu_cache.popitem(last=False)
+    _linTaylor_lu_cache[key] = lu
+
+    return lu
+
+
+def linTaylor_lu_solve(lu, b):
+    if isinstance(lu, tuple):
+        return lu_solve(lu, b)
+    else:
+        # SuperLU factorization of a sparse matrix
+        return lu.solve(numpy.asfortranarray(b, dtype="float64"))
 
 
 def assert_equilibrium_point(epileptor_model, weights, equilibrium_point):
@@ -1,12 +1,174 @@
+import os
+import hashlib
+import inspect
+import pickle
+from collections import OrderedDict
+from functools import wraps
+from types import FunctionType
+
 import numpy
 from numpy import array, empty_like, reshape
+import sympy
 from sympy import Symbol, solve, solveset, lambdify,series, Matrix  # diff, ArraySymbol
 from sympy.tensor.array import Array
 
-from tvb_epilepsy.base.utils import shape_to_size, raise_value_error
+from tvb_epilepsy.base.constants import SYMBOLIC_CACHE_SIZE, SYMBOLIC_CACHE_FOLDER
+from tvb_epilepsy.base.utils import shape_to_size, raise_value_error, warning
+from tvb_epilepsy.base.computations import equations_utils
 from tvb_epilepsy.base.computations.equations_utils import *
 
 
+# In-memory LRU cache of the results (lambdified functions, symbolic expressions and symbolic variables)
+# of the symbol_* builders, keyed by the builder and the values of all its arguments,
+# optionally backed by a folder, where the generated code of the lambdified functions is stored across runs
+_symbolic_cache = OrderedDict()
+_symbolic_cache_folder = SYMBOLIC_CACHE_FOLDER
+# The digests of the versions of the symbol_* builders, computed once per builder
+_symbolic_builder_versions = dict()
+
+
+def set_symbolic_cache_folder(folder=None):
+    # Set the folder to store the symbol_* builders' results to, or None to disable the on-disk cache
+    global _symbolic_cache_folder
+    _symbolic_cache_folder = folder
+
+
+def clear_symbolic_cache(folder=False):
+    _symbolic_cache.clear()
+    if folder and _symbolic_cache_folder is not None and os.path.isdir(_symbolic_cache_folder):
+        for filename in os.listdir(_symbolic_cache_folder):
+            if filename.endswith(".pkl"):
+                os.remove(os.path.join(_symbolic_cache_folder, filename))
+
+
+def _symbolic_builder_version(builder):
+    # A digest of the source code of the builder and of the equations, and of the sympy version,
+    # so that the results stored to disk are not used any more after any of them changes
+    version = _symbolic_builder_versions.get(builder, None)
+    if version is None:
+        digest = hashlib.sha1(inspect.getsource(builder))
+        digest.update(inspect.getsource(equations_utils))
+        digest.update(sympy.__version__)
+        version = digest.hexdigest()
+        _symbolic_builder_versions[builder] = version
+    return version
+
+
+def _symbolic_cache_key(builder, args, kwargs):
+
+    def normalize(arg):
+        if isinstance(arg, numpy.ndarray):
+            return normalize(arg.tolist())
+        elif isinstance(arg, (list, tuple)):
+            return tuple(normalize(a) for a in arg)
+        elif isinstance(arg, numpy.generic):
+            return arg.item()
+        else:
+            return arg
+
+    # Positional and keyword arguments, as well as default values, map to the same key:
+    call_args = inspect.getcallargs(builder, *args, **kwargs)
+
+    return repr((builder.__module__, builder.__name__, _symbolic_builder_version(builder),
+                 tuple((arg, normalize(call_args[arg])) for arg in sorted(call_args.keys()))))
+
+
+def _map_symbolic_result(result, fun):
+    if isinstance(result, dict):
+        return dict((key, _map_symbolic_result(val, fun)) for key, val in result.iteritems())
+    elif isinstance(result, list):
+        return [_map_symbolic_result(item, fun) for item in result]
+    elif isinstance(result, tuple):
+        return tuple(_map_symbolic_result(item, fun) for item in result)
+    else:
+        return fun(result)
+
+
+def _copy_symbolic_item(item):
+    # Lambdified functions and sympy expressions are immutable, but numpy arrays of symbols and sympy matrices are not
+    if isinstance(item, (numpy.ndarray, Matrix)):
+        return item.copy()
+    else:
+        return item
+
+
+class LambdifiedCode(object):
+
+    # The code generated by lambdify for a function, which, unlike the function, can be pickled.
+
+    def __init__(self, function):
+        self.name = function.__name__
+        self.code = inspect.getsource(function)
+
+    def compile(self):
+        # The namespace lambdify executes the generated code in, for the "numpy" module
+        namespace = dict(lambdify([], 0, "numpy").__globals__)
+        exec(self.code, namespace)
+        return namespace[self.name]
+
+
+def _symbolic_cache_filepath(key):
+    return os.path.join(_symbolic_cache_folder, hashlib.sha1(key).hexdigest() + ".pkl")
+
+
+def _load_symbolic_result(key):
+    if _symbolic_cache_folder is None:
+        return None
+    filepath = _symbolic_cache_filepath(key)
+    if not os.path.isfile(filepath):
+        return None
+    try:
+        with open(filepath, "rb") as f:
+            stored_key, result = pickle.load(f)
+    except Exception as e:
+        warning("Failed to load cached symbolic result from " + filepath + ": " + str(e))
+        return None
+    if stored_key != key:
+        return None
+    return _map_symbolic_result(result, lambda item: item.compile() if isinstance(item, LambdifiedCode) else item)
+
+
+def _store_symbolic_result(key, result):
+    if _symbolic_cache_folder is None:
+        return
+    filepath = _symbolic_cache_filepath(key)
+    try:
+        result = _map_symbolic_result(result,
+                                      lambda item: LambdifiedCode(item) if isinstance(item, FunctionType) else item)
+        if not os.path.isdir(_symbolic_cache_folder):
+            os.makedirs(_symbolic_cache_folder)
+        # Write to a temporary file first, so that concurrent runs never read a partially written file
+        temp_filepath = filepath + "." + str(os.getpid()) + ".tmp"
+        with open(temp_filepath, "wb") as f:
+            pickle.dump((key, result), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filepath, filepath)
+    except Exception as e:
+        warning("Failed to store symbolic result to " + filepath + ": " + str(e))
+
+
+def symbolic_cache(builder):
+
+    # Decorator of the symbol_* builders, so that, for the same arguments, the sympy symbols, expressions and
+    # their derivatives are built and lambdified only once
+
+    @wraps(builder)
+    def cached_builder(*args, **kwargs):
+        key = _symbolic_cache_key(builder, args, kwargs)
+        result = _symbolic_cache.pop(key, None)
+        if result is None:
+            result = _load_symbolic_result(key)
+            if result is None:
+                result = builder(*args, **kwargs)
+                _store_symbolic_result(key, result)
+            while len(_symbolic_cache) >= SYMBOLIC_CACHE_SIZE:
+                _symbolic_cache.popitem(last=False)
+        _symbolic_cache[key] = result
+        # Return copies of the containers, since the callers often update them (e.g., the symbolic variables' dict)
+        return _map_symbolic_result(result, _copy_symbolic_item)
+
+    return cached_builder
+
+
 def symbol_vars(n_regions, vars_str, dims=1, ind_str="_", shape=None, output_flag="numpy_array"):
 
     vars_out = list()
@@ -70,6 +232,7 @@ def symbol_vars(n_regions, vars_str, dims=1, ind_str="_", shape=None, output_fla
     return tuple(vars_out)
 
 
+@symbolic_cache
 def symbol_eqtn_coupling(n, ix=None, jx=None, K="K", shape=None):
 
     # Only difference coupling for the moment.
@@ -90,6 +253,7 @@ def symbol_eqtn_coupling(n, ix=None, jx=None, K="K", shape=None):
     return lambdify([x1, K, w], coupling, "numpy"), coupling, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_x0cr_r(n, zmode=numpy.array("lin"), shape=None):
 
     Iext1, yc, a, b, d, x1_rest, x1_cr, x0_rest, x0_cr, vars_dict = \
@@ -106,6 +270,7 @@ def symbol_eqtn_x0cr_r(n, zmode=numpy.array("lin"), shape=None):
     return (x0cr_lambda, r_lambda), (x0cr, r), vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_x0(n, zmode=numpy.array("lin"), z_pos=True, K="K", shape=None):
 
     x1, z, K, vars_dict = symbol_vars(n, ["x1", "z", K], shape=shape)
@@ -120,6 +285,7 @@ def symbol_eqtn_x0(n, zmode=numpy.array("lin"), z_pos=True, K="K", shape=None):
     return x0_lambda, x0, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fx1(n, model="2d", x1_neg=True, slope="slope", Iext1="Iext1", shape=None):
 
     x1, z, y1, slope, Iext1, a, b, d, tau1, vars_dict = symbol_vars(n, ["x1", "z", "y1", slope, Iext1, "a", "b", "d",
@@ -142,6 +308,7 @@ def symbol_eqtn_fx1(n, model="2d", x1_neg=True, slope="slope", Iext1="Iext1", sh
 
 
 
+@symbolic_cache
 def symbol_eqtn_fy1(n, shape=None):
 
     x1, y1, yc, d, tau1, vars_dict = symbol_vars(n, ["x1", "y1", "yc", "d", "tau1"], shape=shape)
@@ -151,6 +318,7 @@ def symbol_eqtn_fy1(n, shape=None):
     return lambdify([x1, y1, yc, d, tau1], fy1, "numpy"), fy1, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fz(n, zmode=numpy.array("lin"), z_pos=True, x0="x0", K="K", shape=None):
 
     x1, z, x0, K, tau1, tau0, vars_dict = symbol_vars(n, ["x1", "z", x0, K, "tau1", "tau0"], shape=shape)
@@ -165,6 +333,7 @@ def symbol_eqtn_fz(n, zmode=numpy.array("lin"), z_pos=True, x0="x0", K="K", shap
     return fz_lambda, fz, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fx2(n, Iext2="Iext2", shape=None):
 
     x2, y2, z, g, Iext2, tau1, vars_dict = symbol_vars(n, ["x2", "y2", "z", "g", Iext2, "tau1"], shape=shape)
@@ -174,6 +343,7 @@ def symbol_eqtn_fx2(n, Iext2="Iext2", shape=None):
     return lambdify([x2, y2, z, g, Iext2, tau1], fx2, "numpy"), fx2, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fy2(n, x2_neg=False, shape=None):
 
     x2, y2, s, tau1, tau2, vars_dict = symbol_vars(n, ["x2", "y2", "s", "tau1", "tau2"], shape=shape)
@@ -183,6 +353,7 @@ def symbol_eqtn_fy2(n, x2_neg=False, shape=None):
     return lambdify([x2, y2, s, tau1, tau2], fy2, "numpy"), fy2, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fg(n, shape=None):
 
     x1, g, gamma, tau1, vars_dict = symbol_vars(n, ["x1", "g", "gamma", "tau1"], shape=shape)
@@ -192,6 +363,7 @@ def symbol_eqtn_fg(n, shape=None):
     return lambdify([x1, g, gamma, tau1], fg, "numpy"), fg, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fx0(n, shape=None):
 
     x0_var, x0, tau1, vars_dict = symbol_vars(n, ["x0_var", "x0", "tau1"], shape=shape)
@@ -201,6 +373,7 @@ def symbol_eqtn_fx0(n, shape=None):
     return lambdify([x0_var, x0, tau1], fx0, "numpy"), fx0, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fslope(n, pmode=array("const"), shape=None):
 
     slope_var, z, g, slope, tau1, vars_dict = symbol_vars(n, ["slope_var", "z", "g", "slope", "tau1"], shape=shape)
@@ -224,6 +397,7 @@ def symbol_eqtn_fslope(n, pmode=array("const"), shape=None):
     return fslope_lambda, fslope, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fIext1(n, shape=None):
 
     Iext1_var, Iext1, tau1, tau0, vars_dict = symbol_vars(n, ["Iext1_var", "Iext1", "tau1", "tau0"], shape=shape)
@@ -233,6 +407,7 @@ def symbol_eqtn_fIext1(n, shape=None):
     return lambdify([Iext1_var, Iext1, tau1, tau0], fIext1, "numpy"), fIext1, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fIext2(n, pmode=array("const"), shape=None):
 
     Iext2_var, z, g, Iext2, tau1, vars_dict = symbol_vars(n, ["Iext2_var", "z", "g", "Iext2", "tau1"], shape=shape)
@@ -255,6 +430,7 @@ def symbol_eqtn_fIext2(n, pmode=array("const"), shape=None):
 
     return fIext2_lambda, fIext2, vars_dict
 
+@symbolic_cache
 def symbol_eqtn_fK(n, shape=None):
 
     K_var, K, tau1, tau0, vars_dict = symbol_vars(n, ["K_var", "K", "tau1", "tau0"], shape=shape)
@@ -264,6 +440,7 @@ def symbol_eqtn_fK(n, shape=None):
     return lambdify([K_var, K, tau1, tau0], fK, "numpy"), fK, vars_dict
 
 
+@symbolic_cache
 def symbol_eqtn_fparam_vars(n, pmode=array("const"), shape=None):
 
     fx0_lambda, fx0, vars_dict = symbol_eqtn_fx0(n, shape)
@@ -284,6 +461,7 @@ def symbol_eqtn_fparam_vars(n, pmode=array("const"), shape=None):
            (fx0, fslope, fIext1, fIext2, fK), vars_dict
 
 
+@symbolic_cache
 def symbol_eqnt_dfun(n, model_vars, zmode=array("lin"), x1_neg=True, x2_neg=False, z_pos=True,
                      pmode=array("const"), output_mode="array", shape=None):
 
@@ -387,6 +565,7 @@ def symbol_eqnt_dfun(n, model_vars, zmode=array("lin"), x1_neg=True, x2_neg=Fals
     return f_lambda, f_sym, v
 
 
+@symbolic_cache
 def symbol_calc_jac(n_regions, model_vars, zmode=array("lin"), x1_neg=True, x2_neg=False, z_pos=True,
                     pmode=array("const")):
 
@@ -469,6 +648,7 @@ def symbol_calc_jac(n_regions, model_vars, zmode=array("lin"), x1_neg=True, x2_n
     return jac_lambda, jac_sym, v
 
 
+@symbolic_cache
 def symbol_calc_coupling_diff(n, ix=None, jx=None, K="K"):
 
     if ix is None:
@@ -485,6 +665,7 @@ def symbol_calc_coupling_diff(n, ix=None, jx=None, K="K"):
     return lambdify([v["K"], v["w"]], dcoupl_dx, "numpy"), dcoupl_dx, v
 
 
+@symbolic_cache
 def symbol_calc_2d_taylor(n, x_taylor="x1lin", order=2, x1_neg=True, slope="slope", Iext1="Iext1", shape=None):
 
     fx1ser, v = symbol_eqtn_fx1(n, model="2d", x1_neg=x1_neg, slope=slope, Iext1=Iext1)[1:]
@@ -509,6 +690,7 @@ def symbol_calc_2d_taylor(n, x_taylor="x1lin", order=2, x1_neg=True, slope="slop
                     fx1ser, "numpy"), fx1ser, v
 
 
+@symbolic_cache
 def symbol_calc_fx1z_2d_x1neg_zpos_jac(n, ix0, iE):
 
     fx1, v = symbol_eqtn_fx1(n, model="2d", x1_neg=True, slope="slope", Iext1="Iext1", shape=None)[1:]
@@ -537,6 +719,7 @@ def symbol_calc_fx1z_2d_x1neg_zpos_jac(n, ix0, iE):
                      v["tau0"]], jac, "numpy"), jac, v
 
 
+@symbolic_cache
 def symbol_calc_fx1y1_6d_diff_x1(n, shape=None):
 
     fx1, v = symbol_eqtn_fx1(n, model="6d", x1_neg=True, slope="slope", Iext1="Iext1", shape=None)[1:]
@@ -564,6 +747,7 @@ def symbol_calc_fx1y1_6d_diff_x1(n, shape=None):
     return lambdify([v["x1"], v["yc"], v["Iext1"], v["a"], v["b"], v["d"], v["tau1"]], dfx1, "numpy"), dfx1, v
 
 
+@symbolic_cache
 def symbol_calc_x0cr_r(n, zmode=array("lin"), shape=None):
 
     # Define the z equilibrium expression...
@@ -623,6 +807,7 @@ def symbol_calc_x0cr_r(n, zmode=array("lin"), shape=None):
            (x0cr, r), v
 
 
+@symbolic_cache
 def symbol_eqtn_fx1z(n, model="6d", zmode=array("lin"), shape=None):  #x1_neg=True, z_pos=True,
 
     # TODO: for the extreme z_pos = False case where we have terms like 0.1 * z ** 7
@@ -676,6 +861,7 @@ def symbol_eqtn_fx1z(n, model="6d", zmode=array("lin"), shape=None):  #x1_neg=Tr
     return fx1z_lambda, fx1z, v
 
 
+@symbolic_cache
 def symbol_eqtn_fx1z_diff(n, model, zmode=array("lin")): #x1_neg=True, , z_pos=True
 
     # TODO: for the extreme z_pos = False case where we have terms like 0.1 * z ** 7
@@ -693,6 +879,7 @@ def symbol_eqtn_fx1z_diff(n, model, zmode=array("lin")): #x1_neg=True, , z_pos=T
     return dfx1z_dx1_lambda, dfx1z_dx1, v
 
 
+@symbolic_cache
 def symbol_eqtn_fx2y2(n, x2_neg=False, shape=None):
 
     y2eq, vy = symbol_eqtn_fy2(n, x2_neg=x2_neg)[1:]
@@ -720,6 +907,7 @@ def symbol_eqtn_fx2y2(n, x2_neg=False, shape=None):
     return lambdify([v["x2"], v["z"], v["g"], v["Iext2"], v["s"], v["tau1"]], fx2, 'numpy'), fx2, v
 
 
+@symbolic_cache
 def symbol_calc_fz_jac_square_taylor(n):
 
     fx1sq, v = symbol_calc_2d_taylor(n, x_taylor="x1sq", order=3, x1_neg=True, slope="slope", Iext1="Iext1")[1:]
@@ -12,6 +12,8 @@ SHOW_FLAG = False
 MOUSEHOOVER = False
 
 TIME_DELAYS_FLAG = 0.0
+# Conduction speed (mm/ms) of the time delays, as the TVB default
+CONDUCTION_SPEED = 3.0
 
 # Default model parameters
 X0_DEF = 0.0
@@ -50,12 +52,34 @@ NOISE_SEED = 42
 
 SYMBOLIC_CALCULATIONS_FLAG = False
 
+# Maximum number of cached LU factorizations for the linTaylor computation of the equilibria
+LINTAYLOR_LU_CACHE_SIZE = 16
+
+# Maximum number of cached lambdified functions of symbolic_utils,
+# and an optional folder to also store their generated code to, across runs (None to disable)
+SYMBOLIC_CACHE_SIZE = 64
+SYMBOLIC_CACHE_FOLDER = None
+
+# Maximum number of cached configured TVB simulators (i.e., skeletons to be completed with a model and initial
+# conditions), keyed by the connectivity, integration step, integrator, noise and monitors of the simulations
+SIMULATOR_CACHE_SIZE = 8
+
+# Compute the dfun of the EpileptorDP models with fused kernels, writing to preallocated buffers,
+# with numexpr (if available, on more than one core) for states of at least FUSED_DFUN_NUMEXPR_SIZE elements,
+# and numpy otherwise
+FUSED_DFUN_FLAG = False
+FUSED_DFUN_NUMEXPR_SIZE = 2 ** 15
+
 # Options: "auto_eigenvals",  "auto_disease", "auto_epileptogenicity", "auto_excitability",
 # or "user_defined", in which case we expect a number equal to from 1 to hypothesis.n_regions
 EIGENVECTORS_NUMBER_SELECTION = "auto_eigenvals"
 WEIGHTED_EIGENVECTOR_SUM = True
 INTERACTIVE_ELBOW_POINT = False
 
+# Default storage profile of the TS written to H5 files, one of custom.read_write.TS_STORAGE_PROFILES:
+# "contiguous", "gzip", "gzip_float32", "lz4" or "lz4_float32"
+TS_STORAGE_PROFILE = "gzip"
+
 # Information needed for the custom simulation
 HDF5_LIB = "libjhdf5.dylib"
 LIB_PATH = "/Applications/Episense.app/Contents/Java"
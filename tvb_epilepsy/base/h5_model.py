@@ -3,9 +3,10 @@ from collections import OrderedDict
 from copy import deepcopy
 
 import h5py
+from h5py import h5o
 import numpy as np
 
-from tvb_epilepsy.base.utils import warning, initialize_logger, change_filename_or_overwrite, \
+from tvb_epilepsy.base.utils import warning, raise_value_error, initialize_logger, change_filename_or_overwrite, \
                                     set_list_item_by_reference_safely, get_list_or_tuple_item_safely, \
                                     list_or_tuple_to_dict, dict_to_list_or_tuple, sort_dict
 
@@ -25,11 +26,135 @@ class_list = ["list", "tuple", "dict",  "Connectivity", "Surface", "Sensors", "H
                  "DeterministicSamplingService", "StochasticSamplingService", "PSEService", 
                  "SensitivityAnalysisService"]
 
+# The class name suffixes ("#" + class name, for the classes of class_list, or "") and the kinds of the objects
+# of each class, i.e., how object_to_h5_model_recursively stores them, computed once per class:
+_h5_schema = dict()
+
+
+def _class_schema(cls):
+    schema = _h5_schema.get(cls, None)
+    if schema is None:
+        if cls.__name__ in class_list:
+            suffix = "#" + cls.__name__
+        else:
+            suffix = ""
+        if cls is type(None):
+            kind = "none"
+        elif issubclass(cls, (float, int, long, complex, str)):
+            kind = "metadata"
+        elif issubclass(cls, np.ndarray):
+            kind = "dataset"
+        elif issubclass(cls, dict):
+            kind = "dict"
+        elif issubclass(cls, (list, tuple)):
+            kind = "sequence"
+        else:
+            kind = "object"
+        schema = (suffix, kind)
+        _h5_schema[cls] = schema
+    return schema
+
+
+def _bool_inf_nan_empty_key(obj):
+    # The key of bool_inf_nan_empty that obj is (elementwise) equal to, if any. The comparisons of most objects
+    # with True return a single bool, instead of an iterable, in which case none of the keys can be matched.
+    try:
+        if isinstance(obj == True, (bool, np.bool_)):
+            return None
+    except:
+        pass
+    for key, val in bool_inf_nan_empty.iteritems():
+        try:
+            if all(obj == val):
+                return key
+        except:
+            continue
+    return None
+
+
+# The dtypes that h5py would guess for str and unicode values, i.e., variable length strings:
+_h5_string_dtypes = {str: h5py.special_dtype(vlen=bytes), unicode: h5py.special_dtype(vlen=unicode)}
+
+
+def _write_h5_datasets(h5_file, datasets_dict):
+    # Convert each field to an array only once, and pass its dtype to create_dataset, instead of letting it be guessed
+    for attribute, field in datasets_dict.iteritems():
+        data = np.asarray(field, order="C")
+        h5_file.create_dataset("/" + attribute, data=data, dtype=data.dtype)
+
+
+def _write_h5_attributes(h5_file, metadata_dict):
+    # Pass attrs.create the precomputed dtypes of the str and unicode values, instead of letting them be guessed
+    for meta, val in metadata_dict.iteritems():
+        h5_file.attrs.create(meta, val, dtype=_h5_string_dtypes.get(type(val), None))
+
+
+class H5DatasetProxy(object):
+
+    # A dataset of an H5 file read by read_h5_model(path, lazy=True), which is read only when it is accessed,
+    # as a whole, by read() or numpy.array(), or in slices, by indexing it, as long as the file is open.
+
+    def __init__(self, h5_file, path):
+        self.h5_file = h5_file
+        self.path = path
+
+    def _dataset(self):
+        if not self.h5_file:
+            raise_value_error("The H5 file of lazy dataset " + self.path + " has been closed!")
+        return self.h5_file[self.path]
+
+    @property
+    def shape(self):
+        return self._dataset().shape
+
+    @property
+    def dtype(self):
+        return self._dataset().dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return len(self._dataset())
+
+    def __getitem__(self, index):
+        return self._dataset()[index]
+
+    def read(self):
+        return self._dataset()[()]
+
+    def __array__(self, dtype=None):
+        data = np.asarray(self.read())
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def __repr__(self):
+        return "H5DatasetProxy(" + self.path + ")"
+
+
 class H5Model(object):
 
-    def __init__(self, datasets_dict, metadata_dict):
+    def __init__(self, datasets_dict, metadata_dict, h5_file=None):
         self.datasets_dict = datasets_dict
         self.metadata_dict = metadata_dict
+        # The open H5 file of the H5DatasetProxy datasets of a lazy read_h5_model, if any:
+        self.h5_file = h5_file
+
+    def close(self):
+        if self.h5_file:
+            self.h5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def add_or_update_metadata_attribute(self, key, value):
         self.metadata_dict.update({key: value})
@@ -61,11 +186,8 @@ class H5Model(object):
 
         h5_file = h5py.File(final_path, 'a', libver='latest')
 
-        for attribute, field in self.datasets_dict.iteritems():
-            h5_file.create_dataset("/" + attribute, data=field)
-
-        for meta, val in self.metadata_dict.iteritems():
-            h5_file.attrs.create(meta, val)
+        _write_h5_datasets(h5_file, self.datasets_dict)
+        _write_h5_attributes(h5_file, self.metadata_dict)
 
         h5_file.close()
 
@@ -83,12 +205,15 @@ class H5Model(object):
 
         data = sort_dict(data)
 
+        items = []
         for key, value in data.iteritems():
 
             if key[0] == "/":
                 key = key.split('/', 1)[1]
 
-            build_hierarchical_object_recursively(obj, key, value, children_dict)
+            items.append((key, value))
+
+        build_hierarchical_object_recursively(obj, items, children_dict)
 
         if np.in1d(output, ["tuple", "list"]):
             obj = dict_to_list_or_tuple(obj, output)
@@ -123,81 +248,79 @@ def convert_to_h5_model(obj):
 
 def object_to_h5_model_recursively(h5_model, obj, name="", root=False):
 
+    # Objects are visited depth first, in the order of their (alphabetically sorted) attributes, with a stack,
+    # instead of recursively. The schema of each class is computed only once.
     # Use in some cases the name of the class as key, when name is empty string. Otherwise, class_name = name.
-    name_empty = (len(name) == 0)
-    class_name = name_empty * obj.__class__.__name__ + name
 
-    if obj is None:
-        h5_model.add_or_update_metadata_attribute(class_name, "None")
+    datasets_dict = h5_model.datasets_dict
+    metadata_dict = h5_model.metadata_dict
 
-    if isinstance(obj, (float, int, long, complex, str, np.ndarray)):
+    stack = [(obj, name, root)]
+    while len(stack) > 0:
+        obj, name, root = stack.pop()
 
-        if isinstance(obj, (float, int, long, complex, str)):
-            h5_model.add_or_update_metadata_attribute(class_name, obj)
-
-        elif isinstance(obj, np.ndarray):
-            h5_model.add_or_update_datasets_attribute(class_name, obj)
-
-    else:
-
-        for key, val in bool_inf_nan_empty.iteritems():
-            # Bool, inf, nan, or empty list/tuple/dict/str
-            try:
-                if all(obj == val):
-                    h5_model.add_or_update_metadata_attribute(class_name, key)
-                    return
-            except:
-                continue
+        suffix, kind = _class_schema(obj.__class__)
+        if len(name) == 0:
+            class_name = obj.__class__.__name__
+        else:
+            class_name = name
+
+        if kind == "metadata":
+            metadata_dict[class_name] = obj
+            continue
+        elif kind == "dataset":
+            datasets_dict[class_name] = obj
+            continue
+        elif kind == "none":
+            metadata_dict[class_name] = "None"
+            continue
+
+        # Bool, inf, nan, or empty list/tuple/dict/str
+        key = _bool_inf_nan_empty_key(obj)
+        if key is not None:
+            metadata_dict[class_name] = key
+            continue
 
         # In any other case, make sure object is/becomes an alphabetically ordered dictionary:
-        if not(isinstance(obj, dict)):
-
-            try:
-
-                for class_type in class_list:
-                    if obj.__class__.__name__ == class_type:
-                        name = name + "#" + obj.__class__.__name__
-                        break
-
-                if isinstance(obj, (list, tuple)):
-                    try:
-                        # empty list or tuple get into metadata
-                        if len(obj) == 0:
-                            h5_model.add_or_update_metadata_attribute(name, key)
-                            return
-                        temp = np.array(obj)
-                        # those that can be converted to np arrays get in datasets
-                        if temp.dtype != "O":
-                            # h5_model.add_or_update_metadata_attribute(name, str(temp))
-                            h5_model.add_or_update_datasets_attribute(name, temp)
-                            return
-                    except:
-                        pass
-                    # the rest are converted to dict
-                    obj = list_or_tuple_to_dict(obj)
-
-                elif isinstance(obj, dict):
-                    obj = sort_dict(obj)
-
-                else:
+        if kind != "dict":
+            name = name + suffix
+            if kind == "sequence":
+                if len(obj) == 0:
+                    # empty list or tuple get into metadata
+                    metadata_dict[name] = "''"
+                    continue
+                try:
+                    temp = np.array(obj)
+                    # those that can be converted to np arrays get in datasets
+                    if temp.dtype != "O":
+                        datasets_dict[name] = temp
+                        continue
+                except:
+                    pass
+                # the rest are converted to dict
+                obj = list_or_tuple_to_dict(obj)
+            else:
+                try:
                     obj = sort_dict(vars(obj))
+                except:
+                    logger.info("Object " + name + " cannot be assigned to h5_model because it has no __dict__ property")
+                    continue
 
-            except:
-                logger.info("Object " + name + (len(name) > 0) * "/" + key + "cannot be assigned to h5_model because it"
-                                                                             "is has no __dict__ property")
-                return
-
+        children = []
         for key, value in obj.iteritems():
-
             if not(root):
                 key = name + (len(name) > 0) * "/" + key
+            if key.find("children_dict") < 0:
+                children.append((value, key, False))
+        stack.extend(reversed(children))
 
-            if key.find("children_dict") < 0 :
-                # call recursively...
-                object_to_h5_model_recursively(h5_model, value, key)
 
+def build_hierarchical_object_recursively(obj, data, children_dict=class_dict, copy_children=True):
 
-def build_hierarchical_object_recursively(obj, key, value, children_dict=class_dict):
+    # Build obj from the (key, value) pairs of data, where the keys are paths relative to obj, in a single pass:
+    # the keys are grouped by their first path component, and each child object is created (or copied, if it
+    # exists already) and built from its own group of keys only once, instead of being copied for every key.
+    # The children of the objects created or copied here are private already, and need not be copied again.
 
     if isinstance(obj, dict):
         set_field = lambda obj, key, value: obj.update({key: value})
@@ -211,22 +334,13 @@ def build_hierarchical_object_recursively(obj, key, value, children_dict=class_d
         set_field = lambda obj, attribute, value: setattr(obj, attribute, value)
         get_field = lambda obj, attribute: getattr(obj, attribute, None)
 
-    # Check whether value is an inf, nan, None, bool, or empty list/dict/tuple/str value
-    try:
-        bool_inf_nan_empty_value = bool_inf_nan_empty.get(value, "skip_bool_inf_nan_empty_value")
-        if bool_inf_nan_empty_value != "skip_bool_inf_nan_empty_value":
-            set_field(obj, key, bool_inf_nan_empty_value)
-            return
-    except:
-        pass
-
-    child_object = get_field(obj, key)
-    if child_object is not None:
-        set_field(obj, key, value)
+    groups = OrderedDict()
+    for key, value in data:
+        this_name, _, child_key = key.partition('/')
+        groups.setdefault(this_name, []).append((child_key, value))
 
-    else:
+    for this_name, children in groups.iteritems():
 
-        this_name = key.split('/', 1)[0]
         split_name = this_name.split('#')
         if len(split_name) == 2:
             name = split_name[0]
@@ -235,54 +349,72 @@ def build_hierarchical_object_recursively(obj, key, value, children_dict=class_d
             class_name = ""
             name = this_name
 
-        try:
+        # value is not a container object, or it is an empty container object
+        if len(children) == 1 and len(children[0][0]) == 0:
+            value = children[0][1]
+
+            # Check whether value is an inf, nan, None, bool, or empty list/dict/tuple/str value
+            try:
+                bool_inf_nan_empty_value = bool_inf_nan_empty.get(value, "skip_bool_inf_nan_empty_value")
+                if bool_inf_nan_empty_value != "skip_bool_inf_nan_empty_value":
+                    set_field(obj, this_name, bool_inf_nan_empty_value)
+                    continue
+            except:
+                pass
 
-           # value is not a container object, or it is an empty container object
-            if this_name == key:
-                # just assign it:
-                if np.in1d(class_name, ["tuple", "list"]) and isinstance(value, np.ndarray):
-                    value = value.tolist()
-                    if class_name == "tuple":
-                        value = tuple(value)
-                set_field(obj, name, value)
-                return 1
+            try:
+                if get_field(obj, this_name) is not None:
+                    set_field(obj, this_name, value)
+                else:
+                    # just assign it:
+                    if np.in1d(class_name, ["tuple", "list"]) and isinstance(value, (np.ndarray, H5DatasetProxy)):
+                        value = np.asarray(value).tolist()
+                        if class_name == "tuple":
+                            value = tuple(value)
+                    set_field(obj, name, value)
+            except:
+                warning("Failed to set attribute " + str(this_name) + " of object " + obj.__class__.__name__ + "!")
+            continue
 
-            else:
-                child_key = key.split('/', 1)[1]
-                child_object = deepcopy(get_field(obj, name))
-                # Check if it exists already:
-                if child_object is None:
-                    # and create it if not:
-                    for class_type, class_instance in children_dict.iteritems():
-                        if class_name == class_type:
-                            child_object = class_instance
+        try:
+            child_object = get_field(obj, name)
+            # Check if it exists already:
+            if child_object is None:
+                # and create it if not, from a copy of the instance of its class in children_dict:
+                child_object = children_dict.get(class_name, None)
+                if child_object is not None:
+                    child_object = deepcopy(child_object)
                     if isinstance(child_object, (list, tuple)):
                         # if it is a list or tuple...
-                        grandchild_name = child_key.split('/', 1)[0]
+                        grandchild_name = children[0][0].split('/', 1)[0]
                         # but its own children names are not strings of integers:
                         if not(grandchild_name.isdigit()):
                             # convert to a dict
                             child_object = list_or_tuple_to_dict(child_object)
-                        # if it is a tuple...
-                        if isinstance(child_object, tuple):
-                            # ...convert to list that is mutable
-                            child_object = list(child_object)
-                # If still not created, make a dict() by default:
-                if child_object is None:
-                    logger.warning("\n Child object " + str(name) +
-                                   " still not created! Creating an Ordereddict() by default!")
-                    child_object = OrderedDict()
-                # ...and continue to further specify it...
-                children_dict.update(getattr(child_object, "children_dict", {}))
-                build_hierarchical_object_recursively(child_object, child_key, value, children_dict)
-                if class_name == "tuple":
-                    child_object = tuple(child_object)
-                set_field(obj, name, child_object)
+            elif copy_children:
+                child_object = deepcopy(child_object)
+            # If still not created, make a dict() by default:
+            if child_object is None:
+                logger.warning("\n Child object " + str(name) +
+                               " still not created! Creating an Ordereddict() by default!")
+                child_object = OrderedDict()
+            # if it is a tuple, convert to list that is mutable
+            if isinstance(child_object, tuple):
+                child_object = list(child_object)
+            # ...and continue to further specify it...
+            children_dict.update(getattr(child_object, "children_dict", {}))
+            build_hierarchical_object_recursively(child_object, children, children_dict, copy_children=False)
+            if class_name == "tuple":
+                child_object = tuple(child_object)
+            set_field(obj, name, child_object)
         except:
-            warning("Failed to set attribute " + str(key) + " of object " + obj.__class__.__name__ + "!")
+            warning("Failed to set attribute " + str(this_name) + " of object " + obj.__class__.__name__ + "!")
+
 
+def read_h5_model(path, lazy=False):
 
-def read_h5_model(path):
+    # If lazy, the datasets are not read, but returned as H5DatasetProxy objects, which are read only when accessed,
+    # and the file is kept open until the H5Model is closed, e.g., with read_h5_model(path, lazy=True) as h5_model:
 
     h5_file = h5py.File(path, 'r', libver='latest')
 
@@ -292,23 +424,33 @@ def read_h5_model(path):
     for key, value in h5_file.attrs.iteritems():
         metadata_dict.update({key: value})
 
-    datasets_keys = return_h5_dataset_paths_recursively(h5_file)
+    datasets_keys = return_h5_dataset_paths(h5_file)
 
-    for key in datasets_keys:
-        datasets_dict.update({key: h5_file[key][()]})
+    if lazy:
+        for key in datasets_keys:
+            datasets_dict.update({key: H5DatasetProxy(h5_file, key)})
+    else:
+        for key in datasets_keys:
+            datasets_dict.update({key: h5_file[key][()]})
 
     datasets_dict = sort_dict(datasets_dict)
     metadata_dict = sort_dict(metadata_dict)
 
-    return H5Model(datasets_dict, metadata_dict)
+    if lazy:
+        return H5Model(datasets_dict, metadata_dict, h5_file)
+    else:
+        h5_file.close()
+        return H5Model(datasets_dict, metadata_dict)
 
 
-def return_h5_dataset_paths_recursively(group):
-    try:
-        paths = []
-        for key in group.keys():
-            paths += return_h5_dataset_paths_recursively(group[key])
+def return_h5_dataset_paths(h5_file):
+    # The paths of all datasets of an H5 file, from the types of its objects, without opening them one by one
+    paths = []
+
+    def add_dataset_path(name, info):
+        if info.type == h5o.TYPE_DATASET:
+            paths.append("/" + name.decode("utf-8"))
+
+    h5o.visit(h5_file.id, add_dataset_path, info=True)
+    return paths
 
-        return paths
-    except:
-        return [group.name]
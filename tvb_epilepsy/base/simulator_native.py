@@ -0,0 +1,323 @@
+"""
+Mechanism for launching native simulations, i.e., integrating the equations of tvb_epilepsy directly with numpy,
+without depending on TVB or on the Java simulator, e.g., for headless batch nodes.
+"""
+
+import sys
+import time
+
+import numpy
+
+from tvb_epilepsy.base.constants import MULTIPLICATIVE_NOISE, ADDITIVE_NOISE
+from tvb_epilepsy.base.utils import warning, raise_value_error
+from tvb_epilepsy.base.h5_model import convert_to_h5_model
+from tvb_epilepsy.base.simulators import ABCSimulator, DelayedCoupling
+from tvb_epilepsy.base.computations.equations_utils import eqtn_fx1, eqtn_fy1, eqtn_fz, eqtn_fx2, eqtn_fy2, \
+    eqtn_fg, eqtn_fx0, eqtn_fslope, eqtn_fIext1, eqtn_fIext2, eqtn_fK, eqtn_slope_Iext2
+
+
+class EpileptorModelNative(object):
+
+    # The EpileptorDP2D, EpileptorDP and EpileptorDPrealistic models, for 2, 6 and 11 state variables, respectively,
+    # with the same parameters, defaults and conventions (e.g., the opposite sign for K), but without TVB.
+    # The tvb_api models can be also used by the native simulator instead.
+
+    _ui_names = {2: "EpileptorDP2D", 6: "EpileptorDP", 11: "EpileptorDPrealistic"}
+    _state_variables = ['x1', 'y1', 'z', 'x2', 'y2', 'g', 'x0_t', 'slope_t', 'Iext1_t', 'Iext2_t', 'K_t']
+
+    def __init__(self, nvar=2, x0=0.0, K=0.0, yc=1.0, Iext1=3.1, Iext2=0.45, a=1.0, b=3.0, d=5.0, slope=0.0, s=4.0,
+                 gamma=0.1, tau1=0.2, tau0=40000.0, tau2=10.0, zmode=numpy.array("lin"), pmode=numpy.array("const")):
+        if nvar not in self._ui_names.keys():
+            raise_value_error("The number of state variables " + str(nvar) + " is not one of 2, 6 and 11!")
+        self._ui_name = self._ui_names[nvar]
+        self._nvar = nvar
+        self.nvar = nvar
+        self.state_variables = ['x1', 'z'] if nvar == 2 else self._state_variables[:nvar]
+        self.x0 = numpy.array(x0, dtype="float64")
+        self.K = numpy.array(K, dtype="float64")
+        self.yc = numpy.array(yc, dtype="float64")
+        self.Iext1 = numpy.array(Iext1, dtype="float64")
+        self.Iext2 = numpy.array(Iext2, dtype="float64")
+        self.a = numpy.array(a, dtype="float64")
+        self.b = numpy.array(b, dtype="float64")
+        self.d = numpy.array(d, dtype="float64")
+        self.slope = numpy.array(slope, dtype="float64")
+        self.s = numpy.array(s, dtype="float64")
+        self.gamma = numpy.array(gamma, dtype="float64")
+        self.tau1 = numpy.array(tau1, dtype="float64")
+        self.tau0 = numpy.array(tau0, dtype="float64")
+        self.tau2 = numpy.array(tau2, dtype="float64")
+        self.zmode = numpy.array(zmode)
+        self.pmode = numpy.array(pmode)
+
+    @staticmethod
+    def fun_slope_Iext2(z, g, pmode, slope, Iext2):
+        return eqtn_slope_Iext2(z, g, pmode, slope, Iext2)
+
+
+def native_model_builder(model_configuration, nvar=2, zmode=numpy.array("lin"), pmode=numpy.array("z")):
+    # We use the opposite sign for K with respect to all epileptor models
+    K = -model_configuration.K
+    if nvar == 2:
+        return EpileptorModelNative(nvar, x0=model_configuration.x0, Iext1=model_configuration.Iext1, K=K,
+                                    yc=model_configuration.yc, a=model_configuration.a, b=model_configuration.b,
+                                    d=model_configuration.d, zmode=zmode)
+    else:
+        return EpileptorModelNative(nvar, x0=model_configuration.x0, Iext1=model_configuration.Iext1,
+                                    Iext2=model_configuration.Iext2, K=K, yc=model_configuration.yc,
+                                    a=model_configuration.a, b=model_configuration.b, d=model_configuration.d,
+                                    s=model_configuration.s, gamma=model_configuration.gamma, zmode=zmode,
+                                    pmode=pmode)
+
+
+class SimulatorNative(ABCSimulator):
+
+    # Integrates the equations of calc_dfun_array (equations_utils) with a vectorized Heun scheme,
+    # with Difference coupling of x1, optional time delays, and white additive or multiplicative noise.
+    # The monitor is a temporal average (default) or a subsampling of the monitor expressions
+    # (default: all state variables), at the monitor sampling period.
+
+    def __init__(self, connectivity, model_configuration, model, simulation_settings):
+        self.model = model
+        self.simulation_settings = simulation_settings
+        self.model_configuration = model_configuration
+        self.connectivity = connectivity
+
+    def _model_parameters(self):
+        # The model parameters of size n_regions as 1D arrays, and all the rest as scalars
+        parameters = dict()
+        for p in ["x0", "K", "yc", "Iext1", "Iext2", "a", "b", "d", "slope", "s", "gamma", "tau1", "tau0", "tau2"]:
+            value = numpy.array(getattr(self.model, p, numpy.nan), dtype="float64")
+            if value.size == 1:
+                parameters[p] = value.item()
+            elif value.size == self.n_regions:
+                parameters[p] = value.flatten()
+            else:
+                raise_value_error("Model parameter " + p + " of shape " + str(value.shape) +
+                                  " does not fit " + str(self.n_regions) + " regions!")
+        parameters["zmode"] = numpy.array(self.model.zmode)
+        parameters["pmode"] = numpy.array(getattr(self.model, "pmode", "const"))
+        return parameters
+
+    def _configure_noise(self):
+        noise_preconfig = self.simulation_settings.noise_preconfig
+        if noise_preconfig is not None and hasattr(noise_preconfig, "nsig"):
+            # A (TVB) noise instance: only its intensity, time scale, type and random stream are used
+            nsig = numpy.array(noise_preconfig.nsig, dtype="float64")
+            ntau = getattr(noise_preconfig, "ntau", 0.0)
+            noise_type = MULTIPLICATIVE_NOISE if noise_preconfig.__class__.__name__ == MULTIPLICATIVE_NOISE \
+                else ADDITIVE_NOISE
+            random_stream = getattr(noise_preconfig, "random_stream", None)
+        else:
+            nsig = numpy.array(self.simulation_settings.noise_intensity, dtype="float64")
+            ntau = self.simulation_settings.noise_ntau
+            noise_type = self.simulation_settings.noise_type
+            if noise_type != MULTIPLICATIVE_NOISE:
+                noise_type = ADDITIVE_NOISE
+            random_stream = None
+        if not isinstance(random_stream, numpy.random.RandomState):
+            random_stream = numpy.random.RandomState(seed=self.simulation_settings.noise_seed)
+        if nsig.size == 1:
+            nsig = numpy.repeat(nsig.flatten(), self.model.nvar)
+        if ntau > 0.0:
+            warning("Coloured noise is not supported by the native simulator! White noise is used instead.")
+        if numpy.max(nsig) > 0:
+            self.simulation_settings.noise_type = noise_type
+            # As for TVB white noise: sqrt(dt) * N(0, 1) * sqrt(2 * nsig), times the state if multiplicative
+            self.noise_gfun = numpy.sqrt(2 * nsig * self.simulation_settings.integration_step).reshape((-1, 1))
+            self.noise_multiplicative = noise_type == MULTIPLICATIVE_NOISE
+        else:
+            self.simulation_settings.noise_type = "None"
+            self.noise_gfun = None
+            self.noise_multiplicative = False
+        self.random_stream = random_stream
+
+    def _configure_monitor(self):
+        dt = self.simulation_settings.integration_step
+        self.istep = max(int(numpy.round(self.simulation_settings.monitor_sampling_period / dt)), 1)
+        monitor_type = str(self.simulation_settings.monitor_type).lower()
+        self.temporal_average = monitor_type == "" or "average" in monitor_type
+        expressions = self.simulation_settings.monitor_expressions
+        if isinstance(expressions, basestring):
+            expressions = [expressions] if len(expressions) > 0 else []
+        if expressions is None or len(expressions) == 0:
+            expressions = self.state_variables
+        expressions = [str(expression) for expression in expressions]
+        if numpy.all([expression in self.state_variables for expression in expressions]):
+            # Only state variables: just index the state
+            self.voi = numpy.array([self.state_variables.index(expression) for expression in expressions])
+            self.voi_expressions = None
+        else:
+            self.voi = None
+            self.voi_expressions = [compile(expression, "<monitor expression>", "eval") for expression in expressions]
+        self.simulation_settings.monitor_expressions = expressions
+
+    def config_simulation(self, initial_conditions=None):
+
+        if isinstance(self.model_configuration.connectivity_matrix, numpy.ndarray):
+            weights = self.model_configuration.connectivity_matrix
+        else:
+            weights = self.connectivity.normalized_weights
+        self.weights = numpy.array(weights, dtype="float64")
+        self.n_regions = self.weights.shape[0]
+
+        dt = self.simulation_settings.integration_step
+        self.idelays = self.time_delays(dt)
+        self.horizon = int(numpy.max(self.idelays)) + 1
+
+        self.parameters = self._model_parameters()
+        self.state_variables = [str(state_variable) for state_variable in self.model.state_variables]
+        self._configure_noise()
+        self._configure_monitor()
+        self.simulation_settings.integrator_type = "heun"
+
+        self.configure_initial_conditions(initial_conditions=initial_conditions)
+
+    def configure_initial_conditions(self, initial_conditions=None):
+
+        if isinstance(initial_conditions, numpy.ndarray):
+            self.initial_conditions = initial_conditions
+
+        else:
+            self.initial_conditions = self.prepare_initial_conditions(history_length=self.horizon)
+
+    def dfun(self, y, coupling):
+        p = self.parameters
+        x1 = y[0]
+        if self.model.nvar == 2:
+            z = y[1]
+            return numpy.array([
+                eqtn_fx1(x1, z, p["yc"], p["Iext1"], p["slope"], p["a"], p["b"], p["d"], p["tau1"], x1 < 0.0,
+                         model="2d"),
+                # We use the opposite sign for K with respect to all epileptor models
+                eqtn_fz(x1, z, p["x0"], p["tau1"], p["tau0"], p["zmode"], z >= 0.0, coupl=-p["K"] * coupling)])
+        y1, z, x2, y2, g = y[1:6]
+        if self.model.nvar == 6:
+            Iext1, slope, x0, K, Iext2 = p["Iext1"], p["slope"], p["x0"], p["K"], p["Iext2"]
+        else:
+            x0, slope, Iext1, Iext2, K = y[6:]
+        dfun = [eqtn_fx1(x1, z, y1, Iext1, slope, p["a"], p["b"], p["d"], p["tau1"], x1 < 0.0, model="6d", x2=x2),
+                eqtn_fy1(x1, p["yc"], y1, p["d"], p["tau1"]),
+                eqtn_fz(x1, z, x0, p["tau1"], p["tau0"], p["zmode"], z >= 0.0, coupl=-K * coupling),
+                eqtn_fx2(x2, y2, z, g, Iext2, p["tau1"]),
+                eqtn_fy2(x2, y2, p["s"], p["tau1"], p["tau2"], x2 < -0.25),
+                # with the slow time scale of the filter of the tvb_api models
+                0.01 * eqtn_fg(x1, g, p["gamma"], p["tau1"])]
+        if self.model.nvar == 11:
+            slope_eq, Iext2_eq = eqtn_slope_Iext2(z, g, p["pmode"], p["slope"], p["Iext2"])
+            dfun += [eqtn_fx0(x0, p["x0"], p["tau1"]),
+                     eqtn_fslope(slope, slope_eq, p["tau1"]),
+                     eqtn_fIext1(Iext1, p["Iext1"], p["tau1"], p["tau0"]),
+                     eqtn_fIext2(Iext2, Iext2_eq, p["tau1"]),
+                     eqtn_fK(K, p["K"], p["tau1"], p["tau0"])]
+        return numpy.array(dfun)
+
+    def _observe(self, state):
+        if self.voi_expressions is None:
+            return state[self.voi]
+        variables = dict(zip(self.state_variables, state))
+        return numpy.array([eval(expression, {"numpy": numpy}, variables) for expression in self.voi_expressions])
+
+    def launch_simulation(self, n_report_blocks=1, sink=None):
+
+        # If a sink (e.g., a TimeSeriesH5Writer) is given, the monitor samples of each report block are appended to it
+        # and flushed at the end of the block, instead of being returned, so that memory is bounded to one block
+
+        # The current state (nvar, n_regions), from the last time point of the initial conditions,
+        # and the Difference coupling of x1, with the history of x1 for the time delays
+        initial_conditions = numpy.array(self.initial_conditions, dtype="float64")
+        if initial_conditions.ndim == 4:
+            initial_conditions = initial_conditions[:, :, :, 0]
+        if initial_conditions.ndim == 2:
+            initial_conditions = initial_conditions[numpy.newaxis]
+        state = initial_conditions[-1].copy()
+        coupling_x1 = DelayedCoupling(self.weights, self.idelays, initial_conditions[:, :1].swapaxes(1, 2))
+
+        # As in TVB, the time steps are counted from the first time point of the initial conditions,
+        # and the monitor samples are taken at the multiples of the monitor's period
+        dt = self.simulation_settings.integration_step
+        n_steps = int(numpy.ceil(self.simulation_settings.simulated_period / dt))
+        first_step = initial_conditions.shape[0]
+        n_samples = (first_step + n_steps - 1) / self.istep - (first_step - 1) / self.istep
+        block_length = max(int(numpy.ceil(float(n_samples) / max(n_report_blocks, 1))), 1)
+
+        # Preallocate the output for all the monitor samples (or for the ones of one report block, for a sink)
+        time_samples = numpy.empty((min(n_samples, block_length) if sink is not None else n_samples,))
+        data = numpy.empty(time_samples.shape + (len(self.simulation_settings.monitor_expressions),
+                                                 self.n_regions, 1))
+        i_sample = 0
+        n_done = 0
+        observed_sum = 0.0
+
+        # Perform the simulation
+        start = time.time()
+
+        try:
+            for step in range(first_step, first_step + n_steps):
+
+                coupling = coupling_x1(state[:1].T)[:, 0]
+                if self.noise_gfun is None:
+                    noise = 0.0
+                else:
+                    noise = self.random_stream.normal(size=state.shape) * self.noise_gfun
+                    if self.noise_multiplicative:
+                        noise *= state
+                dfun = self.dfun(state, coupling)
+                inter = state + dt * dfun + noise
+                state = state + (dfun + self.dfun(inter, coupling)) * dt / 2.0 + noise
+                coupling_x1.update(state[:1].T)
+
+                if self.temporal_average:
+                    observed_sum = observed_sum + self._observe(state)
+                if step % self.istep == 0:
+                    if self.temporal_average:
+                        time_samples[i_sample] = (step - self.istep / 2.0) * dt
+                        data[i_sample, :, :, 0] = observed_sum / self.istep
+                        observed_sum = 0.0
+                    else:
+                        time_samples[i_sample] = step * dt
+                        data[i_sample, :, :, 0] = self._observe(state)
+                    i_sample += 1
+                    n_done += 1
+                    if n_done % block_length == 0:
+                        if sink is not None:
+                            sink.append(time_samples[:i_sample], data[:i_sample])
+                            sink.flush()
+                            i_sample = 0
+                        if n_report_blocks >= 2:
+                            print_this = "\r" + "..." + str(100.0 * (step - first_step + 1) / n_steps) + \
+                                         "% done in " + \
+                                         str(time.time() - start) + " secs"
+                            sys.stdout.write(print_this)
+                            sys.stdout.flush()
+
+        except Exception, error_message:
+            warning("Something went wrong with this simulation...:" + "\n" + str(error_message))
+            if sink is not None:
+                # Keep the results up to the failure
+                sink.append(time_samples[:i_sample], data[:i_sample])
+                sink.flush()
+            return None, None, False
+
+        if sink is not None:
+            sink.append(time_samples[:i_sample], data[:i_sample])
+            sink.flush()
+            return None, None, True
+
+        return time_samples[:i_sample], data[:i_sample], True
+
+    def _prepare_for_h5(self):
+        settings_h5_model = convert_to_h5_model(self.simulation_settings)
+        epileptor_model_h5_model = convert_to_h5_model(self.model)
+
+        epileptor_model_h5_model.append(settings_h5_model)
+        epileptor_model_h5_model.add_or_update_metadata_attribute("EPI_Type", "HypothesisModel")
+        epileptor_model_h5_model.add_or_update_metadata_attribute("Monitor expressions",
+                                                                  self.simulation_settings.monitor_expressions)
+        epileptor_model_h5_model.add_or_update_metadata_attribute("Variables names",
+                                                                  self.simulation_settings.variables_names)
+
+        return epileptor_model_h5_model
+
+    def configure_model(self, **kwargs):
+        self.model = native_model_builder(self.model_configuration, self.model.nvar, **kwargs)
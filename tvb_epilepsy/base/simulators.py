@@ -6,9 +6,8 @@ from abc import ABCMeta, abstractmethod
 
 import numpy
 
-from tvb_epilepsy.base.constants import NOISE_SEED
+from tvb_epilepsy.base.constants import NOISE_SEED, TIME_DELAYS_FLAG, CONDUCTION_SPEED
 from tvb_epilepsy.base.h5_model import convert_to_h5_model
-from tvb_epilepsy.base.computations.equilibrium_computation import calc_equilibrium_point
 from tvb_epilepsy.base.utils import formal_repr
 
 
@@ -83,9 +82,27 @@ class ABCSimulator(object):
     # Prepare for tvb-epilepsy epileptor_models initial conditions
     ###
 
-    def prepare_initial_conditions(self, history_length=1):
+    ###
+    # Time delays and history length
+    ###
+
+    def time_delays(self, dt):
+        # The time delays of the connections in integration steps, from the tract lengths and the conduction speed,
+        # (all zero, unless TIME_DELAYS_FLAG is set) rounded as in TVB
+        return numpy.rint(TIME_DELAYS_FLAG * numpy.array(self.connectivity.tract_lengths, dtype="float64") /
+                          CONDUCTION_SPEED / dt).astype("i")
+
+    def history_length(self, dt):
+        # The number of time points of the history needed for the longest time delay, including the current one
+        return int(numpy.max(self.time_delays(dt))) + 1
+
+    def prepare_initial_conditions(self, history_length=None):
+        if history_length is None:
+            history_length = self.history_length(self.simulation_settings.integration_step)
         # Set default initial conditions right on the resting equilibrium point of the model...
         # ...after computing the equilibrium point (and correct it for zeql for a >=6D model
+        # (imported here, so that the (symbolic) computations are not imported by the light weight simulators)
+        from tvb_epilepsy.base.computations.equilibrium_computation import calc_equilibrium_point
         initial_conditions = calc_equilibrium_point(self.model, self.model_configuration,
                                                     self.connectivity.normalized_weights)
 
@@ -102,3 +119,54 @@ class ABCSimulator(object):
         initial_conditions = numpy.expand_dims(initial_conditions, 2)
         initial_conditions = numpy.tile(initial_conditions, (history_length, 1, 1, 1))
         return initial_conditions
+
+
+class DelayedCoupling(object):
+
+    # The Difference coupling, sum_j w_ij * (x_j(t - d_ij) - x_i(t)), of k coupling variables (e.g., of several state
+    # variables, samples or modes) of all regions, with the time delays d_ij in integration steps.
+    # The history of the coupling variables only is kept in a ring buffer of shape (horizon * n_regions, k), with one
+    # time slot for every step of the longest delay, wherefrom the delayed states of the connections of non-zero
+    # weights are gathered all at once, by flat indices, and summed per region, as in TVB's SparseHistory and
+    # SparseCoupling. Without time delays, there is no history and the coupling is a matrix product.
+
+    def __init__(self, weights, idelays, history):
+        # The history, of shape (time, n_regions, k), ends with the current state.
+        # If it is shorter than the longest delay, it is padded with its first time point.
+        weights = numpy.array(weights, dtype="float64")
+        idelays = numpy.array(idelays, dtype="i")
+        history = numpy.array(history, dtype="float64")
+        self.weights = weights
+        self.weights_sum = numpy.sum(weights, axis=1)[:, numpy.newaxis]
+        self.n_regions = weights.shape[0]
+        self.horizon = int(numpy.max(idelays)) + 1
+        self.step = 0
+        if self.horizon > 1:
+            # The connections of non-zero weights, in row-major order, so that they are summed per region by reduceat:
+            rows, cols = numpy.nonzero(weights)
+            self.nnz_weights = weights[rows, cols][:, numpy.newaxis]
+            self.nnz_rows, self.nnz_row_starts = numpy.unique(rows, return_index=True)
+            # The flat index of x_j(t - d_ij) in the buffer at step 0, to be shifted by n_regions per step:
+            self.nnz_offsets = cols - idelays[rows, cols] * self.n_regions
+            self.buffer = numpy.empty((self.horizon * self.n_regions,) + history.shape[2:])
+            for step in range(1 - self.horizon, 1):
+                self.buffer[self._slot(step)] = history[max(step + history.shape[0] - 1, 0)]
+
+    def _slot(self, step):
+        i_start = (step % self.horizon) * self.n_regions
+        return slice(i_start, i_start + self.n_regions)
+
+    def __call__(self, x):
+        # The coupling at the current step, for its state x, of shape (n_regions, k)
+        if self.horizon == 1:
+            return numpy.dot(self.weights, x) - self.weights_sum * x
+        x_delayed = self.buffer.take((self.step * self.n_regions + self.nnz_offsets) % self.buffer.shape[0], axis=0)
+        coupling = -self.weights_sum * x
+        coupling[self.nnz_rows] += numpy.add.reduceat(self.nnz_weights * x_delayed, self.nnz_row_starts, axis=0)
+        return coupling
+
+    def update(self, x):
+        # Advance by one step, to the state x
+        self.step += 1
+        if self.horizon > 1:
+            self.buffer[self._slot(self.step)] = x
@@ -10,6 +10,7 @@ from datetime import datetime
 import h5py
 import numpy as np
 from matplotlib import use
+from scipy.sparse import issparse
 
 from tvb_epilepsy.base.constants import WEIGHTS_NORM_PERCENT, INTERACTIVE_ELBOW_POINT
 from tvb_epilepsy.base.configurations import FOLDER_LOGS
@@ -285,6 +286,14 @@ def assert_arrays(params, shape=None, transpose=False):
         if isinstance(params[ip], np.ndarray):
             pass
 
+        elif issparse(params[ip]):
+            # scipy.sparse matrices (e.g., connectivity) are only checked for their shape, and they are returned as they
+            # are, without taking part in any shape inference, reshaping or tiling:
+            if shape is not None and params[ip].shape != shape:
+                raise_value_error("Sparse input of shape " + str(params[ip].shape) +
+                                  " is not of the shape given: " + str(shape) + "!")
+            continue
+
         elif isinstance(params[ip], (list, tuple)):
             # assuming a list or tuple of symbols...
             params[ip] = np.array(params[ip]).astype(type(params[ip][0]))
@@ -335,6 +344,10 @@ def assert_arrays(params, shape=None, transpose=False):
             if params[ip].size > size:
                 raise_value_error("At least one input is of a greater size than the one given!")
 
+    if shape is None and len(shapes) == 0:
+        # Only sparse inputs:
+        return params[0] if len(params) == 1 else tuple(params)
+
     if shape is None:
 
         # Keep only shapes of the correct size
@@ -359,6 +372,9 @@ def assert_arrays(params, shape=None, transpose=False):
     # Now reshape or tile when necessary
     for ip in range(len(params)):
 
+        if issparse(params[ip]):
+            continue
+
         try:
             if params[ip].shape != shape:
 
@@ -501,6 +517,24 @@ def curve_elbow_point(vals):
         return elbow
 
 
+def curve_elbow_points(vals_array):
+
+    # Batch version of curve_elbow_point() for the rows of a 2D array
+    vals_array = np.array(vals_array)
+
+    if INTERACTIVE_ELBOW_POINT:
+        return np.array([curve_elbow_point(vals) for vals in vals_array])
+
+    # Sort each row in descending order (a no-op for rows that are already sorted that way):
+    vals_array = np.sort(vals_array, axis=1)[:, ::-1]
+
+    cumsum_vals = np.cumsum(vals_array, axis=1)
+
+    grad = np.gradient(np.gradient(np.gradient(cumsum_vals, axis=1), axis=1), axis=1)
+
+    return np.argmax(grad, axis=1)
+
+
 # File writing/reading and manipulations
 
 
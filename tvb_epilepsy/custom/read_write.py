@@ -5,7 +5,13 @@
 import os
 import h5py
 import numpy
+try:
+    # For the lz4 filter of the TS storage profiles
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
+from tvb_epilepsy.base.constants import TS_STORAGE_PROFILE
 from tvb_epilepsy.base.utils import warning, raise_error, raise_value_error, change_filename_or_overwrite, \
                                     read_object_from_h5_file, print_metadata, write_metadata
 # TODO: solve problems with setting up a logger
@@ -232,9 +238,11 @@ def read_simulation_settings(path=os.path.join(PATIENT_VIRTUAL_HEAD, "ep", "sim_
     return model, sim_settings
 
 
-def read_ts(path=os.path.join(PATIENT_VIRTUAL_HEAD, "ep", "ts.h5"), data=None, logger=logger):
+def read_ts(path=os.path.join(PATIENT_VIRTUAL_HEAD, "ep", "ts.h5"), data=None, lazy=False, logger=logger):
     """
     :param path: Path towards a valid TimeSeries H5 file
+    :param lazy: If True, return TimeSeriesH5Reader handles, which read only the slices that are indexed,
+                 instead of loading the whole datasets
     :return: Timeseries in a numpy array
     """
     logger.info("Reading TimeSeries from:\n" + path)
@@ -242,32 +250,105 @@ def read_ts(path=os.path.join(PATIENT_VIRTUAL_HEAD, "ep", "ts.h5"), data=None, l
     print_metadata(h5_file, logger)
     logger.info("Structures:\n" + str(h5_file["/"].keys()))
 
+    total_time = int(h5_file["/"].attrs["Simulated_period"][0])
+    nr_of_steps = int(h5_file["/data"].attrs["Number_of_steps"][0])
+    start_time = float(h5_file["/data"].attrs["Start_time"][0])
+
+    time = numpy.linspace(start_time, total_time, nr_of_steps)
+
     if isinstance(data, dict):
 
         for key in data:
             logger.info("Values expected shape: " + str(h5_file['/' + key].shape))
-            data[key] = h5_file['/' + key][()]
-            logger.info("Actual Data shape: " + str(data[key].shape))
-            logger.info("First Channel sv sum: " + str(numpy.sum(data[key][:, 0])))
+            if lazy:
+                data[key] = TimeSeriesH5Reader(path, '/' + key, time=time, logger=logger)
+            else:
+                data[key] = h5_file['/' + key][()]
+                logger.info("Actual Data shape: " + str(data[key].shape))
 
     else:
         logger.info("Values expected shape: " + str(h5_file['/data'].shape))
-        data = h5_file['/data'][()]
-        logger.info("Actual Data shape: " + str(data.shape))
-        logger.info("First Channel sv sum: " + str(numpy.sum(data[:, 0])))
-
-    total_time = int(h5_file["/"].attrs["Simulated_period"][0])
-    nr_of_steps = int(h5_file["/data"].attrs["Number_of_steps"][0])
-    start_time = float(h5_file["/data"].attrs["Start_time"][0])
-
-    time = numpy.linspace(start_time, total_time, nr_of_steps)
+        if lazy:
+            data = TimeSeriesH5Reader(path, '/data', time=time, logger=logger)
+        else:
+            data = h5_file['/data'][()]
+            logger.info("Actual Data shape: " + str(data.shape))
 
     h5_file.close()
     return time, data
 
 
+# Storage profiles of the TS datasets written by write_ts, write_ts_epi and write_ts_seeg_epi:
+# time-major chunks of about chunk_size bytes, spanning all channels and state variables of several time steps,
+# so that reading a time window touches only its chunks, compressed with gzip (readable by any HDF5 library)
+# or lz4 (faster, requires the hdf5plugin module), after shuffling the bytes of the values,
+# and optionally downcast to float32. "contiguous" is the uncompressed layout of the previous versions.
+TS_STORAGE_PROFILES = {"contiguous": {},
+                       "gzip": {"chunk_size": 2 ** 18, "compression": "gzip", "compression_opts": 1,
+                                "shuffle": True},
+                       "gzip_float32": {"chunk_size": 2 ** 18, "compression": "gzip", "compression_opts": 1,
+                                        "shuffle": True, "dtype": "float32"},
+                       "lz4": {"chunk_size": 2 ** 18, "compression": "lz4", "shuffle": True},
+                       "lz4_float32": {"chunk_size": 2 ** 18, "compression": "lz4", "shuffle": True,
+                                       "dtype": "float32"}}
+
+
+def _ts_storage_options(storage_profile, shape, dtype, logger=logger):
+    # The create_dataset options of a TS of this shape and dtype, for a storage profile name or dict
+    if storage_profile is None:
+        storage_profile = TS_STORAGE_PROFILE
+    if isinstance(storage_profile, basestring):
+        if storage_profile not in TS_STORAGE_PROFILES:
+            raise_value_error("Invalid TS storage profile " + storage_profile + "! Expected one of " +
+                              str(TS_STORAGE_PROFILES.keys()), logger)
+        storage_profile = TS_STORAGE_PROFILES[storage_profile]
+    dtype = numpy.dtype(storage_profile.get("dtype", dtype))
+    options = {"dtype": dtype}
+    chunk_size = storage_profile.get("chunk_size", None)
+    if chunk_size is not None and shape[0] > 0:
+        chunk_length = max(1, chunk_size // (numpy.prod(shape[1:]) * dtype.itemsize))
+        options["chunks"] = (min(chunk_length, shape[0]),) + tuple(shape[1:])
+    compression = storage_profile.get("compression", None)
+    if compression == "lz4":
+        if hdf5plugin is None:
+            warning("\nNo hdf5plugin module found! TS will be compressed with gzip instead of lz4.")
+            options.update({"compression": "gzip", "compression_opts": 1})
+        else:
+            options.update(hdf5plugin.LZ4())
+    elif compression is not None:
+        options["compression"] = compression
+        if storage_profile.get("compression_opts", None) is not None:
+            options["compression_opts"] = storage_profile["compression_opts"]
+    if storage_profile.get("shuffle", False):
+        options["shuffle"] = True
+    return options
+
+
+def _write_ts_dataset(h5_file, name, data, sampling_period, n_sv, storage_profile=None, logger=logger):
+    # Write a TS dataset with its metadata, block by block of whole chunks of about 1 MB, computing the extrema
+    # of each block, as it is stored (i.e., after any downcasting), while it is still in the cache,
+    # instead of in separate passes over the whole data.
+    dataset = h5_file.create_dataset(name, shape=data.shape,
+                                     **_ts_storage_options(storage_profile, data.shape, data.dtype, logger))
+    step_size = max(1, numpy.prod(data.shape[1:]) * dataset.dtype.itemsize)
+    block_length = max(1, 2 ** 20 // step_size)
+    if dataset.chunks is not None:
+        block_length = dataset.chunks[0] * max(1, block_length // dataset.chunks[0])
+    max_value = -numpy.inf
+    min_value = numpy.inf
+    for i_block in range(0, data.shape[0], block_length):
+        block = numpy.asarray(data[i_block:i_block + block_length], dtype=dataset.dtype)
+        dataset[i_block:i_block + block.shape[0]] = block
+        max_value = max(max_value, block.max())
+        min_value = min(min_value, block.min())
+    write_metadata({KEY_MAX: max_value, KEY_MIN: min_value,
+                    KEY_STEPS: data.shape[0], KEY_CHANNELS: data.shape[1], KEY_SV: n_sv,
+                    KEY_SAMPLING: sampling_period, KEY_START: 0.0
+                    }, h5_file, KEY_DATE, KEY_VERSION, name)
+
+
 def write_ts(raw_data, sampling_period, folder=os.path.join(PATIENT_VIRTUAL_HEAD, "ep"), filename="ts_from_python.h5",
-             logger=logger):
+             storage_profile=None, logger=logger):
 
     path, overwrite = change_filename_or_overwrite(os.path.join(folder, filename))
     # if os.path.exists(path):
@@ -288,22 +369,13 @@ def write_ts(raw_data, sampling_period, folder=os.path.join(PATIENT_VIRTUAL_HEAD
     if isinstance(raw_data, dict):
         for data in raw_data:
             if len(raw_data[data].shape) == 2 and str(raw_data[data].dtype)[0] == "f":
-                h5_file.create_dataset("/" + data, data=raw_data[data])
-                write_metadata({KEY_MAX: raw_data[data].max(), KEY_MIN: raw_data[data].min(),
-                                KEY_STEPS: raw_data[data].shape[0], KEY_CHANNELS: raw_data[data].shape[1],
-                                KEY_SV: 1,
-                                KEY_SAMPLING: sampling_period, KEY_START: 0.0
-                                }, h5_file, KEY_DATE, KEY_VERSION, "/" + data)
+                _write_ts_dataset(h5_file, "/" + data, raw_data[data], sampling_period, 1, storage_profile, logger)
             else:
                 raise_value_error("Invalid TS data. 2D (time, nodes) numpy.ndarray of floats expected")
 
     elif isinstance(raw_data, numpy.ndarray):
         if len(raw_data.shape) != 2 and str(raw_data.dtype)[0] != "f":
-            h5_file.create_dataset("/data", data=raw_data)
-            write_metadata({KEY_MAX: raw_data.max(), KEY_MIN: raw_data.min(),
-                            KEY_STEPS: raw_data.shape[0], KEY_CHANNELS: raw_data.shape[1], KEY_SV: 1,
-                            KEY_SAMPLING: sampling_period, KEY_START: 0.0
-                            }, h5_file, KEY_DATE, KEY_VERSION, "/data")
+            _write_ts_dataset(h5_file, "/data", raw_data, sampling_period, 1, storage_profile, logger)
         else:
             raise_value_error("Invalid TS data. 2D (time, nodes) numpy.ndarray of floats expected")
 
@@ -313,30 +385,33 @@ def write_ts(raw_data, sampling_period, folder=os.path.join(PATIENT_VIRTUAL_HEAD
     h5_file.close()
 
 
-def read_ts_epi(path=os.path.join(PATIENT_VIRTUAL_HEAD, "ep", "ts.h5"),
+def read_ts_epi(path=os.path.join(PATIENT_VIRTUAL_HEAD, "ep", "ts.h5"), lazy=False,
                 logger=logger):
     """
     :param path: Path towards a valid TimeSeries H5 file
+    :param lazy: If True, return a TimeSeriesH5Reader handle, which reads only the slices that are indexed,
+                 instead of loading the whole dataset
     :return: Timeseries in a numpy array
     """
     logger.info("Reading TimeSeries from:\n" + path)
+    if lazy:
+        return TimeSeriesH5Reader(path, '/data', logger=logger)
+
     h5_file = h5py.File(path, 'r', libver='latest')
 
     print_metadata(h5_file, logger)
     logger.info("Structures:\n" + str(h5_file["/"].keys()))
     logger.info("Values expected shape: " + str(h5_file['/data'].shape))
-    h5_file['/data']
 
     data = h5_file['/data'][()]
     logger.info("Actual Data shape: " + str(data.shape))
-    logger.info("First Channel sv sum: " +  str(numpy.sum(data[:, 0, :], axis=1)))
 
     h5_file.close()
     return data
 
 
 def write_ts_epi(raw_data, sampling_period, lfp_data=None, folder=os.path.join(PATIENT_VIRTUAL_HEAD, "ep"),
-                 filename="ts_from_python.h5", logger=logger):
+                 filename="ts_from_python.h5", storage_profile=None, logger=logger):
 
     path, overwrite = change_filename_or_overwrite(folder, filename)
     # if os.path.exists(path):
@@ -365,23 +440,14 @@ def write_ts_epi(raw_data, sampling_period, lfp_data=None, folder=os.path.join(P
             warning("\nFile to overwrite not found!")
 
     h5_file = h5py.File(path, 'a', libver='latest')
-    h5_file.create_dataset("/data", data=raw_data)
-    h5_file.create_dataset("/lfpdata", data=lfp_data)
-
     write_metadata({KEY_TYPE: "TimeSeries"}, h5_file, KEY_DATE, KEY_VERSION)
-    write_metadata({KEY_MAX: raw_data.max(), KEY_MIN: raw_data.min(),
-                    KEY_STEPS: raw_data.shape[0], KEY_CHANNELS: raw_data.shape[1], KEY_SV: raw_data.shape[2],
-                    KEY_SAMPLING: sampling_period, KEY_START: 0.0
-                    }, h5_file, KEY_DATE, KEY_VERSION, "/data")
-    write_metadata({KEY_MAX: lfp_data.max(), KEY_MIN: lfp_data.min(),
-                    KEY_STEPS: lfp_data.shape[0], KEY_CHANNELS: lfp_data.shape[1], KEY_SV: 1,
-                    KEY_SAMPLING: sampling_period, KEY_START: 0.0
-                    }, h5_file, KEY_DATE, KEY_VERSION, "/lfpdata")
+    _write_ts_dataset(h5_file, "/data", raw_data, sampling_period, raw_data.shape[2], storage_profile, logger)
+    _write_ts_dataset(h5_file, "/lfpdata", lfp_data, sampling_period, 1, storage_profile, logger)
     h5_file.close()
 
 
 def write_ts_seeg_epi(seeg_data, sampling_period, folder=os.path.join(PATIENT_VIRTUAL_HEAD, "ep"),
-                 filename="ts_from_python.h5", logger=logger):
+                 filename="ts_from_python.h5", storage_profile=None, logger=logger):
 
     path = os.path.join(folder, filename)
     if not os.path.exists(path):
@@ -393,17 +459,278 @@ def write_ts_seeg_epi(seeg_data, sampling_period, folder=os.path.join(PATIENT_VI
 
     try:
         h5_file = h5py.File(path, 'a', libver='latest')
-        h5_file.create_dataset("/" + sensors_name, data=seeg_data)
-
-        write_metadata({KEY_MAX: seeg_data.max(), KEY_MIN: seeg_data.min(),
-                        KEY_STEPS: seeg_data.shape[0], KEY_CHANNELS: seeg_data.shape[1], KEY_SV: 1,
-                        KEY_SAMPLING: sampling_period, KEY_START: 0.0
-                        }, h5_file, KEY_DATE, KEY_VERSION, "/" + sensors_name)
+        _write_ts_dataset(h5_file, "/" + sensors_name, seeg_data, sampling_period, 1, storage_profile, logger)
         h5_file.close()
     except Exception, e:
         raise_error(e + "\nSeeg dataset already written as " + sensors_name, logger)
 
 
+def _write_h5_group(h5_group, values):
+    # dicts to groups, tuples and lists to groups with an "EPI_Sequence" attribute and "0", "1", ... keys,
+    # and numpy arrays, numbers and strings to datasets. None values are skipped.
+    for key, value in values.iteritems():
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            _write_h5_group(h5_group.create_group(key), value)
+        elif isinstance(value, (tuple, list)):
+            group = h5_group.create_group(key)
+            group.attrs["EPI_Sequence"] = len(value)
+            _write_h5_group(group, dict([(str(i), item) for i, item in enumerate(value)]))
+        else:
+            h5_group.create_dataset(key, data=value)
+
+
+def _read_h5_group(h5_group):
+    values = {}
+    for key, item in h5_group.iteritems():
+        if isinstance(item, h5py.Group):
+            values[key] = _read_h5_group(item)
+            if "EPI_Sequence" in item.attrs:
+                values[key] = tuple([values[key].get(str(i), None) for i in range(item.attrs["EPI_Sequence"])])
+        else:
+            values[key] = item[()]
+    return values
+
+
+def write_simulation_checkpoint(checkpoint, path, logger=logger):
+    """
+    :param checkpoint: a (nested) dict of numpy arrays, numbers, strings and tuples, with the state of a simulation
+    :param path: Path of the H5 file, which is replaced atomically, i.e., the checkpoint is written to a temporary
+                 file first, so that a failure while writing it leaves the previous checkpoint intact
+    """
+    logger.info("Writing a simulation checkpoint to:\n" + path)
+    temp_path = path + ".tmp"
+    h5_file = h5py.File(temp_path, 'w', libver='latest')
+    try:
+        write_metadata({KEY_TYPE: "SimulationCheckpoint"}, h5_file, KEY_DATE, KEY_VERSION)
+        _write_h5_group(h5_file, checkpoint)
+    finally:
+        h5_file.close()
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+
+def read_simulation_checkpoint(path, logger=logger):
+    """
+    :param path: Path towards a simulation checkpoint H5 file, written by write_simulation_checkpoint
+    :return: the checkpoint dict
+    """
+    logger.info("Reading a simulation checkpoint from:\n" + path)
+    h5_file = h5py.File(path, 'r', libver='latest')
+    try:
+        return _read_h5_group(h5_file)
+    finally:
+        h5_file.close()
+
+
+class TimeSeriesH5Writer(object):
+
+    # A sink for simulators, which appends blocks of monitor samples, of shape (time, sv, regions, modes),
+    # to chunked, resizable "/time" and "/data" datasets of an H5 file while the simulation is running,
+    # so that only one block is held in memory and the samples written so far survive a crash.
+    # "/data" has the (time, regions, sv) layout of write_ts_epi, for the first mode of the monitor.
+    # With resume=True, samples are appended to an existing file, and those that are not later than its last time
+    # point (e.g., when restarting a simulation from a previous state) are skipped.
+
+    def __init__(self, path, sampling_period, resume=False, chunk_size=2**20, logger=logger):
+        self.path = path
+        self.sampling_period = sampling_period
+        self.chunk_size = chunk_size
+        self.logger = logger
+        if os.path.exists(path) and not resume:
+            os.remove(path)
+        self.logger.info("Streaming a TS to:\n" + path)
+        self.h5_file = h5py.File(path, 'a', libver='latest')
+        if "/data" in self.h5_file:
+            self.n_samples = self.h5_file["/data"].shape[0]
+            self.max_value = self.h5_file["/data"].attrs.get(KEY_MAX, -numpy.inf)
+            self.min_value = self.h5_file["/data"].attrs.get(KEY_MIN, numpy.inf)
+            self.logger.info("Resuming after " + str(self.n_samples) + " time steps")
+        else:
+            self.n_samples = 0
+            self.max_value = -numpy.inf
+            self.min_value = numpy.inf
+            write_metadata({KEY_TYPE: "TimeSeries"}, self.h5_file, KEY_DATE, KEY_VERSION)
+
+    @property
+    def last_time(self):
+        if self.n_samples > 0:
+            return self.h5_file["/time"][self.n_samples - 1]
+        else:
+            return -numpy.inf
+
+    def _create_datasets(self, sample_shape, dtype, time_dtype):
+        # Chunks of about chunk_size bytes, spanning all regions and state variables of several time steps
+        chunk_length = max(1, self.chunk_size // (numpy.prod(sample_shape) * numpy.dtype(dtype).itemsize))
+        self.h5_file.create_dataset("/data", shape=(0,) + sample_shape, maxshape=(None,) + sample_shape,
+                                    chunks=(chunk_length,) + sample_shape, dtype=dtype)
+        self.h5_file.create_dataset("/time", shape=(0,), maxshape=(None,), chunks=(max(chunk_length, 1024),),
+                                    dtype=time_dtype)
+
+    def append(self, time, data):
+        time = numpy.array(time).flatten()
+        if time.size == 0:
+            return
+        data = numpy.array(data)
+        if data.ndim != 4 or data.shape[0] != time.size:
+            raise_value_error("Invalid TS block. 4D (time, sv, regions, modes) numpy.ndarray expected, "
+                              "with as many time points as the time block", self.logger)
+        new_samples = time > self.last_time
+        if not numpy.all(new_samples):
+            time = time[new_samples]
+            data = data[new_samples]
+        if time.size == 0:
+            return
+        data = numpy.swapaxes(data[:, :, :, 0], 1, 2)
+        if "/data" not in self.h5_file:
+            self._create_datasets(data.shape[1:], data.dtype, time.dtype)
+        n_samples = self.n_samples + time.size
+        self.h5_file["/time"].resize((n_samples,))
+        self.h5_file["/time"][self.n_samples:] = time
+        self.h5_file["/data"].resize((n_samples,) + data.shape[1:])
+        self.h5_file["/data"][self.n_samples:] = data
+        self.n_samples = n_samples
+        self.max_value = max(self.max_value, data.max())
+        self.min_value = min(self.min_value, data.min())
+
+    def flush(self):
+        if "/data" in self.h5_file:
+            data = self.h5_file["/data"]
+            write_metadata({KEY_MAX: self.max_value, KEY_MIN: self.min_value,
+                            KEY_STEPS: data.shape[0], KEY_CHANNELS: data.shape[1], KEY_SV: data.shape[2],
+                            KEY_SAMPLING: self.sampling_period, KEY_START: self.h5_file["/time"][0]
+                            }, self.h5_file, KEY_DATE, KEY_VERSION, "/data")
+        self.h5_file.flush()
+
+    def close(self):
+        if self.h5_file:
+            self.flush()
+            self.h5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TimeSeriesH5Reader(object):
+
+    # A lazy handle of a time series dataset of an H5 file, of shape (time, channels, ...), which is kept open
+    # until it is closed, and reads only the slices that are indexed (as for an h5py dataset), or the time windows
+    # and channels asked for by window and iter_chunks, so that recordings larger than the memory can be processed.
+    # The time points are those of a "/time" dataset (e.g., written by TimeSeriesH5Writer), if any,
+    # or are computed from the Start_time and Sampling_period metadata of the dataset.
+
+    def __init__(self, path, dataset="/data", time=None, logger=logger):
+        self.path = path
+        self.logger = logger
+        self.h5_file = h5py.File(path, 'r', libver='latest')
+        if dataset not in self.h5_file:
+            self.h5_file.close()
+            raise_value_error("No " + dataset + " dataset in TS file " + path + "!", logger)
+        self.data = self.h5_file[dataset]
+        self.n_steps = int(self._metadata(KEY_STEPS, self.data.shape[0]))
+        self.start_time = float(self._metadata(KEY_START, 0.0))
+        self.sampling_period = self._metadata(KEY_SAMPLING, None)
+        self._time = time
+
+    def _metadata(self, key, default):
+        # Attributes are written either as scalars or as arrays of one element (e.g., by episense)
+        value = self.data.attrs.get(key, None)
+        if value is None:
+            return default
+        return numpy.array(value).flatten()[0]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def time(self):
+        if self._time is None:
+            if "/time" in self.h5_file and self.h5_file["/time"].shape[0] == self.data.shape[0]:
+                self._time = self.h5_file["/time"][()]
+            elif self.sampling_period is not None:
+                self._time = self.start_time + self.sampling_period * numpy.arange(self.data.shape[0])
+            else:
+                self._time = numpy.arange(self.data.shape[0], dtype="float64")
+        return self._time
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def _time_indices(self, start_time=None, end_time=None):
+        if start_time is None:
+            i_start = 0
+        else:
+            i_start = int(numpy.searchsorted(self.time, start_time, side="left"))
+        if end_time is None:
+            i_end = self.data.shape[0]
+        else:
+            i_end = int(numpy.searchsorted(self.time, end_time, side="right"))
+        return i_start, max(i_start, i_end)
+
+    def _read(self, i_start, i_end, channels=None):
+        if channels is None:
+            return self.data[i_start:i_end]
+        elif isinstance(channels, slice):
+            return self.data[i_start:i_end, channels]
+        else:
+            # h5py reads only increasing channel indices, which are reordered as asked for afterwards:
+            channels, order = numpy.unique(numpy.array(channels, dtype="i").flatten(), return_inverse=True)
+            return self.data[i_start:i_end, channels.tolist()][:, order]
+
+    def window(self, start_time=None, end_time=None, channels=None):
+        """
+        :param start_time, end_time: Limits (included) of the time window, or None for the start or end of the TS
+        :param channels: Indices or slice of the channels to be read, or None for all of them
+        :return: the time points and the data of the time window
+        """
+        i_start, i_end = self._time_indices(start_time, end_time)
+        return self.time[i_start:i_end], self._read(i_start, i_end, channels)
+
+    def iter_chunks(self, chunk_length=None, start_time=None, end_time=None, channels=None):
+        """
+        :param chunk_length: Number of time points of each chunk, by default the chunk length of the dataset,
+                             if it is chunked, or about 1 MB otherwise
+        :return: a generator of the time points and the data of consecutive chunks of the time window
+        """
+        if chunk_length is None:
+            if self.data.chunks is not None:
+                chunk_length = self.data.chunks[0]
+            else:
+                chunk_length = 2 ** 20 // max(1, numpy.prod(self.data.shape[1:]) * self.data.dtype.itemsize)
+        chunk_length = max(1, int(chunk_length))
+        i_start, i_end = self._time_indices(start_time, end_time)
+        for i_chunk in range(i_start, i_end, chunk_length):
+            i_chunk_end = min(i_chunk + chunk_length, i_end)
+            yield self.time[i_chunk:i_chunk_end], self._read(i_chunk, i_chunk_end, channels)
+
+    def close(self):
+        if self.h5_file:
+            self.h5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 if __name__ == "__main__":
     read_epileptogenicity()
     read_ts()
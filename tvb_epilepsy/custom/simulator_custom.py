@@ -127,9 +127,8 @@ class SimulatorCustom(ABCSimulator):
 
         json_model = self.prepare_epileptor_model_for_json(self.connectivity.number_of_regions)
 
-        # TODO: history length has to be computed given the time delays (i.e., the tract lengts...)
-        # history_length = ...
-        initial_conditions = self.prepare_initial_conditions(history_length=1)
+        # The history length is computed given the time delays (i.e., the tract lengths...)
+        initial_conditions = self.prepare_initial_conditions()
 
         self.custom_config = FullConfiguration(connectivity_path=os.path.abspath(self.connectivity.file_path),
                                                epileptor_paramses=json_model, settings=ep_settings,
@@ -193,8 +192,7 @@ class SimulatorCustom(ABCSimulator):
             self.initial_conditions = initial_conditions
 
         else:
-            # TODO: have a function to calculate the correct history length when we have time delays
-            self.initial_conditions = self.prepare_initial_conditions(history_length=1)
+            self.initial_conditions = self.prepare_initial_conditions()
 
 
 # Some helper functions for model and simulator construction
@@ -3,13 +3,16 @@
 Service to do LSA computation.
 """
 import numpy
+from scipy.sparse import issparse
+from scipy.sparse.linalg import eigs
 
 from tvb_epilepsy.base.constants import X1_EQ_CR_DEF, EIGENVECTORS_NUMBER_SELECTION, WEIGHTED_EIGENVECTOR_SUM, \
                                         FIG_FORMAT,  SAVE_FLAG, SHOW_FLAG
 from tvb_epilepsy.base.configurations import FOLDER_FIGURES
 from tvb_epilepsy.base.utils import warning, raise_value_error, initialize_logger, formal_repr, \
-                                    weighted_vector_sum,curve_elbow_point
-from tvb_epilepsy.base.computations.calculations_utils import calc_fz_jac_square_taylor
+                                    weighted_vector_sum,curve_elbow_point, curve_elbow_points, ensure_list
+from tvb_epilepsy.base.computations.calculations_utils import calc_fz_jac_square_taylor, \
+                                                              calc_fz_jac_square_taylor_batch
 from tvb_epilepsy.base.computations.equilibrium_computation import calc_eq_z
 from tvb_epilepsy.base.h5_model import convert_to_h5_model
 from tvb_epilepsy.base.model.disease_hypothesis import DiseaseHypothesis
@@ -59,27 +62,34 @@ class LSAService(object):
     def get_curve_elbow_point(self, values_array):
         return curve_elbow_point(values_array)
 
-    def _ensure_eigen_vectors_number(self, eigen_values, e_values, x0_values, disease_indices):
-        if self.eigen_vectors_number is None:
-            if self.eigen_vectors_number_selection is "auto_eigenvals":
-                self.eigen_vectors_number = self.get_curve_elbow_point(numpy.abs(eigen_values)) + 1
+    def get_curve_elbow_points(self, values_arrays):
+        return curve_elbow_points(values_arrays)
 
-            elif self.eigen_vectors_number_selection is "auto_disease":
-                self.eigen_vectors_number = len(disease_indices)
+    def _compute_eigen_vectors_number(self, eigen_values, e_values, x0_values, disease_indices):
+        if self.eigen_vectors_number_selection is "auto_eigenvals":
+            return self.get_curve_elbow_point(numpy.abs(eigen_values)) + 1
 
-            elif self.eigen_vectors_number_selection is "auto_epileptogenicity":
-                self.eigen_vectors_number = self.get_curve_elbow_point(e_values) + 1
+        elif self.eigen_vectors_number_selection is "auto_disease":
+            return len(disease_indices)
 
-            elif self.eigen_vectors_number_selection is "auto_excitability":
-                self.eigen_vectors_number = self.get_curve_elbow_point(x0_values) + 1
+        elif self.eigen_vectors_number_selection is "auto_epileptogenicity":
+            return self.get_curve_elbow_point(e_values) + 1
 
-            else:
-                raise_value_error("\n" + self.eigen_vectors_number_selection +
-                                 "is not a valid option when for automatic computation of self.eigen_vectors_number")
+        elif self.eigen_vectors_number_selection is "auto_excitability":
+            return self.get_curve_elbow_point(x0_values) + 1
+
+        else:
+            raise_value_error("\n" + self.eigen_vectors_number_selection +
+                             "is not a valid option when for automatic computation of self.eigen_vectors_number")
+
+    def _ensure_eigen_vectors_number(self, eigen_values, e_values, x0_values, disease_indices):
+        if self.eigen_vectors_number is None:
+            self.eigen_vectors_number = self._compute_eigen_vectors_number(eigen_values, e_values, x0_values,
+                                                                           disease_indices)
         else:
             self.eigen_vectors_number_selection = "user_defined"
 
-    def _compute_jacobian(self, model_configuration):
+    def _ensure_subcritical_equilibria(self, model_configuration):
 
         # Check if any of the equilibria are in the supercritical regime (beyond the separatrix) and set it right before
         # the bifurcation.
@@ -98,26 +108,74 @@ class LSAService(object):
                                   model_configuration.a*i_temp[temp], model_configuration.b*i_temp[temp],
                                   model_configuration.d*i_temp[temp])
 
+    def _compute_jacobian(self, model_configuration):
+
+        self._ensure_subcritical_equilibria(model_configuration)
+
         fz_jacobian = calc_fz_jac_square_taylor(model_configuration.zEQ, model_configuration.yc,
                                                 model_configuration.Iext1, model_configuration.K,
                                                 model_configuration.connectivity_matrix,
                                                 model_configuration.a, model_configuration.b, model_configuration.d)
 
-        if numpy.any([numpy.any(numpy.isnan(fz_jacobian.flatten())), numpy.any(numpy.isinf(fz_jacobian.flatten()))]):
+        if issparse(fz_jacobian):
+            values = fz_jacobian.data
+        else:
+            values = fz_jacobian.flatten()
+        if numpy.any([numpy.any(numpy.isnan(values)), numpy.any(numpy.isinf(values))]):
             raise_value_error("nan or inf values in dfz")
 
         return fz_jacobian
 
+    def _sparse_eigen_decomposition(self, jacobian, disease_hypothesis, model_configuration):
+        # For a sparse Jacobian (of a sparse connectivity), only the first eigen_vectors_number eigenvectors,
+        # i.e., those of the eigenvalues of smallest real part, are computed with a sparse (ARPACK) eigen-solver.
+        # For an automatic eigen_vectors_number from the elbow of the eigenvalues, the number of computed eigenvalues
+        # is doubled until the elbow is found before the last few of them.
+        # It returns None when a full eigenvalue decomposition is necessary.
+        # The eigen_vectors_number is only computed here, and left to run_lsa() to be stored to the service.
+        n_regions = jacobian.shape[0]
+        eigen_vectors_number = self.eigen_vectors_number
+        if eigen_vectors_number is None and self.eigen_vectors_number_selection != "auto_eigenvals":
+            eigen_vectors_number = self._compute_eigen_vectors_number(None, model_configuration.e_values,
+                                                                      model_configuration.x0_values,
+                                                                      disease_hypothesis.get_all_disease_indices())
+        if eigen_vectors_number is not None:
+            n_eigen = max(eigen_vectors_number, 1)
+        else:
+            n_eigen = max(n_regions / 10, 10)
+        while n_eigen < n_regions - 1:
+            eigen_values, eigen_vectors = eigs(jacobian, k=n_eigen, which="SR")
+            if numpy.all(eigen_values.imag == 0.0):
+                eigen_values = eigen_values.real
+                eigen_vectors = eigen_vectors.real
+            sorted_indices = numpy.argsort(eigen_values, kind='mergesort')
+            eigen_values = eigen_values[sorted_indices]
+            if eigen_vectors_number is not None or \
+                    self.get_curve_elbow_point(numpy.abs(eigen_values)) < n_eigen - 3:
+                return eigen_values, eigen_vectors[:, sorted_indices]
+            n_eigen *= 2
+        return None
+
     def run_lsa(self, disease_hypothesis, model_configuration):
 
         jacobian = self._compute_jacobian(model_configuration)
 
-        # Perform eigenvalue decomposition
-        eigen_values, eigen_vectors = numpy.linalg.eig(jacobian)
+        eigen_decomposition = None
+        if issparse(jacobian):
+            eigen_decomposition = self._sparse_eigen_decomposition(jacobian, disease_hypothesis, model_configuration)
+            if eigen_decomposition is None:
+                jacobian = jacobian.toarray()
 
-        sorted_indices = numpy.argsort(eigen_values, kind='mergesort')
-        self.eigen_values = eigen_values[sorted_indices]
-        self.eigen_vectors = eigen_vectors[:, sorted_indices]
+        if eigen_decomposition is None:
+            # Perform eigenvalue decomposition
+            eigen_values, eigen_vectors = numpy.linalg.eig(jacobian)
+
+            sorted_indices = numpy.argsort(eigen_values, kind='mergesort')
+            self.eigen_values = eigen_values[sorted_indices]
+            self.eigen_vectors = eigen_vectors[:, sorted_indices]
+
+        else:
+            self.eigen_values, self.eigen_vectors = eigen_decomposition
 
         self._ensure_eigen_vectors_number(self.eigen_values, model_configuration.e_values,
                                           model_configuration.x0_values, disease_hypothesis.get_all_disease_indices())
@@ -153,6 +211,132 @@ class LSAService(object):
                                  {tuple(disease_hypothesis.w_indices): disease_hypothesis.w_values},
                                  propagation_indices, lsa_propagation_strength, "LSA_" + disease_hypothesis.name)
 
+    def _compute_jacobians(self, model_configurations):
+
+        for model_configuration in model_configurations:
+            self._ensure_subcritical_equilibria(model_configuration)
+
+        n_regions = model_configurations[0].zEQ.size
+        stack_params = lambda name: numpy.array([getattr(model_configuration, name) * numpy.ones((n_regions,))
+                                                 for model_configuration in model_configurations])
+
+        # Avoid stacking copies of the connectivity when it is common to all model configurations.
+        # The stacked Jacobians are dense, and so is any sparse connectivity for them:
+        dense = lambda w: w.toarray() if issparse(w) else w
+        connectivity_matrix = model_configurations[0].connectivity_matrix
+        if not(numpy.all([model_configuration.connectivity_matrix is connectivity_matrix
+                          for model_configuration in model_configurations])):
+            connectivity_matrix = numpy.array([dense(model_configuration.connectivity_matrix)
+                                               for model_configuration in model_configurations])
+        else:
+            connectivity_matrix = dense(connectivity_matrix)
+
+        fz_jacobians = calc_fz_jac_square_taylor_batch(stack_params("zEQ"), stack_params("yc"), stack_params("Iext1"),
+                                                       stack_params("K"), connectivity_matrix)
+
+        if numpy.any([numpy.any(numpy.isnan(fz_jacobians)), numpy.any(numpy.isinf(fz_jacobians))]):
+            raise_value_error("nan or inf values in dfz")
+
+        return fz_jacobians
+
+    def _ensure_eigen_vectors_numbers(self, eigen_values, disease_hypotheses, model_configurations):
+        n_batch = eigen_values.shape[0]
+
+        if self.eigen_vectors_number is not None:
+            return self.eigen_vectors_number * numpy.ones((n_batch,), dtype="i")
+
+        elif self.eigen_vectors_number_selection is "auto_eigenvals":
+            return self.get_curve_elbow_points(numpy.abs(eigen_values)) + 1
+
+        elif self.eigen_vectors_number_selection is "auto_disease":
+            return numpy.array([len(disease_hypothesis.get_all_disease_indices())
+                                for disease_hypothesis in disease_hypotheses])
+
+        elif self.eigen_vectors_number_selection is "auto_epileptogenicity":
+            return self.get_curve_elbow_points(numpy.array([model_configuration.e_values.flatten()
+                                                            for model_configuration in model_configurations])) + 1
+
+        elif self.eigen_vectors_number_selection is "auto_excitability":
+            return self.get_curve_elbow_points(numpy.array([model_configuration.x0_values.flatten()
+                                                            for model_configuration in model_configurations])) + 1
+
+        else:
+            raise_value_error("\n" + self.eigen_vectors_number_selection +
+                              "is not a valid option when for automatic computation of self.eigen_vectors_number")
+
+    def run_lsa_batch(self, disease_hypotheses, model_configurations, batch_size=None):
+        # Vectorized equivalent of run_lsa() for many pairs of disease hypotheses and model configurations,
+        # which decomposes the stacked (batch_size, n_regions, n_regions) Jacobians of each batch together.
+        # Unlike run_lsa(), the eigen values and vectors, as well as any automatically computed eigen_vectors_number,
+        # are not stored in the service.
+        # A single disease hypothesis can be given to be used for all model configurations.
+
+        model_configurations = ensure_list(model_configurations)
+        n_configurations = len(model_configurations)
+        if isinstance(disease_hypotheses, DiseaseHypothesis):
+            disease_hypotheses = [disease_hypotheses] * n_configurations
+        elif len(disease_hypotheses) != n_configurations:
+            raise_value_error("The number of disease hypotheses (" + str(len(disease_hypotheses)) + ") is not equal to "
+                              "the number of model configurations (" + str(n_configurations) + ")!")
+
+        if batch_size is None:
+            batch_size = n_configurations
+        batch_size = max(int(batch_size), 1)
+
+        lsa_hypotheses = []
+        for i_batch in range(0, n_configurations, batch_size):
+            lsa_hypotheses += self._run_lsa_batch(disease_hypotheses[i_batch:i_batch + batch_size],
+                                                  model_configurations[i_batch:i_batch + batch_size])
+
+        return lsa_hypotheses
+
+    def _run_lsa_batch(self, disease_hypotheses, model_configurations):
+
+        jacobians = self._compute_jacobians(model_configurations)
+        n_batch, n_regions = jacobians.shape[:2]
+
+        # Perform a stacked eigenvalue decomposition
+        eigen_values, eigen_vectors = numpy.linalg.eig(jacobians)
+
+        sorted_indices = numpy.argsort(eigen_values, axis=1, kind='mergesort')
+        batch_indices = numpy.arange(n_batch)[:, numpy.newaxis]
+        eigen_values = eigen_values[batch_indices, sorted_indices]
+        eigen_vectors = eigen_vectors[batch_indices, :, sorted_indices].transpose(0, 2, 1)
+
+        eigen_vectors_numbers = self._ensure_eigen_vectors_numbers(eigen_values, disease_hypotheses,
+                                                                   model_configurations)
+
+        # Calculate the propagation strength index by summing the first n eigenvectors (minimum 1),
+        # or all of them, without weighting, when n is equal to the number of regions
+        all_eigen_vectors = eigen_vectors_numbers == n_regions
+        eigen_vectors_mask = numpy.arange(n_regions)[numpy.newaxis, :] < \
+                             numpy.maximum(eigen_vectors_numbers, 1)[:, numpy.newaxis]
+        weights = eigen_vectors_mask.astype(eigen_values.dtype)
+        if self.weighted_eigenvector_sum:
+            weighted = numpy.logical_not(all_eigen_vectors)
+            weights[weighted] *= eigen_values[weighted]
+            weights[weighted] /= numpy.sum(weights[weighted], axis=1, keepdims=True)
+        lsa_propagation_strengths = numpy.abs(numpy.einsum("bk,bnk->bn", weights, eigen_vectors))
+
+        if self.normalize_propagation_strength:
+            # Normalize by the maximum
+            lsa_propagation_strengths /= numpy.max(lsa_propagation_strengths, axis=1, keepdims=True)
+
+        propagation_strength_elbows = self.get_curve_elbow_points(lsa_propagation_strengths)
+
+        lsa_hypotheses = []
+        for disease_hypothesis, lsa_propagation_strength, propagation_strength_elbow in \
+                zip(disease_hypotheses, lsa_propagation_strengths, propagation_strength_elbows):
+            propagation_indices = lsa_propagation_strength.argsort()[-propagation_strength_elbow:]
+            lsa_hypotheses.append(
+                DiseaseHypothesis(disease_hypothesis.number_of_regions,
+                                  {tuple(disease_hypothesis.x0_indices): disease_hypothesis.x0_values},
+                                  {tuple(disease_hypothesis.e_indices): disease_hypothesis.e_values},
+                                  {tuple(disease_hypothesis.w_indices): disease_hypothesis.w_values},
+                                  propagation_indices, lsa_propagation_strength, "LSA_" + disease_hypothesis.name))
+
+        return lsa_hypotheses
+
     def plot_lsa(self, disease_hypothesis, model_configuration, region_labels=[],
                  pse_results=None, title="Hypothesis Overview",
                  figure_dir=FOLDER_FIGURES, figure_format=FIG_FORMAT,
@@ -4,6 +4,7 @@ Service to do X0/e_values Hypothesis configuration.
 """
 import numpy
 from matplotlib import pyplot
+from scipy.sparse import issparse
 
 from tvb_epilepsy.base.constants import X1_EQ_CR_DEF, E_DEF, X0_DEF, K_DEF, YC_DEF, I_EXT1_DEF, I_EXT2_DEF, A_DEF, \
                                         B_DEF, D_DEF, SLOPE_DEF, S_DEF, GAMMA_DEF, X1_DEF, X0_CR_DEF, FIG_SIZE, \
@@ -16,6 +17,7 @@ from tvb_epilepsy.base.computations.calculations_utils import calc_x0cr_r, calc_
                                                               calc_fx1_2d_taylor, calc_fz, calc_x0_val__to_model_x0, \
                                                               calc_model_x0_to_x0_val
 from tvb_epilepsy.base.computations.equilibrium_computation import calc_eq_z, eq_x1_hypo_x0_linTaylor, \
+                                                                  eq_x1_hypo_x0_linTaylor_batch, \
                                                                   eq_x1_hypo_x0_optimize, def_x1lin, calc_eq_y1
 from tvb_epilepsy.base.plot_utils import save_figure, check_show
 
@@ -42,7 +44,7 @@ class ModelConfigurationService(object):
 
     def __init__(self, number_of_regions, x0_values=X0_DEF, e_values=E_DEF, yc=YC_DEF, Iext1=I_EXT1_DEF,
                  Iext2=I_EXT2_DEF, K=K_DEF, a=A_DEF, b=B_DEF, d=D_DEF, slope=SLOPE_DEF, s=S_DEF, gamma=GAMMA_DEF,
-                 zmode=numpy.array("lin"), x1eq_mode="optimize"):
+                 zmode=numpy.array("lin"), x1eq_mode="optimize", x1eq_continuation=False):
         self.number_of_regions = number_of_regions
         self.x0_values = x0_values * numpy.ones((self.number_of_regions,), dtype=numpy.float32)
         self.yc = yc
@@ -56,6 +58,10 @@ class ModelConfigurationService(object):
         self.gamma = gamma
         self.zmode = zmode
         self.x1eq_mode = x1eq_mode
+        # If x1eq_continuation is True, the optimization of the x1 equilibria starts from the previous solution,
+        # which is kept in a mutable dictionary, so that it is shared among the loops of a pse (see pse_service):
+        self.x1eq_continuation = x1eq_continuation
+        self.x1eq_previous = {}
         if len(ensure_list(K)) == 1:
             self.K_unscaled = numpy.array(K) * numpy.ones((self.number_of_regions,), dtype=numpy.float32)
         elif len(ensure_list(K)) == self.number_of_regions:
@@ -87,7 +93,8 @@ class ModelConfigurationService(object):
              "14. slope": self.slope,
              "15. gamma": self.gamma,
              "16. zmode": self.zmode,
-             "07. x1eq_mode": self.x1eq_mode
+             "17. x1eq_mode": self.x1eq_mode,
+             "18. x1eq_continuation": self.x1eq_continuation
              }
         return formal_repr(self, d)
 
@@ -161,14 +168,40 @@ class ModelConfigurationService(object):
                 eq_x1_hypo_x0_linTaylor(x0_indices, e_indices, x1EQ, zEQ, x0, self.K,
                                         connectivity_matrix, self.yc, self.Iext1, self.a, self.b, self.d)[0]
         else:
-            x1EQ = \
+            x1EQ, x0_e = \
                 eq_x1_hypo_x0_optimize(x0_indices, e_indices, x1EQ, zEQ, x0, self.K,
-                                       connectivity_matrix, self.yc, self.Iext1, self.a, self.b, self.d)[0]
+                                       connectivity_matrix, self.yc, self.Iext1, self.a, self.b, self.d,
+                                       xinit=self._get_x1eq_init(x0_indices, e_indices))
+            if self.x1eq_continuation:
+                model_x0 = numpy.empty(x1EQ.shape, dtype=x1EQ.dtype)
+                model_x0[x0_indices] = x0
+                model_x0[e_indices] = x0_e
+                self.x1eq_previous.update({"x1EQ": numpy.array(x1EQ), "x0": model_x0})
         return x1EQ
 
+    def _get_x1eq_init(self, x0_indices, e_indices):
+        # Continuation: the initial guess of the optimization is the previous solution,
+        # i.e., x1 equilibria for the x0 hypothesis' regions and model x0 values for the e hypothesis' regions.
+        if not(self.x1eq_continuation) or len(self.x1eq_previous) == 0 \
+                or self.x1eq_previous["x1EQ"].size != self.number_of_regions:
+            return None
+        xinit = numpy.array(self.x1eq_previous["x1EQ"])
+        xinit[e_indices] = self.x1eq_previous["x0"][e_indices]
+        return xinit
+
+    def reset_x1eq_continuation(self):
+        self.x1eq_previous.clear()
+
     def _normalize_global_coupling(self):
         self.K = self.K_unscaled / self.number_of_regions
 
+    def _apply_connectivity_disease(self, disease_hypothesis, connectivity_matrix):
+        if issparse(connectivity_matrix):
+            # A scipy.sparse connectivity cannot be scaled in place elementwise (* is a matrix product for them)
+            return connectivity_matrix.multiply(disease_hypothesis.get_connectivity_disease()).tocsr()
+        connectivity_matrix *= disease_hypothesis.get_connectivity_disease()
+        return connectivity_matrix
+
     def configure_model_from_equilibrium(self, x1EQ, zEQ, connectivity_matrix):
         # x1EQ, zEQ = self._ensure_equilibrum(x1EQ, zEQ) # We don't this by default anymore
         x0, Ceq, x0_values, e_values = self._compute_params_after_equilibration(x1EQ, zEQ, connectivity_matrix)
@@ -183,7 +216,7 @@ class ModelConfigurationService(object):
 
         # Then apply connectivity disease hypothesis scaling if any:
         if len(disease_hypothesis.w_indices) > 0:
-            connectivity_matrix *= disease_hypothesis.get_connectivity_disease()
+            connectivity_matrix = self._apply_connectivity_disease(disease_hypothesis, connectivity_matrix)
 
         # All nodes except for the diseased ones will get the default epileptogenicity:
         e_values = numpy.array(self.e_values)
@@ -200,8 +233,18 @@ class ModelConfigurationService(object):
 
         # Then apply connectivity disease hypothesis scaling if any:
         if len(disease_hypothesis.w_indices) > 0:
-            connectivity_matrix *= disease_hypothesis.get_connectivity_disease()
+            connectivity_matrix = self._apply_connectivity_disease(disease_hypothesis, connectivity_matrix)
+
+        x0_values, x1EQ_temp, zEQ_temp = self._compute_hypothesis_x0_values_and_equilibria(disease_hypothesis)
+
+        # Now, solve the system in order to compute equilibrium:
+        x1EQ = self._compute_x1_equilibrium(disease_hypothesis.e_indices, x1EQ_temp, zEQ_temp, x0_values,
+                                            connectivity_matrix)
+        zEQ = self._compute_z_equilibrium(x1EQ)
+
+        return self.configure_model_from_equilibrium(x1EQ, zEQ, connectivity_matrix)
 
+    def _compute_hypothesis_x0_values_and_equilibria(self, disease_hypothesis):
         # We assume that all nodes have the default (healthy) excitability:
         x0_values = numpy.array(self.x0_values)
         # ...and some  excitability-diseased ones:
@@ -218,12 +261,42 @@ class ModelConfigurationService(object):
         # Compute equilibrium from epileptogenicity:
         x1EQ_temp, zEQ_temp = self._compute_x1_and_z_equilibrium_from_E(e_values)
 
-        # Now, solve the system in order to compute equilibrium:
-        x1EQ = self._compute_x1_equilibrium(disease_hypothesis.e_indices, x1EQ_temp, zEQ_temp, x0_values,
-                                            connectivity_matrix)
-        zEQ = self._compute_z_equilibrium(x1EQ)
+        return x0_values, x1EQ_temp, zEQ_temp
+
+    def configure_models_from_hypotheses(self, disease_hypotheses, connectivity_matrix):
+        # Equivalent to configure_model_from_hypothesis() for each one of many disease hypotheses.
+        # For x1eq_mode = "linTaylor", hypotheses without connectivity disease and with the same epileptogenicity
+        # regions share the matrix of the linear system for the x1 equilibria (see eq_x1_hypo_x0_linTaylor_batch).
+        # Then, all of them are solved together, with multiple right hand sides, on a single LU factorization.
+        disease_hypotheses = ensure_list(disease_hypotheses)
+        e_indices = list(disease_hypotheses[0].e_indices)
+        if self.x1eq_mode != "linTaylor" or \
+                not(numpy.all([len(disease_hypothesis.w_indices) == 0 and
+                               list(disease_hypothesis.e_indices) == e_indices
+                               for disease_hypothesis in disease_hypotheses])):
+            # Each hypothesis gets a copy of the connectivity, in order to apply any connectivity disease on it:
+            return [self.configure_model_from_hypothesis(disease_hypothesis, connectivity_matrix.copy())
+                    for disease_hypothesis in disease_hypotheses]
 
-        return self.configure_model_from_equilibrium(x1EQ, zEQ, connectivity_matrix)
+        # Always normalize K first
+        self._normalize_global_coupling()
+        self._compute_critical_x0_scaling()
+
+        x0 = []
+        x1EQ_temp = []
+        zEQ_temp = []
+        for disease_hypothesis in disease_hypotheses:
+            x0_values, x1EQ, zEQ = self._compute_hypothesis_x0_values_and_equilibria(disease_hypothesis)
+            x0.append(self._compute_model_x0(x0_values))
+            x1EQ_temp.append(x1EQ)
+            zEQ_temp.append(zEQ)
+
+        x0_indices = numpy.delete(numpy.array(range(connectivity_matrix.shape[0])), e_indices)
+        x1EQs = eq_x1_hypo_x0_linTaylor_batch(x0_indices, e_indices, numpy.array(x1EQ_temp), numpy.array(zEQ_temp),
+                                              numpy.array(x0), self.K, connectivity_matrix, self.yc, self.Iext1)[0]
+
+        return [self.configure_model_from_equilibrium(x1EQ, self._compute_z_equilibrium(x1EQ), connectivity_matrix)
+                for x1EQ in x1EQs]
 
     def plot_nullclines_eq(self, model_config, region_labels, special_idx, model, zmode, figure_name,
                            show_flag=SHOW_FLAG, save_flag=SAVE_FLAG,
@@ -2,15 +2,17 @@
 Mechanism for parameter search exploration for LSA and simulations (it will have TVB or custom implementations)
 """
 
-from copy import deepcopy
+from copy import copy, deepcopy
+from inspect import getargspec
+from multiprocessing import Pool, cpu_count
+from operator import attrgetter
 
 import numpy as np
 from tvb_epilepsy.service.epileptor_model_factory import model_build_dict
 from tvb_epilepsy.service.model_configuration_service import ModelConfigurationService
 
 from tvb_epilepsy.base.constants import EIGENVECTORS_NUMBER_SELECTION, K_DEF, YC_DEF, I_EXT1_DEF, A_DEF, B_DEF
-from tvb_epilepsy.base.utils import warning, raise_not_implemented_error, raise_value_error, initialize_logger, \
-                                   formal_repr
+from tvb_epilepsy.base.utils import warning, raise_value_error, initialize_logger, formal_repr
 from tvb_epilepsy.base.h5_model import convert_to_h5_model
 from tvb_epilepsy.base.model.disease_hypothesis import DiseaseHypothesis
 from tvb_epilepsy.base.model.model_configuration import ModelConfiguration
@@ -18,12 +20,99 @@ from tvb_epilepsy.base.simulators import ABCSimulator
 from tvb_epilepsy.custom.read_write import read_ts
 from tvb_epilepsy.custom.simulator_custom import custom_model_builder
 from tvb_epilepsy.service.lsa_service import LSAService
-from tvb_epilepsy.tvb_api.simulator_tvb import SimulatorTVB
+from tvb_epilepsy.tvb_api.simulator_tvb import SimulatorTVB, SimulatorTVBBatch
 
 logger = initialize_logger(__name__)
 
 
+class AttributePath(object):
+    # A parameter's path, e.g., "hypothesis.x0_values", together with the parameter's indices, resolved once:
+    # the path is split, its getattr chain is compiled and the indices are validated and converted to a linear index,
+    # so that only direct attribute/array reads and writes are left for each pse loop.
+
+    def __init__(self, path, indices=[]):
+        self.path = str(path)
+        self.names = self.path.split(".")
+        self.head = self.names[0]
+        self.attribute = self.names[-1]
+        if len(self.names) > 1:
+            self._get_parent = attrgetter(".".join(self.names[:-1]))
+        else:
+            self._get_parent = lambda object: object
+        self.indices = self._validate_indices(indices)
+        self._tail = None
+
+    def _validate_indices(self, indices):
+        if indices is None:
+            return np.array([], dtype="i")
+        indices = np.array(indices).flatten()
+        if indices.size == 0:
+            return indices.astype("i")
+        if indices.dtype.kind not in "iu":
+            if indices.dtype.kind != "f" or np.any(np.round(indices) != indices):
+                raise_value_error("Indices " + str(indices) + " of parameter " + self.path + " are not integers!")
+            indices = indices.astype("i")
+        if np.any(indices < 0):
+            raise_value_error("Indices " + str(indices) + " of parameter " + self.path + " are not all >= 0!")
+        return indices
+
+    def __reduce__(self):
+        # attrgetter objects cannot be pickled, e.g., for multiprocessing, so rebuild from the path and indices
+        return (AttributePath, (self.path, self.indices))
+
+    def __repr__(self):
+        return "AttributePath(" + self.path + str(self.indices.tolist()) + ")"
+
+    def __str__(self):
+        return self.path
+
+    @property
+    def tail(self):
+        # The same path and indices, without the first attribute, relative to the object of the first attribute
+        if self._tail is None:
+            if len(self.names) < 2:
+                raise_value_error("Parameter path " + self.path + " has no attributes below " + self.head + "!")
+            self._tail = AttributePath(".".join(self.names[1:]), self.indices)
+        return self._tail
+
+    def get_parent(self, object):
+        return self._get_parent(object)
+
+    def get(self, object):
+        value = getattr(self._get_parent(object), self.attribute)
+        if self.indices.size > 0:
+            return value[self.indices]
+        else:
+            return value
+
+    def set(self, object, values):
+        parent = self._get_parent(object)
+        if self.indices.size > 0:
+            # index has to be linear... i.e., 1D...
+            getattr(parent, self.attribute)[self.indices] = values
+        else:
+            setattr(parent, self.attribute, values)
+
+    def validate(self, object):
+        # Check once, before any pse loop, that the path exists for this object and that the indices are in range
+        try:
+            value = getattr(self._get_parent(object), self.attribute)
+        except AttributeError:
+            raise_value_error("Parameter path " + self.path + " does not exist in " + object.__class__.__name__ + "!")
+        if self.indices.size > 0 and np.max(self.indices) >= np.size(value):
+            raise_value_error("Indices " + str(self.indices) + " of parameter " + self.path + " are out of range "
+                              "for a value of size " + str(np.size(value)) + "!")
+
+
+def compile_attribute_paths(params_paths, params_indices):
+    return [AttributePath(path, indices) for path, indices in zip(params_paths, params_indices)]
+
+
 def set_object_attribute_recursively(object, path, values, indices):
+    if isinstance(path, AttributePath):
+        path.set(object, values)
+        return
+
     # Convert the parameter's path to a list of strings separated by "."
     path = path.split(".")
 
@@ -43,6 +132,19 @@ def set_object_attribute_recursively(object, path, values, indices):
 
 
 def pop_object_parameters(object_type, params_paths, params_values, params_indices):
+    if len(params_paths) > 0 and isinstance(params_paths[0], AttributePath):
+        # Compiled paths: no string parsing, just a split of the lists
+        object_params = []
+        other_params = []
+        for ip, path in enumerate(params_paths):
+            if path.head == object_type:
+                object_params.append(ip)
+            else:
+                other_params.append(ip)
+        return [params_paths[ip].tail for ip in object_params], [params_values[ip] for ip in object_params], \
+               [params_indices[ip] for ip in object_params], [params_paths[ip] for ip in other_params], \
+               [params_values[ip] for ip in other_params], [params_indices[ip] for ip in other_params]
+
     object_params_paths = []
     object_params_values = []
     object_params_indices = []
@@ -61,29 +163,89 @@ def pop_object_parameters(object_type, params_paths, params_values, params_indic
     return object_params_paths, object_params_values, object_params_indices, params_paths, params_values, params_indices
 
 
-def update_object(object, object_type, params_paths, params_values, params_indices):
+class ParametersOverlay(object):
+    # Applies parameters' values in place on an object, keeping what is needed to restore the object afterwards,
+    # so that the same (scratch) object can be reused for all loops of a pse, instead of deep copying it in every loop.
+    # Assigned values are reverted on the very arrays or objects that were modified,
+    # and a shallow snapshot of the object's attributes reverts any attribute rebinding (e.g., by an update() method),
+    # and removes any attribute added in the meantime (e.g., the simTVB of a simulator that had none before the loop).
+    # Mutations of the (not overlaid) attributes' values persist, e.g., the x1eq_previous of a model configuration
+    # service, used to continue the equilibrium of the previous loop.
+
+    def __init__(self, object):
+        self.object = object
+        self._attributes = dict(vars(object))
+        self._base_values = []
+
+    def apply(self, params_paths, params_values, params_indices):
+        for path, values, indices in zip(params_paths, params_values, params_indices):
+            if not(isinstance(path, AttributePath)):
+                path = AttributePath(path, indices)
+            parent = path.get_parent(self.object)
+            temp = getattr(parent, path.attribute)
+            if path.indices.size > 0:
+                # index has to be linear... i.e., 1D...
+                self._base_values.append((temp, None, path.indices, temp[path.indices]))
+                temp[path.indices] = values
+            else:
+                self._base_values.append((parent, path.attribute, path.indices, temp))
+                setattr(parent, path.attribute, values)
+        return self.object
+
+    def restore(self):
+        while len(self._base_values) > 0:
+            target, attribute, indices, values = self._base_values.pop()
+            if indices.size > 0:
+                target[indices] = values
+            else:
+                setattr(target, attribute, values)
+        attributes = self.object.__dict__
+        for attribute in [attribute for attribute in attributes if attribute not in self._attributes]:
+            del attributes[attribute]
+        attributes.update(self._attributes)
+
+
+def update_object(object, object_type, params_paths, params_values, params_indices, overlays=None):
     update_flag = False
     object_params_paths, object_params_values, object_params_indices, params_paths, params_values, params_indices = \
         pop_object_parameters(object_type, params_paths, params_values, params_indices)
-    for ip in range(len(object_params_paths)):
-        set_object_attribute_recursively(object, object_params_paths[ip], object_params_values[ip],
-                                         object_params_indices[ip])
-        update_flag = True
+    if overlays is None:
+        for ip in range(len(object_params_paths)):
+            set_object_attribute_recursively(object, object_params_paths[ip], object_params_values[ip],
+                                             object_params_indices[ip])
+    else:
+        overlay = ParametersOverlay(object)
+        overlays.append(overlay)
+        overlay.apply(object_params_paths, object_params_values, object_params_indices)
+    update_flag = len(object_params_paths) > 0
     return object, params_paths, params_values, params_indices, update_flag
 
 
+def restore_overlays(overlays):
+    if overlays is not None:
+        while len(overlays) > 0:
+            overlays.pop().restore()
+
+
 def update_hypothesis(hypothesis_input, connectivity_matrix, params_paths, params_values, params_indices,
                       model_configuration_service_input=None,
-                      yc=YC_DEF, Iext1=I_EXT1_DEF, K=K_DEF, a=A_DEF, b=B_DEF, x1eq_mode="optimize"):
-    # Assign possible hypothesis parameters on a new hypothesis object:
-    hypothesis = deepcopy(hypothesis_input)
+                      yc=YC_DEF, Iext1=I_EXT1_DEF, K=K_DEF, a=A_DEF, b=B_DEF, x1eq_mode="optimize", overlays=None):
+    # Assign possible hypothesis parameters on a new hypothesis object,
+    # or, if a list of overlays is given, on the input hypothesis itself, to be restored by the caller:
+    if overlays is None:
+        hypothesis = deepcopy(hypothesis_input)
+    else:
+        hypothesis = hypothesis_input
     hypothesis, params_paths, params_values, params_indices = \
-        update_object(hypothesis, "hypothesis", params_paths, params_values, params_indices)[:4]
+        update_object(hypothesis, "hypothesis", params_paths, params_values, params_indices, overlays)[:4]
     hypothesis.update(name=hypothesis.name)
 
     # ...create/update a model configuration service:
     if isinstance(model_configuration_service_input, ModelConfigurationService):
-        model_configuration_service = deepcopy(model_configuration_service_input)
+        if overlays is None:
+            model_configuration_service = deepcopy(model_configuration_service_input)
+        else:
+            model_configuration_service = model_configuration_service_input
     else:
         model_configuration_service = ModelConfigurationService(hypothesis_input.number_of_regions,
                                                                 yc=yc, Iext1=Iext1, K=K, a=a, b=b, x1eq_mode=x1eq_mode)
@@ -91,7 +253,7 @@ def update_hypothesis(hypothesis_input, connectivity_matrix, params_paths, param
     # ...modify possible related parameters:
     model_configuration_service, params_paths, params_values, params_indices = \
         update_object(model_configuration_service, "model_configuration_service", params_paths, params_values,
-                      params_indices)[:4]
+                      params_indices, overlays)[:4]
 
     # ...and compute a new model_configuration:
     if hypothesis.type == "Epileptogenicity":
@@ -106,33 +268,43 @@ def update_hypothesis(hypothesis_input, connectivity_matrix, params_paths, param
 
 def lsa_out_fun(hypothesis, model_configuration=None, **kwargs):
     if isinstance(model_configuration, ModelConfiguration):
-        return {"propagation_strengths": hypothesis.propagation_strenghts, "x0_values": model_configuration.x0_values,
+        return {"propagation_strengths": hypothesis.propagation_strengths, "x0_values": model_configuration.x0_values,
                 "e_values": model_configuration.e_values, "x1EQ": model_configuration.x1EQ,
                 "zEQ": model_configuration.zEQ, "Ceq": model_configuration.Ceq}
     else:
-        hypothesis.propagation_strenghts
+        return hypothesis.propagation_strengths
 
 
 def lsa_run_fun(hypothesis_input, connectivity_matrix, params_paths, params_values, params_indices, out_fun=lsa_out_fun,
                 model_configuration_service_input=None,
                 yc=YC_DEF, Iext1=I_EXT1_DEF, K=K_DEF, a=A_DEF, b=B_DEF, x1eq_mode="optimize",
                 lsa_service_input=None,
-                n_eigenvectors=EIGENVECTORS_NUMBER_SELECTION, weighted_eigenvector_sum=True):
+                n_eigenvectors=EIGENVECTORS_NUMBER_SELECTION, weighted_eigenvector_sum=True, copy_inputs=True):
+    # If copy_inputs is False, the input objects are modified in place and restored before returning,
+    # which is meant for scratch copies of the inputs, reused for all loops of a pse
+    if copy_inputs:
+        overlays = None
+    else:
+        overlays = []
+
     try:
         # Update hypothesis and create a new model_configuration:
         hypothesis, model_configuration, params_paths, params_values, params_indices \
             = update_hypothesis(hypothesis_input, connectivity_matrix, params_paths, params_values, params_indices,
-                                model_configuration_service_input, yc, Iext1, K, a, b, x1eq_mode)
+                                model_configuration_service_input, yc, Iext1, K, a, b, x1eq_mode, overlays)
 
         # ...create/update lsa service:
         if isinstance(lsa_service_input, LSAService):
-            lsa_service = deepcopy(lsa_service_input)
+            if copy_inputs:
+                lsa_service = deepcopy(lsa_service_input)
+            else:
+                lsa_service = lsa_service_input
         else:
             lsa_service = LSAService(n_eigenvectors=n_eigenvectors, weighted_eigenvector_sum=weighted_eigenvector_sum)
 
         # ...and modify possible related parameters:
         lsa_service = \
-            update_object(lsa_service, "lsa_service", params_paths, params_values, params_indices)[0]
+            update_object(lsa_service, "lsa_service", params_paths, params_values, params_indices, overlays)[0]
 
         # Run LSA:
         lsa_hypothesis = lsa_service.run_lsa(hypothesis, model_configuration)
@@ -148,6 +320,9 @@ def lsa_run_fun(hypothesis_input, connectivity_matrix, params_paths, params_valu
 
         return False, None
 
+    finally:
+        restore_overlays(overlays)
+
 
 def sim_out_fun(simulator, time, data, **kwargs):
     if data is None:
@@ -156,56 +331,222 @@ def sim_out_fun(simulator, time, data, **kwargs):
     return {"time": time, "data": data}
 
 
+def update_simulator(simulator_input, connectivity_matrix, params_paths, params_values, params_indices,
+                     hypothesis_input=None, model_configuration_service_input=None,
+                     yc=YC_DEF, Iext1=I_EXT1_DEF, K=K_DEF, a=A_DEF, b=B_DEF, x1eq_mode="optimize",
+                     update_initial_conditions=True, overlays=None):
+    # Assign the parameters on a new simulator object,
+    # or, if a list of overlays is given, on the input simulator itself, to be restored by the caller:
+    if overlays is None:
+        # Create new objects from the input simulator,
+        # apart from a TVB simulator, which is reconfigured below from a cached one, instead of being deep copied
+        memo = {}
+        if isinstance(simulator_input, SimulatorTVB) and hasattr(simulator_input, "simTVB"):
+            memo[id(simulator_input.simTVB)] = simulator_input.simTVB
+        simulator = deepcopy(simulator_input, memo)
+        model_configuration = simulator.model_configuration
+        model = simulator.model
+    else:
+        # The simulator's overlay is created first, in order to restore also its model and model configuration
+        overlays.append(ParametersOverlay(simulator_input))
+        simulator = simulator_input
+        model_configuration = simulator_input.model_configuration
+        model = simulator_input.model
+
+    # First try to update model_configuration via an input hypothesis...:
+    if isinstance(hypothesis_input, DiseaseHypothesis):
+        hypothesis, model_configuration, params_paths, params_values, params_indices = \
+            update_hypothesis(hypothesis_input, connectivity_matrix, params_paths, params_values, params_indices,
+                              model_configuration_service_input, yc, Iext1, K, a, b, x1eq_mode, overlays)
+        # Update model configuration:
+        simulator.model_configuration = model_configuration
+        # ...in which case a model has to be regenerated:
+        if isinstance(simulator, SimulatorTVB):
+            model = model_build_dict[model._ui_name](model_configuration, zmode=model.zmode)
+        else:
+            model = custom_model_builder(model_configuration)
+
+    # Now (further) update model if needed:
+    model, params_paths, params_values, params_indices = \
+        update_object(model, "model", params_paths, params_values, params_indices, overlays)[:4]
+    simulator.model = model
+
+    # Now, update other possible remaining parameters, i.e., concerning the integrator, noise etc...
+    if overlays is None:
+        for ip in range(len(params_paths)):
+            set_object_attribute_recursively(simulator, params_paths[ip], params_values[ip], params_indices[ip])
+    else:
+        overlays[0].apply(params_paths, params_values, params_indices)
+
+    # Now, recalculate the default initial conditions...
+    # If initial conditions were parameters, then, this flag can be set to False
+    if isinstance(simulator, SimulatorTVB):
+        # A TVB simulator is configured for the new model,
+        # from the cached one that shares its connectivity, integrator, noise and monitors
+        if update_initial_conditions or not hasattr(simulator, "simTVB"):
+            initial_conditions = None
+        else:
+            initial_conditions = simulator.simTVB.initial_conditions
+        simulator.config_simulation(initial_conditions=initial_conditions)
+    elif update_initial_conditions:
+        simulator.configure_initial_conditions()
+
+    return simulator
+
+
 def sim_run_fun(simulator_input, connectivity_matrix, params_paths, params_values, params_indices, out_fun=sim_out_fun,
                 hypothesis_input=None,
                 model_configuration_service_input=None,
                 yc=YC_DEF, Iext1=I_EXT1_DEF, K=K_DEF, a=A_DEF, b=B_DEF, x1eq_mode="optimize",
-                update_initial_conditions=True):
-    # Create new objects from the input simulator
-    simulator = deepcopy(simulator_input)
-    model_configuration = deepcopy(simulator_input.model_configuration)
-    model = deepcopy(simulator_input.model)
+                update_initial_conditions=True, copy_inputs=True):
+    # If copy_inputs is False, the input objects are modified in place and restored before returning,
+    # which is meant for scratch copies of the inputs, reused for all loops of a pse
+    if copy_inputs:
+        overlays = None
+    else:
+        overlays = []
 
     try:
 
-        # First try to update model_configuration via an input hypothesis...:
-        if isinstance(hypothesis_input, DiseaseHypothesis):
-            hypothesis, model_configuration, params_paths, params_values, params_indices = \
-                update_hypothesis(hypothesis_input, connectivity_matrix, params_paths, params_values, params_indices,
-                                  model_configuration_service_input, yc, Iext1, K, a, b, x1eq_mode)
-            # Update model configuration:
-            simulator.model_configuration = model_configuration
-            # ...in which case a model has to be regenerated:
-            if isinstance(simulator, SimulatorTVB):
-                model = model_build_dict[model._ui_name](model_configuration, zmode=model.zmode)
-            else:
-                model = custom_model_builder(model_configuration)
+        simulator = update_simulator(simulator_input, connectivity_matrix, params_paths, params_values,
+                                     params_indices, hypothesis_input, model_configuration_service_input,
+                                     yc, Iext1, K, a, b, x1eq_mode, update_initial_conditions, overlays)
 
-        # Now (further) update model if needed:
-        model, params_paths, params_values, params_indices = \
-            update_object(model, "model", params_paths, params_values, params_indices)
-        simulator.model = model
+        time, data, status = simulator.launch_simulation()
 
-        # Now, update other possible remaining parameters, i.e., concerning the integrator, noise etc...
-        for ip in range(len(params_paths)):
-            set_object_attribute_recursively(simulator, params_paths[ip], params_values[ip], params_indices[ip])
+        if status:
+            output = out_fun(simulator, time, data)
+        else:
+            output = None
+
+        return status, output
 
-        # Now, recalculate the default initial conditions...
-        # If initial conditions were parameters, then, this flag can be set to False
-        if update_initial_conditions:
-            simulator.configure_initial_conditions()
+    except:
 
-        time, data, status = simulator.launch()
+        return False, None
 
-        if status:
-            output = out_fun(time, data, simulator)
+    finally:
+        restore_overlays(overlays)
 
-        return True, output
+
+def sim_batch_inputs_fun(simulator_input, connectivity_matrix, params_paths, params_values, params_indices,
+                         hypothesis_input=None, model_configuration_service_input=None,
+                         yc=YC_DEF, Iext1=I_EXT1_DEF, K=K_DEF, a=A_DEF, b=B_DEF, x1eq_mode="optimize",
+                         update_initial_conditions=True, copy_inputs=True):
+    # Like sim_run_fun, but, instead of launching the simulation,
+    # return the updated model and initial conditions, to be simulated together with those of other samples,
+    # as well as the updated model configuration (sharing the connectivity matrix of the input one)
+    if copy_inputs:
+        overlays = None
+    else:
+        overlays = []
+
+    try:
+        simulator = update_simulator(simulator_input, connectivity_matrix, params_paths, params_values,
+                                     params_indices, hypothesis_input, model_configuration_service_input,
+                                     yc, Iext1, K, a, b, x1eq_mode, update_initial_conditions, overlays)
+        model_configuration = simulator.model_configuration
+        model_configuration = deepcopy(model_configuration, {id(model_configuration.connectivity_matrix):
+                                                                 model_configuration.connectivity_matrix})
+        return True, (deepcopy(simulator.model), np.array(simulator.simTVB.initial_conditions), model_configuration)
 
     except:
 
         return False, None
 
+    finally:
+        restore_overlays(overlays)
+
+
+def hilbert_curve_order(samples, n_bits=None):
+    # Order samples (n_samples x n_params) along a Hilbert space-filling curve, so that consecutive samples are close
+    # in parameters' space, e.g., for an equilibrium solver to start from the solution of the previous sample.
+    # Each parameter is scaled to an integer grid of 2 ** n_bits points, and the Hilbert index of each sample is
+    # computed with Skilling's transpose algorithm (J. Skilling, "Programming the Hilbert curve", 2004).
+    samples = np.array(samples, dtype="float64")
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    n_samples, n_dims = samples.shape
+    if n_samples < 3:
+        return np.arange(n_samples)
+    if n_dims == 1:
+        return np.argsort(samples[:, 0], kind="mergesort")
+    if n_bits is None:
+        n_bits = int(np.ceil(np.log2(n_samples))) + 1
+    # Scale every parameter to [0, 2 ** n_bits - 1]:
+    smin = samples.min(axis=0)
+    srange = samples.max(axis=0) - smin
+    srange[srange == 0.0] = 1.0
+    X = np.round((samples - smin) / srange * (2 ** n_bits - 1)).astype("int64").T
+    # Inverse undo excess work:
+    Q = 1 << (n_bits - 1)
+    while Q > 1:
+        P = Q - 1
+        for i in range(n_dims):
+            Q_set = (X[i] & Q) > 0
+            X[0][Q_set] ^= P
+            t = (X[0] ^ X[i]) & P
+            t[Q_set] = 0
+            X[0] ^= t
+            X[i] ^= t
+        Q >>= 1
+    # Gray encode:
+    for i in range(1, n_dims):
+        X[i] ^= X[i - 1]
+    t = np.zeros((n_samples, ), dtype="int64")
+    Q = 1 << (n_bits - 1)
+    while Q > 1:
+        t[(X[n_dims - 1] & Q) > 0] ^= Q - 1
+        Q >>= 1
+    X ^= t
+    # The Hilbert index interleaves the bits of the transposed coordinates, from the most significant ones.
+    # Sort by all interleaved bits (lexsort's last key is the primary one), to avoid integer overflow:
+    bits = [(X[i] >> bit) & 1 for bit in range(n_bits - 1, -1, -1) for i in range(n_dims)]
+    return np.lexsort(bits[::-1])
+
+
+def prepare_pse_scratch_inputs(run_fun, pse_object, kwargs):
+    # For run functions that can modify their inputs in place and restore them afterwards,
+    # make scratch copies of the pse object and of any other input objects once, to be reused for all loops:
+    if "copy_inputs" in getargspec(run_fun).args and kwargs.get("copy_inputs", None) is None:
+        pse_object = deepcopy(pse_object)
+        kwargs = dict(kwargs)
+        for key, value in kwargs.iteritems():
+            if key.endswith("_input"):
+                kwargs[key] = deepcopy(value)
+        kwargs["copy_inputs"] = False
+    return pse_object, kwargs
+
+
+def run_pse_loop(run_fun, pse_object, connectivity_matrix, params_paths, params, params_indices, out_fun, **kwargs):
+    try:
+        return run_fun(pse_object, connectivity_matrix, params_paths, params, params_indices, out_fun, **kwargs)
+    except:
+        return False, None
+
+
+# The objects common to all loops of a parallel pse are passed once to each worker process at its initialization,
+# instead of being pickled together with every chunk of parameters' values:
+_pse_worker_inputs = {}
+
+
+def _init_pse_worker(run_fun, pse_object, connectivity_matrix, params_paths, params_indices, out_fun, kwargs):
+    pse_object, kwargs = prepare_pse_scratch_inputs(run_fun, pse_object, kwargs)
+    _pse_worker_inputs.update({"run_fun": run_fun, "pse_object": pse_object,
+                               "connectivity_matrix": connectivity_matrix, "params_paths": params_paths,
+                               "params_indices": params_indices, "out_fun": out_fun, "kwargs": kwargs})
+
+
+def _run_pse_chunk(pse_params_chunk):
+    chunk_results = []
+    for params in pse_params_chunk:
+        chunk_results.append(run_pse_loop(_pse_worker_inputs["run_fun"], _pse_worker_inputs["pse_object"],
+                                          _pse_worker_inputs["connectivity_matrix"],
+                                          _pse_worker_inputs["params_paths"], params,
+                                          _pse_worker_inputs["params_indices"], _pse_worker_inputs["out_fun"],
+                                          **_pse_worker_inputs["kwargs"]))
+    return chunk_results
+
 
 class PSEService(object):
     def __init__(self, task, hypothesis=[], simulator=[], params_pse=None, run_fun=None, out_fun=None):
@@ -220,6 +561,7 @@ class PSEService(object):
         self.params_paths = []
         self.n_params_vals = []
         self.params_indices = []
+        self.params_attribute_paths = []
         self.n_loops = 0
 
         if task == "LSA":
@@ -288,6 +630,8 @@ class PSEService(object):
                 self.n_params_vals = self.n_params_vals[0]
 
             self.pse_params = np.vstack(temp).T
+            # Resolve all parameters' paths and indices once, for all loops:
+            self.params_attribute_paths = compile_attribute_paths(self.params_paths, self.params_indices)
             self.params_paths = np.array(self.params_paths)
             self.params_indices = np.array(self.params_indices)
             self.n_loops = self.pse_params.shape[0]
@@ -327,46 +671,181 @@ class PSEService(object):
         h5_model = self._prepare_for_h5()
         h5_model.write_to_h5(folder, filename)
 
-    def run_pse(self, connectivity_matrix, grid_mode=False, **kwargs):
+    def _validate_params_paths(self, pse_object, kwargs):
+        # Validate the compiled parameters' paths and indices against the input objects of the default run functions,
+        # so that wrong paths fail once, before any loop, instead of failing every single loop:
+        if self.run_fun not in (lsa_run_fun, sim_run_fun):
+            return
+        for path in self.params_attribute_paths:
+            if len(path.names) > 1 and self.task == "LSA" and path.head == "hypothesis":
+                path.tail.validate(pse_object)
+            elif len(path.names) > 1 and self.task == "SIMULATION" and path.head == "model":
+                path.tail.validate(pse_object.model)
+            elif len(path.names) > 1 and kwargs.get(path.head + "_input", None) is not None:
+                path.tail.validate(kwargs[path.head + "_input"])
+            elif self.task == "SIMULATION" and hasattr(pse_object, path.head):
+                path.validate(pse_object)
+
+    def _run_fun_params_paths(self):
+        # The compiled parameters' paths are meant for the default run functions only,
+        # whereas user defined run functions get the parameters' paths as strings:
+        if self.run_fun in (lsa_run_fun, sim_run_fun):
+            return self.params_attribute_paths
+        else:
+            return self.params_paths
+
+    def _loops_order(self, samples_order=None):
+        # The order of execution of the loops, e.g., along a space-filling curve, so that consecutive loops have
+        # neighbouring parameters' values, which makes continuation (e.g., x1eq_continuation) effective.
+        # Results are always returned in the original order of the samples.
+        if samples_order is None:
+            return np.arange(self.n_loops)
+        elif samples_order == "hilbert":
+            return hilbert_curve_order(self.pse_params)
+        else:
+            raise_value_error("\nsamples_order = " + str(samples_order) + " is not a valid pse samples' order!" +
+                              "\nSelect one of None or 'hilbert'")
 
-        results = []
-        execution_status = []
+    def run_pse(self, connectivity_matrix, grid_mode=False, samples_order=None, **kwargs):
+
+        results = [None] * self.n_loops
+        execution_status = [False] * self.n_loops
+
+        self._validate_params_paths(self.pse_object, kwargs)
+        pse_object, kwargs = prepare_pse_scratch_inputs(self.run_fun, self.pse_object, kwargs)
 
         loop_tenth = 1
-        for iloop in range(self.n_loops):
+        for iorder, iloop in enumerate(self._loops_order(samples_order)):
 
             params = self.pse_params[iloop, :]
 
-            if iloop == 0 or iloop + 1 >= loop_tenth * self.n_loops / 10.0:
-                print "\nExecuting loop " + str(iloop + 1) + " of " + str(self.n_loops)
-                if iloop > 0:
+            if iorder == 0 or iorder + 1 >= loop_tenth * self.n_loops / 10.0:
+                print "\nExecuting loop " + str(iorder + 1) + " of " + str(self.n_loops)
+                if iorder > 0:
                     loop_tenth += 1
             # print "\nParameters:"
             # for ii in range(len(params)):
             #      print self.params_paths[ii] + "[" + str(self.params_indices[ii]) + "] = " + str(params[ii])
 
-            status = False
-            output = None
+            status, output = run_pse_loop(self.run_fun, pse_object, connectivity_matrix,
+                                          self._run_fun_params_paths(), params, self.params_indices, self.out_fun,
+                                          **kwargs)
 
-            try:
-                status, output = self.run_fun(self.pse_object, connectivity_matrix,
-                                              self.params_paths, params, self.params_indices, self.out_fun, **kwargs)
+            if not status:
+                warning("\nExecution of loop " + str(iloop) + " failed!")
 
-            except:
-                pass
+            results[iloop] = output
+            execution_status[iloop] = status
+
+        return self._reshape_pse_results(results, execution_status, grid_mode)
+
+    def run_pse_parallel(self, connectivity_matrix, grid_mode=False, n_processes=None, chunk_size=None,
+                         samples_order=None, **kwargs):
+
+        if n_processes is None:
+            n_processes = cpu_count()
+        n_processes = int(max(min(n_processes, self.n_loops), 1))
+
+        # Split the pse_params rows in contiguous chunks, several per process, for load balancing:
+        if chunk_size is None:
+            chunk_size = int(np.ceil(self.n_loops / (4.0 * n_processes)))
+        chunk_size = int(max(chunk_size, 1))
+        # (if samples_order is given, each chunk is a contiguous part of the ordered loops)
+        loops_order = self._loops_order(samples_order)
+        chunks = [self.pse_params[loops_order[iorder:iorder + chunk_size]]
+                  for iorder in range(0, self.n_loops, chunk_size)]
+
+        print "\nExecuting " + str(self.n_loops) + " loops in " + str(len(chunks)) + " chunks of up to " + \
+              str(chunk_size) + " loops, on " + str(n_processes) + " processes"
+
+        self._validate_params_paths(self.pse_object, kwargs)
+
+        pool = Pool(processes=n_processes, initializer=_init_pse_worker,
+                    initargs=(self.run_fun, self.pse_object, connectivity_matrix, self._run_fun_params_paths(),
+                              self.params_indices, self.out_fun, kwargs))
+        try:
+            # imap returns the chunks' results in the order of the chunks:
+            results = [None] * self.n_loops
+            execution_status = [False] * self.n_loops
+            for ichunk, chunk_results in enumerate(pool.imap(_run_pse_chunk, chunks)):
+                for iorder, (status, output) in enumerate(chunk_results):
+                    iloop = loops_order[ichunk * chunk_size + iorder]
+                    if not status:
+                        warning("\nExecution of loop " + str(iloop) + " failed!")
+                    results[iloop] = output
+                    execution_status[iloop] = status
+                print "\nExecuted chunk " + str(ichunk + 1) + " of " + str(len(chunks))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        return self._reshape_pse_results(results, execution_status, grid_mode)
+
+    def run_pse_batch(self, connectivity_matrix, grid_mode=False, batch_size=None, **kwargs):
+        # For a simulation pse of a SimulatorTVB, whose parameters concern only the model (or the hypothesis):
+        # the model and initial conditions of every loop are prepared first, without running any simulation,
+        # and then the models of batch_size loops at a time are simulated all together by a SimulatorTVBBatch,
+        # which integrates their stacked states with one vectorized Heun step.
+
+        if self.task != "SIMULATION" or self.run_fun is not sim_run_fun or \
+                not isinstance(self.pse_object, SimulatorTVB):
+            raise_value_error("\nBatch pse is possible only for the default simulation pse of a SimulatorTVB!")
+        for path in self.params_attribute_paths:
+            if path.head not in ["model", "hypothesis"]:
+                raise_value_error("\nBatch pse is possible only for model or hypothesis parameters, not for " +
+                                  path.path + "!")
+
+        if batch_size is None:
+            batch_size = self.n_loops
+        batch_size = int(max(batch_size, 1))
+
+        results = [None] * self.n_loops
+        execution_status = [False] * self.n_loops
+
+        self._validate_params_paths(self.pse_object, kwargs)
+        pse_object, kwargs = prepare_pse_scratch_inputs(sim_batch_inputs_fun, self.pse_object, kwargs)
+
+        for ibatch in range(0, self.n_loops, batch_size):
+
+            print "\nExecuting loops " + str(ibatch + 1) + " to " + str(min(ibatch + batch_size, self.n_loops)) + \
+                  " of " + str(self.n_loops)
+
+            loops, models, initial_conditions, model_configurations = [], [], [], []
+            for iloop in range(ibatch, min(ibatch + batch_size, self.n_loops)):
+                status, output = sim_batch_inputs_fun(pse_object, connectivity_matrix, self.params_attribute_paths,
+                                                      self.pse_params[iloop, :], self.params_indices, **kwargs)
+                if status:
+                    loops.append(iloop)
+                    models.append(output[0])
+                    initial_conditions.append(output[1])
+                    model_configurations.append(output[2])
+                else:
+                    warning("\nExecution of loop " + str(iloop) + " failed!")
+
+            if len(loops) == 0:
+                continue
+
+            time, data, status = SimulatorTVBBatch(pse_object, models, initial_conditions).launch_simulation()
 
             if not status:
-                warning("\nExecution of loop " + str(iloop) + " failed!")
+                warning("\nExecution of loops " + str(loops) + " failed!")
+                continue
+
+            # out_fun gets, for every loop, a shallow copy of the simulator, with its model and model configuration
+            for iloop, model, model_configuration, loop_data in zip(loops, models, model_configurations, data):
+                simulator = copy(pse_object)
+                simulator.model = model
+                simulator.model_configuration = model_configuration
+                results[iloop] = self.out_fun(simulator, time, loop_data)
+                execution_status[iloop] = True
 
-            results.append(output)
-            execution_status.append(status)
+        return self._reshape_pse_results(results, execution_status, grid_mode)
 
+    def _reshape_pse_results(self, results, execution_status, grid_mode=False):
         if grid_mode:
             results = np.reshape(np.array(results, dtype="O"), tuple(self.n_params_vals))
             execution_status = np.reshape(np.array(execution_status), tuple(self.n_params_vals))
-
         return results, execution_status
-
-    def run_pse_parallel(self, connectivity_matrix, grid_mode=False):
-        # TODO: start each loop on a separate process, gather results and return them
-        raise_not_implemented_error
@@ -4,6 +4,8 @@ import os
 
 import shutil
 
+import numpy
+
 here = os.path.dirname(os.path.abspath(__file__))
 temporary_folder = 'temp'
 
@@ -14,5 +16,15 @@ def get_temporary_files_path(*args):
     return file_path
 
 
+def get_random_connectivity_matrix(n_regions, random_state=None):
+    # A random symmetric connectivity matrix, without self-connections
+    if random_state is None:
+        random_state = numpy.random.RandomState(0)
+    connectivity_matrix = random_state.uniform(0.0, 1.0, (n_regions, n_regions))
+    connectivity_matrix = (connectivity_matrix + connectivity_matrix.T) / 2.0
+    connectivity_matrix[numpy.diag_indices(n_regions)] = 0.0
+    return connectivity_matrix
+
+
 def remove_temporary_test_files():
     shutil.rmtree(temporary_folder)
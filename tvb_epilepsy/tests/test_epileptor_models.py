@@ -0,0 +1,64 @@
+import numpy
+from tvb_epilepsy.tvb_api import epileptor_models
+from tvb_epilepsy.tvb_api.epileptor_models import EpileptorDP, EpileptorDPrealistic, EpileptorDP2D
+
+
+class TestEpileptorModels():
+    n_regions = 20
+
+    def test_dfun_fused(self):
+        random_state = numpy.random.RandomState(0)
+        shape = (self.n_regions, 1)
+        fused_dfun_flag = epileptor_models.FUSED_DFUN_FLAG
+        try:
+            for model_class, n_vars, iz in [(EpileptorDP, 6, 2), (EpileptorDPrealistic, 11, 2), (EpileptorDP2D, 2, 1)]:
+                for zmode in ["lin", "sig"]:
+                    model = model_class(zmode=numpy.array(zmode),
+                                        x0=random_state.uniform(-2.5, -2.0, shape),
+                                        K=random_state.uniform(0.0, 10.0, shape))
+                    model.configure()
+                    # Both branches of the piecewise terms, including negative z:
+                    state_variables = random_state.uniform(-1.5, 1.0, (n_vars,) + shape)
+                    state_variables[iz] = random_state.uniform(-0.5, 4.0, shape)
+                    coupling = random_state.normal(0.0, 0.1, (2,) + shape)
+
+                    epileptor_models.FUSED_DFUN_FLAG = False
+                    dfun = model.dfun(state_variables, coupling)
+                    epileptor_models.FUSED_DFUN_FLAG = True
+                    ydot = numpy.empty_like(state_variables)
+
+                    assert model.dfun_fused(state_variables, coupling, ydot=ydot) is ydot
+                    assert numpy.allclose(ydot, dfun, rtol=1e-12, atol=1e-12)
+        finally:
+            epileptor_models.FUSED_DFUN_FLAG = fused_dfun_flag
+
+    def test_jacobian(self):
+        random_state = numpy.random.RandomState(1)
+        shape = (self.n_regions, 1)
+        eps = 1e-6
+        for model_class, n_vars, iz, pmodes in [(EpileptorDP, 6, 2, [None]),
+                                                (EpileptorDPrealistic, 11, 2, ["const", "g", "z", "z*g"]),
+                                                (EpileptorDP2D, 2, 1, [None])]:
+            for zmode in ["lin", "sig"]:
+                for pmode in pmodes:
+                    kwargs = {"zmode": numpy.array(zmode),
+                              "x0": random_state.uniform(-2.5, -2.0, shape),
+                              "K": random_state.uniform(0.0, 10.0, shape)}
+                    if pmode is not None:
+                        kwargs["pmode"] = numpy.array(pmode)
+                    model = model_class(**kwargs)
+                    model.configure()
+                    state_variables = random_state.uniform(-1.5, 1.0, (n_vars,) + shape)
+                    state_variables[iz] = random_state.uniform(-0.5, 4.0, shape)
+                    coupling = random_state.normal(0.0, 0.1, (2,) + shape)
+                    local_coupling = 0.1
+
+                    jacobian = model.jacobian(state_variables, coupling, local_coupling)
+                    assert jacobian.shape == (n_vars, n_vars) + shape
+                    # Central finite differences of the dfun, with the coupling kept fixed:
+                    for j in range(n_vars):
+                        dy = numpy.zeros(state_variables.shape)
+                        dy[j] = eps
+                        dfun_diff = (model.dfun(state_variables + dy, coupling, local_coupling) -
+                                     model.dfun(state_variables - dy, coupling, local_coupling)) / (2 * eps)
+                        assert numpy.allclose(jacobian[:, j], dfun_diff, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,32 @@
+import numpy
+from tvb_epilepsy.base.constants import A_DEF, B_DEF, D_DEF, SLOPE_DEF
+from tvb_epilepsy.base.computations.equilibrium_computation import X1EqOptimizeParameters, \
+    eq_x1_hypo_x0_optimize_fun, eq_x1_hypo_x0_optimize_jac
+from tvb_epilepsy.tests.base import get_random_connectivity_matrix
+
+
+class TestEquilibriumComputation():
+    n_regions = 20
+
+    def test_x1eq_optimize_parameters(self):
+        random_state = numpy.random.RandomState(0)
+        w = get_random_connectivity_matrix(self.n_regions, random_state)
+        K = random_state.uniform(0.01, 0.1, self.n_regions)
+        yc = numpy.ones(self.n_regions)
+        Iext1 = 3.1 * numpy.ones(self.n_regions)
+        ix0 = numpy.arange(3, self.n_regions)
+        iE = numpy.arange(3)
+        x1EQ = random_state.uniform(-1.8, -1.5, self.n_regions)
+        zEQ = random_state.uniform(3.0, 3.2, self.n_regions)
+        x0 = random_state.uniform(-2.5, -2.0, len(ix0))
+        x = random_state.uniform(-1.8, -1.5, self.n_regions)
+        parameters = [numpy.ones(self.n_regions) * p for p in [A_DEF, B_DEF, D_DEF, SLOPE_DEF]]
+
+        x1eq_optimize_parameters = X1EqOptimizeParameters(ix0, iE, x1EQ, zEQ, x0, K, w, yc, Iext1, *parameters)
+
+        fun = eq_x1_hypo_x0_optimize_fun(x, ix0, iE, numpy.array(x1EQ), numpy.array(zEQ), x0, K, w, yc, Iext1,
+                                         *parameters)
+        jac = eq_x1_hypo_x0_optimize_jac(x, ix0, iE, numpy.array(x1EQ), numpy.array(zEQ), x0, K, w, yc, Iext1,
+                                         *parameters)
+        assert numpy.allclose(x1eq_optimize_parameters.fun(x), fun)
+        assert numpy.allclose(x1eq_optimize_parameters.jac(x), jac)
@@ -1,6 +1,8 @@
 import os
+from collections import OrderedDict
 from copy import deepcopy
-from tvb_epilepsy.base.h5_model import read_h5_model
+import numpy
+from tvb_epilepsy.base.h5_model import convert_to_h5_model, read_h5_model, H5DatasetProxy
 from tvb_epilepsy.base.model.disease_hypothesis import DiseaseHypothesis
 from tvb_epilepsy.base.utils import assert_equal_objects
 from tvb_epilepsy.tests.base import get_temporary_files_path, remove_temporary_test_files
@@ -48,6 +50,58 @@ class TestHypothesis():
             children_dict=hypothesis_template)
         assert_equal_objects(lsa_hypothesis, lsa_hypothesis2)
 
+    def test_h5_lazy_conversion(self):
+        lsa_hypothesis = DiseaseHypothesis(76, excitability_hypothesis={tuple([20, 30]): [0.9, 0.8]},
+                                           epileptogenicity_hypothesis={}, connectivity_hypothesis={},
+                                           propagation_indices=[0], propagation_strenghts=[18])
+
+        folder = get_temporary_files_path()
+        file_name = "hypo_lazy.h5"
+
+        lsa_hypothesis.write_to_h5(folder, file_name)
+        lsa_hypothesis1 = read_h5_model(os.path.join(folder, file_name)).convert_from_h5_model(
+            obj=deepcopy(lsa_hypothesis))
+
+        with read_h5_model(os.path.join(folder, file_name), lazy=True) as h5_model:
+            assert h5_model.metadata_dict["name"] == lsa_hypothesis.name
+            x0_values = h5_model.datasets_dict["/x0_values"]
+            assert isinstance(x0_values, H5DatasetProxy) and x0_values.shape == (76,)
+            assert numpy.array_equal(x0_values[20:31:10], [0.9, 0.8])
+
+            lsa_hypothesis2 = h5_model.convert_from_h5_model(obj=deepcopy(lsa_hypothesis))
+            assert isinstance(lsa_hypothesis2.x0_values, H5DatasetProxy)
+            assert numpy.array_equal(numpy.array(lsa_hypothesis2.x0_values), lsa_hypothesis1.x0_values)
+            assert lsa_hypothesis2.x0_indices == lsa_hypothesis1.x0_indices
+
+        try:
+            x0_values.read()
+            assert False
+        except ValueError:
+            pass
+
+    def test_h5_nested_conversion(self):
+        lsa_hypothesis = DiseaseHypothesis(76, excitability_hypothesis={tuple([20]): [0.9]},
+                                           epileptogenicity_hypothesis={}, connectivity_hypothesis={})
+        results = {"results": [{"x0_values": numpy.array([0.1 * i, 0.2]), "n": i, "hypothesis": lsa_hypothesis}
+                               for i in range(3)]}
+
+        folder = get_temporary_files_path()
+        file_name = "hypo_results.h5"
+
+        convert_to_h5_model(results).write_to_h5(folder, file_name)
+        results1 = read_h5_model(os.path.join(folder, file_name)).convert_from_h5_model(
+            obj=OrderedDict(), children_dict={"list": list(), "DiseaseHypothesis": DiseaseHypothesis(76)})
+
+        assert len(results1["results"]) == 3
+        for i, result in enumerate(results1["results"]):
+            assert result["n"] == i
+            assert numpy.array_equal(result["x0_values"], [0.1 * i, 0.2])
+            assert isinstance(result["hypothesis"], DiseaseHypothesis)
+            assert result["hypothesis"].x0_indices == lsa_hypothesis.x0_indices
+            assert numpy.array_equal(result["hypothesis"].x0_values, lsa_hypothesis.x0_values)
+        # Each child is created from its own copy of the instances of children_dict
+        assert results1["results"][0]["hypothesis"] is not results1["results"][1]["hypothesis"]
+
     @classmethod
     def teardown_class(cls):
         remove_temporary_test_files()
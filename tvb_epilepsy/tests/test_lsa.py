@@ -0,0 +1,83 @@
+from copy import deepcopy
+import numpy
+from scipy import sparse
+from tvb_epilepsy.base.model.disease_hypothesis import DiseaseHypothesis
+from tvb_epilepsy.service.lsa_service import LSAService
+from tvb_epilepsy.service.model_configuration_service import ModelConfigurationService
+from tvb_epilepsy.tests.base import get_random_connectivity_matrix
+
+
+class TestLSA():
+    n_regions = 20
+
+    def test_run_lsa_batch(self):
+        connectivity_matrix = get_random_connectivity_matrix(self.n_regions)
+
+        hypothesis = DiseaseHypothesis(self.n_regions, excitability_hypothesis={tuple([3]): [0.9]},
+                                       epileptogenicity_hypothesis={tuple([10]): [0.8]}, connectivity_hypothesis={})
+        model_configurations = []
+        for K in [5.0, 10.0, 15.0]:
+            model_configurations.append(ModelConfigurationService(self.n_regions, K=K)
+                                        .configure_model_from_hypothesis(hypothesis, connectivity_matrix))
+
+        lsa_hypotheses = [LSAService().run_lsa(hypothesis, deepcopy(model_configuration))
+                          for model_configuration in model_configurations]
+        lsa_hypotheses_batch = LSAService().run_lsa_batch(hypothesis, deepcopy(model_configurations), batch_size=2)
+
+        assert len(lsa_hypotheses_batch) == len(lsa_hypotheses)
+        for lsa_hypothesis, lsa_hypothesis_batch in zip(lsa_hypotheses, lsa_hypotheses_batch):
+            assert numpy.allclose(lsa_hypothesis.propagation_strengths, lsa_hypothesis_batch.propagation_strengths)
+            assert numpy.all(numpy.sort(lsa_hypothesis.propagation_indices) ==
+                             numpy.sort(lsa_hypothesis_batch.propagation_indices))
+
+    def test_run_lsa_sparse(self):
+        n_regions = 50
+        connectivity_matrix = sparse.random(n_regions, n_regions, density=0.1, format="csr",
+                                            random_state=numpy.random.RandomState(0))
+        connectivity_matrix = ((connectivity_matrix + connectivity_matrix.T) / 2.0).tocsr()
+
+        hypothesis = DiseaseHypothesis(n_regions, excitability_hypothesis={tuple([3]): [0.9]},
+                                       epileptogenicity_hypothesis={tuple([10]): [0.8]}, connectivity_hypothesis={})
+        model_configuration_service = ModelConfigurationService(n_regions, K=10.0)
+        model_configuration = model_configuration_service.configure_model_from_hypothesis(
+            hypothesis, connectivity_matrix.toarray())
+        model_configuration_sparse = model_configuration_service.configure_model_from_hypothesis(
+            hypothesis, connectivity_matrix)
+
+        assert numpy.allclose(model_configuration.x1EQ, model_configuration_sparse.x1EQ)
+        assert numpy.allclose(model_configuration.x0_values, model_configuration_sparse.x0_values)
+
+        # With a single eigenvector, the propagation strength does not depend on the eigenvector's sign:
+        lsa_service = LSAService(eigen_vectors_number=1)
+        lsa_hypothesis = lsa_service.run_lsa(hypothesis, model_configuration)
+        lsa_service_sparse = LSAService(eigen_vectors_number=1)
+        lsa_hypothesis_sparse = lsa_service_sparse.run_lsa(hypothesis, model_configuration_sparse)
+
+        assert lsa_service_sparse.eigen_vectors.shape == (n_regions, 1)
+        assert numpy.allclose(lsa_service.eigen_values[0], lsa_service_sparse.eigen_values[0])
+        assert numpy.allclose(lsa_hypothesis.propagation_strengths, lsa_hypothesis_sparse.propagation_strengths)
+
+    def test_run_lsa_sparse_eigen_vectors_number_selection(self):
+        n_regions = 50
+        connectivity_matrix = sparse.random(n_regions, n_regions, density=0.1, format="csr",
+                                            random_state=numpy.random.RandomState(0))
+        connectivity_matrix = ((connectivity_matrix + connectivity_matrix.T) / 2.0).tocsr()
+
+        hypothesis = DiseaseHypothesis(n_regions, excitability_hypothesis={tuple([3]): [0.9]},
+                                       epileptogenicity_hypothesis={tuple([10]): [0.8]}, connectivity_hypothesis={})
+        model_configuration_service = ModelConfigurationService(n_regions, K=10.0)
+        model_configuration = model_configuration_service.configure_model_from_hypothesis(
+            hypothesis, connectivity_matrix.toarray())
+        model_configuration_sparse = model_configuration_service.configure_model_from_hypothesis(
+            hypothesis, connectivity_matrix)
+
+        # An automatically computed eigen_vectors_number is stored in the same way for dense and sparse inputs:
+        lsa_service = LSAService(eigen_vectors_number_selection="auto_disease")
+        lsa_service.run_lsa(hypothesis, model_configuration)
+        lsa_service_sparse = LSAService(eigen_vectors_number_selection="auto_disease")
+        lsa_service_sparse.run_lsa(hypothesis, model_configuration_sparse)
+
+        assert lsa_service_sparse.eigen_vectors.shape == (n_regions, 2)
+        assert lsa_service.eigen_vectors_number == lsa_service_sparse.eigen_vectors_number == 2
+        assert lsa_service.eigen_vectors_number_selection == lsa_service_sparse.eigen_vectors_number_selection \
+               == "auto_disease"
@@ -0,0 +1,27 @@
+import numpy
+from tvb_epilepsy.base.model.disease_hypothesis import DiseaseHypothesis
+from tvb_epilepsy.service.model_configuration_service import ModelConfigurationService
+from tvb_epilepsy.tests.base import get_random_connectivity_matrix
+
+
+class TestModelConfigurationService():
+    n_regions = 20
+
+    def test_configure_models_from_hypotheses(self):
+        connectivity_matrix = get_random_connectivity_matrix(self.n_regions)
+
+        hypotheses = [DiseaseHypothesis(self.n_regions, excitability_hypothesis={tuple([3]): [x0]},
+                                        epileptogenicity_hypothesis={tuple([10]): [0.8]}, connectivity_hypothesis={})
+                      for x0 in [0.7, 0.8, 0.9]]
+        model_configuration_service = ModelConfigurationService(self.n_regions, x1eq_mode="linTaylor")
+
+        model_configurations = model_configuration_service.configure_models_from_hypotheses(hypotheses,
+                                                                                            connectivity_matrix)
+
+        assert len(model_configurations) == len(hypotheses)
+        for hypothesis, model_configuration in zip(hypotheses, model_configurations):
+            model_configuration_single = \
+                model_configuration_service.configure_model_from_hypothesis(hypothesis, connectivity_matrix)
+            assert numpy.allclose(model_configuration.x1EQ, model_configuration_single.x1EQ, atol=10 ** (-5))
+            assert numpy.allclose(model_configuration.x0_values, model_configuration_single.x0_values,
+                                  atol=10 ** (-5))
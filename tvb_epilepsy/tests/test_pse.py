@@ -0,0 +1,145 @@
+import os
+import numpy
+from tvb_epilepsy.base.model.disease_hypothesis import DiseaseHypothesis
+from tvb_epilepsy.scripts.hypothesis_scripts import start_lsa_run
+from tvb_epilepsy.scripts.simulation_scripts import setup_TVB_simulation_from_model_configuration, set_time_scales
+from tvb_epilepsy.service.model_configuration_service import ModelConfigurationService
+from tvb_epilepsy.service.pse_service import PSEService, AttributePath, ParametersOverlay, hilbert_curve_order, \
+    lsa_run_fun, sim_out_fun
+from tvb_epilepsy.tests.base import get_random_connectivity_matrix
+from tvb_epilepsy.tvb_api.readers_tvb import TVBReader
+
+
+class TestPSE():
+    n_regions = 20
+    n_samples = 8
+
+    def _prepare_pse(self):
+        random_state = numpy.random.RandomState(0)
+        connectivity_matrix = get_random_connectivity_matrix(self.n_regions, random_state)
+
+        hypothesis = DiseaseHypothesis(self.n_regions, excitability_hypothesis={tuple([3]): [0.9]},
+                                       epileptogenicity_hypothesis={tuple([10]): [0.8]}, connectivity_hypothesis={})
+        model_configuration_service, model_configuration, lsa_service, lsa_hypothesis = \
+            start_lsa_run(hypothesis, connectivity_matrix)
+
+        params_pse = [{"path": "hypothesis.x0_values", "indices": [0],
+                       "samples": random_state.uniform(0.7, 0.95, self.n_samples)},
+                      {"path": "model_configuration_service.K_unscaled", "indices": range(self.n_regions),
+                       "samples": random_state.uniform(5.0, 15.0, self.n_samples)}]
+        pse = PSEService("LSA", hypothesis=lsa_hypothesis, params_pse=params_pse)
+
+        return pse, connectivity_matrix, {"lsa_service_input": lsa_service,
+                                          "model_configuration_service_input": model_configuration_service}
+
+    def test_run_pse_parallel(self):
+        pse, connectivity_matrix, kwargs = self._prepare_pse()
+
+        results, execution_status = pse.run_pse(connectivity_matrix, **kwargs)
+        results_parallel, execution_status_parallel = pse.run_pse_parallel(connectivity_matrix, n_processes=2,
+                                                                           chunk_size=3, **kwargs)
+
+        assert numpy.all(execution_status)
+        assert execution_status_parallel == execution_status
+        for result, result_parallel in zip(results, results_parallel):
+            for key in result.keys():
+                assert numpy.allclose(result[key], result_parallel[key])
+
+    def test_run_pse_continuation(self):
+        pse, connectivity_matrix, kwargs = self._prepare_pse()
+
+        results, execution_status = pse.run_pse(connectivity_matrix, **kwargs)
+        kwargs["model_configuration_service_input"].x1eq_continuation = True
+        results_continuation, execution_status_continuation = pse.run_pse(connectivity_matrix, samples_order="hilbert",
+                                                                          **kwargs)
+
+        assert execution_status_continuation == execution_status
+        for result, result_continuation in zip(results, results_continuation):
+            for key in result.keys():
+                assert numpy.allclose(result[key], result_continuation[key], atol=10 ** (-6))
+
+    def test_run_pse_user_run_fun(self):
+        pse, connectivity_matrix, kwargs = self._prepare_pse()
+
+        # User defined run functions get the parameters' paths as strings:
+        def run_fun(hypothesis_input, connectivity_matrix, params_paths, params_values, params_indices, out_fun,
+                    **kwargs):
+            assert all([isinstance(path, basestring) for path in params_paths])
+            return lsa_run_fun(hypothesis_input, connectivity_matrix, params_paths, params_values, params_indices,
+                               out_fun, **kwargs)
+
+        results, execution_status = pse.run_pse(connectivity_matrix, **kwargs)
+        pse.run_fun = run_fun
+        results_user, execution_status_user = pse.run_pse(connectivity_matrix, **kwargs)
+
+        assert execution_status_user == execution_status
+        for result, result_user in zip(results, results_user):
+            for key in result.keys():
+                assert numpy.allclose(result[key], result_user[key])
+
+    def test_run_pse_batch(self):
+        connectivity = TVBReader().read_connectivity(os.path.join("data", "connectivity_76.zip"))
+        hypothesis = DiseaseHypothesis(connectivity.number_of_regions, excitability_hypothesis={tuple([0, 10]): [1, 1]},
+                                       epileptogenicity_hypothesis={}, connectivity_hypothesis={})
+        model_configuration = ModelConfigurationService(connectivity.number_of_regions).\
+            configure_model_from_hypothesis(hypothesis, connectivity.normalized_weights)
+        (dt, fsAVG, sim_length, monitor_period, n_report_blocks) = \
+            set_time_scales(fs=2 * 4096.0, time_length=100.0, scale_fsavg=None, report_every_n_monitor_steps=10.0)
+        simulator = setup_TVB_simulation_from_model_configuration(model_configuration, connectivity, dt, sim_length,
+                                                                  monitor_period, "EpileptorDP2D",
+                                                                  zmode=numpy.array("lin"), noise_instance=None,
+                                                                  noise_intensity=0.0, monitor_expressions=None)
+        simulator.config_simulation(initial_conditions=None)
+
+        # The out_fun gets the simulator with the model of each sample:
+        out_fun = lambda simulator, time, data: dict(sim_out_fun(simulator, time, data),
+                                                     x0=numpy.array(simulator.model.x0).flatten())
+        x0 = numpy.array(simulator.model.x0).flatten()
+        pse = PSEService("SIMULATION", simulator=simulator, out_fun=out_fun,
+                         params_pse=[{"path": "model.x0", "indices": [3],
+                                      "samples": numpy.linspace(x0[3], x0[3] + 0.5, 3)}])
+
+        results, execution_status = pse.run_pse(connectivity.normalized_weights)
+        results_batch, execution_status_batch = pse.run_pse_batch(connectivity.normalized_weights, batch_size=2)
+
+        assert numpy.all(execution_status)
+        assert execution_status_batch == execution_status
+        for result, result_batch, sample in zip(results, results_batch, pse.pse_params[:, 0]):
+            assert numpy.allclose(result_batch["x0"][3], sample)
+            for key in result.keys():
+                assert numpy.allclose(result[key], result_batch[key])
+
+    def test_hilbert_curve_order(self):
+        grid = numpy.array(numpy.meshgrid(range(8), range(8), indexing="ij")).reshape(2, -1).T
+        order = hilbert_curve_order(grid, n_bits=3)
+
+        assert numpy.all(numpy.sort(order) == numpy.arange(grid.shape[0]))
+        assert numpy.all(numpy.abs(numpy.diff(grid[order], axis=0)).sum(axis=1) == 1)
+
+    def test_attribute_path(self):
+        hypothesis = DiseaseHypothesis(self.n_regions, excitability_hypothesis={tuple([3, 5]): [0.9, 0.8]},
+                                       epileptogenicity_hypothesis={}, connectivity_hypothesis={})
+        path = AttributePath("hypothesis.x0_values", [1.0])
+
+        assert path.head == "hypothesis"
+        assert path.tail.get(hypothesis) == [0.8]
+
+        path.tail.set(hypothesis, 0.7)
+        assert numpy.allclose(hypothesis.x0_values, [0.9, 0.7])
+
+    def test_parameters_overlay(self):
+        hypothesis = DiseaseHypothesis(self.n_regions, excitability_hypothesis={tuple([3, 5]): [0.9, 0.8]},
+                                       epileptogenicity_hypothesis={}, connectivity_hypothesis={})
+        x0_values = hypothesis.x0_values
+        attributes = dict(vars(hypothesis))
+
+        overlay = ParametersOverlay(hypothesis)
+        overlay.apply(["x0_values", "name"], [0.5, "loop"], [[1], []])
+        assert numpy.allclose(hypothesis.x0_values, [0.9, 0.5])
+        hypothesis.x0_values = numpy.array([0.1, 0.2])
+        hypothesis.added_in_loop = True
+        overlay.restore()
+
+        assert hypothesis.x0_values is x0_values
+        assert numpy.allclose(hypothesis.x0_values, [0.9, 0.8])
+        assert vars(hypothesis) == attributes
@@ -0,0 +1,76 @@
+import os
+import h5py
+import numpy
+from tvb_epilepsy.custom.read_write import TimeSeriesH5Writer, TimeSeriesH5Reader, write_ts_epi, write_ts_seeg_epi
+from tvb_epilepsy.tests.base import get_temporary_files_path, remove_temporary_test_files
+
+
+class TestReadWrite():
+    sampling_period = 0.5
+
+    def test_time_series_h5_writer(self):
+        path = get_temporary_files_path("ts_writer.h5")
+        time = self.sampling_period * numpy.arange(1, 31)
+        data = numpy.random.RandomState(0).normal(size=(30, 2, 5, 1))
+        with TimeSeriesH5Writer(path, self.sampling_period) as writer:
+            writer.append(time[:10], data[:10])
+            writer.flush()
+            writer.append(time[10:20], data[10:20])
+
+        # Resume, e.g., after a crash, appending only the samples after the last written one:
+        with TimeSeriesH5Writer(path, self.sampling_period, resume=True) as writer:
+            assert writer.n_samples == 20
+            writer.append(time[15:], data[15:])
+
+        h5_file = h5py.File(path, 'r')
+        assert numpy.array_equal(h5_file["/time"][:], time)
+        assert numpy.array_equal(h5_file["/data"][:], numpy.swapaxes(data[:, :, :, 0], 1, 2))
+        assert h5_file["/data"].attrs["Number_of_steps"] == 30
+        h5_file.close()
+
+    def test_time_series_h5_reader(self):
+        path = get_temporary_files_path("ts_reader.h5")
+        time = self.sampling_period * numpy.arange(1, 31)
+        data = numpy.random.RandomState(0).normal(size=(30, 2, 5, 1))
+        with TimeSeriesH5Writer(path, self.sampling_period, chunk_size=2 ** 8) as writer:
+            writer.append(time, data)
+        data = numpy.swapaxes(data[:, :, :, 0], 1, 2)
+
+        with TimeSeriesH5Reader(path) as reader:
+            assert reader.shape == data.shape and reader.n_steps == 30
+            assert numpy.array_equal(reader[5:10, 1], data[5:10, 1])
+            # A time window of some channels, in any order:
+            window_time, window_data = reader.window(2.0, 4.0, channels=[4, 0, 2])
+            assert numpy.array_equal(window_time, time[3:8])
+            assert numpy.array_equal(window_data, data[3:8][:, [4, 0, 2]])
+            # Chunks of the time window:
+            chunks = list(reader.iter_chunks(chunk_length=4, start_time=2.0))
+            assert [chunk_time.shape[0] for chunk_time, chunk_data in chunks] == [4, 4, 4, 4, 4, 4, 3]
+            assert numpy.array_equal(numpy.concatenate([chunk_data for chunk_time, chunk_data in chunks]),
+                                     data[3:])
+
+    def test_write_ts_storage_profiles(self):
+        folder = get_temporary_files_path()
+        data = numpy.random.RandomState(0).normal(size=(1000, 5, 3))
+        for storage_profile in ["contiguous", "gzip", "gzip_float32"]:
+            filename = "ts_" + storage_profile + ".h5"
+            write_ts_epi(data, self.sampling_period, data[:, :, 0], folder, filename,
+                         storage_profile=storage_profile)
+            write_ts_seeg_epi(data[:, :, 1], self.sampling_period, folder, filename,
+                              storage_profile=storage_profile)
+            with TimeSeriesH5Reader(os.path.join(folder, filename)) as reader:
+                stored_data = data.astype(reader.dtype)
+                assert numpy.array_equal(reader[:], stored_data)
+                assert reader.data.attrs["Max_value"] == stored_data.max()
+                assert reader.data.attrs["Min_value"] == stored_data.min()
+                if storage_profile == "contiguous":
+                    assert reader.data.chunks is None
+                else:
+                    # Time-major chunks, spanning all regions and state variables:
+                    assert reader.data.chunks[1:] == (5, 3) and reader.data.compression == "gzip"
+            with TimeSeriesH5Reader(os.path.join(folder, filename), "/SeegSensors-5") as reader:
+                assert numpy.array_equal(reader[:], stored_data[:, :, 1])
+
+    @classmethod
+    def teardown_class(cls):
+        remove_temporary_test_files()
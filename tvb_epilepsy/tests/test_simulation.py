@@ -1,11 +1,18 @@
 import numpy
 import os
+from tvb.simulator import monitors
+from tvb_epilepsy.base import simulators
 from tvb_epilepsy.base.model.disease_hypothesis import DiseaseHypothesis
+from tvb_epilepsy.base.simulator_native import SimulatorNative, native_model_builder
 from tvb_epilepsy.custom.readers_custom import CustomReader
 from tvb_epilepsy.scripts.simulation_scripts import setup_TVB_simulation_from_model_configuration, set_time_scales, \
     setup_custom_simulation_from_model_configuration
+from tvb_epilepsy.service.epileptor_model_factory import model_build_dict
 from tvb_epilepsy.service.model_configuration_service import ModelConfigurationService
+from tvb_epilepsy.tests.base import get_temporary_files_path
+from tvb_epilepsy.tvb_api import simulator_tvb
 from tvb_epilepsy.tvb_api.readers_tvb import TVBReader
+from tvb_epilepsy.tvb_api.simulator_tvb import SimulatorTVBBatch, clear_simulator_cache
 
 data_dir = "data"
 
@@ -48,6 +55,226 @@ class TestSimulationRun():
 
         assert status == True
 
+    def test_tvb_simulation_batch(self):
+        reader = TVBReader()
+        connectivity = reader.read_connectivity(os.path.join(data_dir, "connectivity_76.zip"))
+        model_configuration = self._prepare_model_for_simulation(connectivity)
+        (dt, fsAVG, sim_length, monitor_period, n_report_blocks) = \
+            set_time_scales(fs=self.fs, time_length=1000.0, scale_fsavg=None,
+                            report_every_n_monitor_steps=self.report_every_n_monitor_steps)
+
+        def setup_simulator():
+            simulator = setup_TVB_simulation_from_model_configuration(model_configuration, connectivity, dt,
+                                                                      sim_length, monitor_period,
+                                                                      self.epileptor_model, zmode=self.zmode,
+                                                                      noise_instance=None,
+                                                                      noise_intensity=self.noise_intensity,
+                                                                      monitor_expressions=None)
+            simulator.config_simulation(initial_conditions=None)
+            return simulator
+
+        simulator = setup_simulator()
+        models = []
+        for x0_shift in [0.0, 0.2]:
+            model = model_build_dict[self.epileptor_model](model_configuration, zmode=self.zmode)
+            model.x0 = model.x0 + x0_shift
+            models.append(model)
+
+        ttavg, tavg_data, status = SimulatorTVBBatch(simulator, models).launch_simulation()
+
+        # The serial runs share the random stream of the noise, as the samples of a batch do:
+        simulator_serial = setup_simulator()
+        assert status == True
+        for model, model_tavg_data in zip(models, tavg_data):
+            simulator_serial.model = model
+            simulator_serial.config_simulation(initial_conditions=simulator.simTVB.initial_conditions)
+            ttavg_serial, tavg_data_serial, status_serial = simulator_serial.launch_simulation()
+            assert numpy.allclose(ttavg, ttavg_serial)
+            assert numpy.allclose(model_tavg_data, tavg_data_serial)
+
+    def test_tvb_simulation_cache(self):
+        reader = TVBReader()
+        connectivity = reader.read_connectivity(os.path.join(data_dir, "connectivity_76.zip"))
+        model_configuration = self._prepare_model_for_simulation(connectivity)
+        (dt, fsAVG, sim_length, monitor_period, n_report_blocks) = \
+            set_time_scales(fs=self.fs, time_length=1000.0, scale_fsavg=None,
+                            report_every_n_monitor_steps=self.report_every_n_monitor_steps)
+
+        def run_simulation(x0_shift, simulator=None):
+            if simulator is None:
+                simulator = setup_TVB_simulation_from_model_configuration(model_configuration, connectivity, dt,
+                                                                          sim_length, monitor_period,
+                                                                          self.epileptor_model, zmode=self.zmode,
+                                                                          noise_instance=None,
+                                                                          noise_intensity=10 ** -4,
+                                                                          monitor_expressions=None)
+                simulator.model.x0 = simulator.model.x0 + x0_shift
+            simulator.config_simulation(initial_conditions=None)
+            return simulator, simulator.launch_simulation()[1]
+
+        # A simulator configured from the cached one of a previous simulation, against a newly configured one:
+        clear_simulator_cache()
+        run_simulation(0.0)
+        simulator, tavg_data_cached = run_simulation(0.2)
+        clear_simulator_cache()
+        tavg_data = run_simulation(0.2)[1]
+
+        assert numpy.array_equal(tavg_data_cached, tavg_data)
+
+        # The random stream of the preconfigured noise is advanced by every simulation, as without the cache:
+        tavg_data_next = run_simulation(0.2, simulator)[1]
+
+        assert not numpy.array_equal(tavg_data_next, tavg_data)
+
+    def test_tvb_simulation_checkpoint(self):
+        reader = TVBReader()
+        connectivity = reader.read_connectivity(os.path.join(data_dir, "connectivity_76.zip"))
+        model_configuration = self._prepare_model_for_simulation(connectivity)
+        (dt, fsAVG, sim_length, monitor_period, n_report_blocks) = \
+            set_time_scales(fs=self.fs, time_length=1000.0, scale_fsavg=None,
+                            report_every_n_monitor_steps=self.report_every_n_monitor_steps)
+        checkpoint_path = get_temporary_files_path("simulation_checkpoint.h5")
+
+        def run_simulation(**kwargs):
+            simulator = setup_TVB_simulation_from_model_configuration(model_configuration, connectivity, dt,
+                                                                      sim_length, monitor_period,
+                                                                      self.epileptor_model, zmode=self.zmode,
+                                                                      noise_instance=None, noise_intensity=10 ** -4,
+                                                                      monitor_expressions=None)
+            simulator.config_simulation(initial_conditions=None)
+            return simulator.launch_simulation(4, **kwargs)
+
+        # A simulation resumed from the checkpoint of its last but one report block, against an uninterrupted one:
+        ttavg, tavg_data, status = run_simulation()
+        run_simulation(checkpoint_path=checkpoint_path)
+        ttavg_resumed, tavg_data_resumed, status_resumed = run_simulation(resume_from=checkpoint_path)
+        os.remove(checkpoint_path)
+
+        assert status and status_resumed
+        assert numpy.array_equal(ttavg, ttavg_resumed)
+        assert numpy.array_equal(tavg_data, tavg_data_resumed)
+
+    def test_tvb_simulation_rosenbrock(self):
+        reader = TVBReader()
+        connectivity = reader.read_connectivity(os.path.join(data_dir, "connectivity_76.zip"))
+        model_configuration = self._prepare_model_for_simulation(connectivity)
+        (dt, fsAVG, sim_length, monitor_period, n_report_blocks) = \
+            set_time_scales(fs=self.fs, time_length=1000.0, scale_fsavg=None,
+                            report_every_n_monitor_steps=self.report_every_n_monitor_steps)
+
+        tavg_data = []
+        # The Rosenbrock integrator with a larger integration step, against Heun:
+        for integrator_type, integration_step in [("heun", dt), ("rosenbrock", 8 * dt)]:
+            simulator = setup_TVB_simulation_from_model_configuration(model_configuration, connectivity,
+                                                                      integration_step, sim_length, monitor_period,
+                                                                      self.epileptor_model, zmode=self.zmode,
+                                                                      noise_instance=None, noise_intensity=0.0,
+                                                                      monitor_expressions=None)
+            simulator.config_simulation(initial_conditions=None, integrator_type=integrator_type)
+            ttavg, data, status = simulator.launch_simulation()
+            assert status == True
+            tavg_data.append(data)
+
+        assert numpy.allclose(tavg_data[0], tavg_data[1], rtol=1e-4, atol=1e-4)
+
+    def test_tvb_simulation_adaptive(self):
+        reader = TVBReader()
+        connectivity = reader.read_connectivity(os.path.join(data_dir, "connectivity_76.zip"))
+        model_configuration = self._prepare_model_for_simulation(connectivity)
+        (dt, fsAVG, sim_length, monitor_period, n_report_blocks) = \
+            set_time_scales(fs=self.fs, time_length=1000.0, scale_fsavg=None,
+                            report_every_n_monitor_steps=self.report_every_n_monitor_steps)
+
+        ttavg, tavg_data = [], []
+        # The adaptive integrator samples its dense output at the monitor period, like a SubSample monitor,
+        # which also replaces the default TemporalAverage monitor:
+        for integrator_type, monitor in [("heun", monitors.SubSample()), ("adaptive", monitors.SubSample()),
+                                         ("adaptive", None)]:
+            simulator = setup_TVB_simulation_from_model_configuration(model_configuration, connectivity, dt,
+                                                                      sim_length, monitor_period,
+                                                                      self.epileptor_model, zmode=self.zmode,
+                                                                      noise_instance=None, noise_intensity=0.0,
+                                                                      monitor_expressions=None,
+                                                                      monitors_instance=monitor)
+            simulator.config_simulation(initial_conditions=None, integrator_type=integrator_type)
+            time, data, status = simulator.launch_simulation()
+            assert status == True
+            ttavg.append(time)
+            tavg_data.append(data)
+
+        assert simulator.simTVB.integrator.dt == monitor_period
+        assert isinstance(simulator.simTVB.monitors[0], monitors.SubSample)
+        for time, data in zip(ttavg[1:], tavg_data[1:]):
+            assert numpy.allclose(time, ttavg[0])
+            assert numpy.allclose(data, tavg_data[0], rtol=1e-4, atol=1e-4)
+
+    def test_native_simulation(self):
+        reader = TVBReader()
+        connectivity = reader.read_connectivity(os.path.join(data_dir, "connectivity_76.zip"))
+        model_configuration = self._prepare_model_for_simulation(connectivity)
+        (dt, fsAVG, sim_length, monitor_period, n_report_blocks) = \
+            set_time_scales(fs=self.fs, time_length=1000.0, scale_fsavg=None,
+                            report_every_n_monitor_steps=self.report_every_n_monitor_steps)
+
+        simulator = setup_TVB_simulation_from_model_configuration(model_configuration, connectivity, dt,
+                                                                  sim_length, monitor_period,
+                                                                  self.epileptor_model, zmode=self.zmode,
+                                                                  noise_instance=None, noise_intensity=0.0,
+                                                                  monitor_expressions=None)
+        simulator.config_simulation(initial_conditions=None)
+        ttavg, tavg_data, status = simulator.launch_simulation()
+
+        # The native simulator, with a model built without TVB, against TVB:
+        model = native_model_builder(model_configuration, 2, zmode=self.zmode)
+        simulator_native = SimulatorNative(connectivity, model_configuration, model, simulator.simulation_settings)
+        simulator_native.config_simulation(initial_conditions=simulator.simTVB.initial_conditions)
+        ttavg_native, tavg_data_native, status_native = simulator_native.launch_simulation(n_report_blocks)
+
+        assert status_native == True
+        assert numpy.allclose(ttavg, ttavg_native)
+        assert numpy.allclose(tavg_data, tavg_data_native)
+
+    def test_simulation_time_delays(self):
+        reader = TVBReader()
+        connectivity = reader.read_connectivity(os.path.join(data_dir, "connectivity_76.zip"))
+        model_configuration = self._prepare_model_for_simulation(connectivity)
+        (dt, fsAVG, sim_length, monitor_period, n_report_blocks) = \
+            set_time_scales(fs=self.fs, time_length=200.0, scale_fsavg=None,
+                            report_every_n_monitor_steps=self.report_every_n_monitor_steps)
+
+        time_delays_flag = simulators.TIME_DELAYS_FLAG, simulator_tvb.TIME_DELAYS_FLAG
+        try:
+            simulators.TIME_DELAYS_FLAG = simulator_tvb.TIME_DELAYS_FLAG = 1.0
+            simulator = setup_TVB_simulation_from_model_configuration(model_configuration, connectivity, dt,
+                                                                      sim_length, monitor_period,
+                                                                      self.epileptor_model, zmode=self.zmode,
+                                                                      noise_instance=None, noise_intensity=0.0,
+                                                                      monitor_expressions=None)
+            simulator.model.x0 = simulator.model.x0 + 0.3
+            simulator.config_simulation(initial_conditions=None)
+            horizon = simulator.history_length(dt)
+            assert horizon > 1
+            assert simulator.simTVB.horizon == horizon
+            assert simulator.simTVB.initial_conditions.shape[0] == horizon
+            ttavg, tavg_data, status = simulator.launch_simulation()
+
+            # The native and the batch simulators, with their own histories of the coupling variables, against TVB:
+            model = native_model_builder(model_configuration, 2, zmode=self.zmode)
+            model.x0 = model.x0 + 0.3
+            simulator_native = SimulatorNative(connectivity, model_configuration, model,
+                                               simulator.simulation_settings)
+            simulator_native.config_simulation(initial_conditions=simulator.simTVB.initial_conditions)
+            ttavg_native, tavg_data_native, status_native = simulator_native.launch_simulation()
+            ttavg_batch, tavg_data_batch, status_batch = \
+                SimulatorTVBBatch(simulator, [simulator.model]).launch_simulation()
+        finally:
+            simulators.TIME_DELAYS_FLAG, simulator_tvb.TIME_DELAYS_FLAG = time_delays_flag
+
+        assert status and status_native and status_batch
+        assert numpy.allclose(ttavg, ttavg_native) and numpy.allclose(ttavg, ttavg_batch)
+        assert numpy.allclose(tavg_data, tavg_data_native)
+        assert numpy.allclose(tavg_data, tavg_data_batch[0])
+
         # This can be ran only locally for the moment
 
         # def test_custom_simulation(self):
@@ -0,0 +1,43 @@
+import os
+import numpy
+from tvb_epilepsy.base.computations import symbolic_utils
+from tvb_epilepsy.base.computations.symbolic_utils import symbol_eqnt_dfun
+from tvb_epilepsy.tests.base import get_temporary_files_path, remove_temporary_test_files
+
+
+class TestSymbolicUtils():
+    n_regions = 3
+
+    def test_symbolic_cache(self):
+        folder = get_temporary_files_path("symbolic_cache")
+        try:
+            symbolic_utils.set_symbolic_cache_folder(folder)
+            symbolic_utils.clear_symbolic_cache()
+            dfun_lambda, dfun_sym, vars_dict = symbol_eqnt_dfun(self.n_regions, 2)
+            vars_dict.pop("x1")
+            assert "x1" in symbol_eqnt_dfun(self.n_regions, model_vars=2)[2]
+            assert len(os.listdir(folder)) > 0
+
+            # Rebuild the lambdified function from the code stored to disk:
+            symbolic_utils.clear_symbolic_cache()
+            dfun_lambda_stored, dfun_sym_stored = symbol_eqnt_dfun(self.n_regions, 2)[:2]
+            assert dfun_sym_stored == dfun_sym
+            args = [0.3 * numpy.ones(self.n_regions)] * 6 + [numpy.ones((self.n_regions, self.n_regions))] + \
+                   [0.7 * numpy.ones(self.n_regions)] * 6
+            assert numpy.allclose(dfun_lambda_stored(*args), dfun_lambda(*args))
+
+            # After a change of the builder's or the equations' code, or of sympy, the stored results are not used:
+            n_stored = len(os.listdir(folder))
+            symbolic_utils.clear_symbolic_cache()
+            for builder in symbolic_utils._symbolic_builder_versions.keys():
+                symbolic_utils._symbolic_builder_versions[builder] = "changed"
+            symbol_eqnt_dfun(self.n_regions, 2)
+            assert len(os.listdir(folder)) > n_stored
+        finally:
+            symbolic_utils.set_symbolic_cache_folder(None)
+            symbolic_utils.clear_symbolic_cache()
+            symbolic_utils._symbolic_builder_versions.clear()
+
+    @classmethod
+    def teardown_class(cls):
+        remove_temporary_test_files()
@@ -3,14 +3,233 @@
 Extend TVB Models, with new ones, specific for Epilepsy.
 """
 
+from weakref import WeakKeyDictionary
 import numpy
 import tvb.basic.traits.types_basic as basic
 import tvb.datatypes.arrays as arrays
 from tvb.simulator.common import get_logger
 from tvb.simulator.models import Model
-from tvb_epilepsy.base.utils import raise_value_error, raise_not_implemented_error
+from tvb_epilepsy.base.constants import FUSED_DFUN_FLAG, FUSED_DFUN_NUMEXPR_SIZE
+from tvb_epilepsy.base.computations.equations_utils import eqtn_jac_x1_2d_diag, eqtn_jac_x1_6d_diag, \
+    eqtn_jac_fz_2d_diag, eqtn_slope_Iext2, eqtn_slope_Iext2_diff
+from tvb_epilepsy.base.utils import raise_value_error
 LOG = get_logger(__name__)
 
+try:
+    import numexpr
+    NUMEXPR_IMPORT = True
+    # numexpr is faster than the numpy kernels only when it evaluates large states in parallel:
+    NUMEXPR_PARALLEL = numexpr.detect_number_of_cores() > 1
+except ImportError:
+    NUMEXPR_IMPORT = False
+    NUMEXPR_PARALLEL = False
+
+
+# Fused dfun kernels of the EpileptorDP models:
+# they write to a preallocated output and to workspace buffers, evaluate the branches of the piecewise terms
+# only where (and if) their masks hold.
+# The zmode (and pmode) of a model are dispatched once, when the model is configured, and the resulting kernels are
+# kept outside the model, so that they are neither deep copied nor written to h5 files together with it.
+_dfun_fused_kernels = WeakKeyDictionary()
+
+
+class DfunFusedKernel(object):
+
+    def __init__(self, fz, expressions, slope_Iext2=None, n_buffers=2):
+        self.fz = fz
+        self.expressions = expressions
+        self.slope_Iext2 = slope_Iext2
+        self.n_buffers = n_buffers
+        self.workspace = None
+
+    def get_workspace(self, state_variables):
+        # Buffers of the shape of one state variable, reallocated only when the shape of the state changes:
+        shape = state_variables.shape[1:]
+        if self.workspace is None or self.workspace[0].shape != shape \
+                or self.workspace[0].dtype != state_variables.dtype:
+            self.workspace = [numpy.empty(shape, dtype=state_variables.dtype) for _ in range(self.n_buffers)] + \
+                             [numpy.empty(shape, dtype="bool")]
+        return self.workspace
+
+    def use_numexpr(self, state_variables):
+        return NUMEXPR_PARALLEL and state_variables.size >= FUSED_DFUN_NUMEXPR_SIZE
+
+    def evaluate(self, ydot, local_dict):
+        for iy, expression in enumerate(self.expressions):
+            numexpr.evaluate(expression, local_dict=local_dict, out=ydot[iy], casting="same_kind")
+        return ydot
+
+
+def _get_dfun_fused_kernel(model):
+    kernel = _dfun_fused_kernels.get(model, None)
+    if kernel is None:
+        # e.g., for a model that has not been configured, or for a copy of a configured one
+        kernel = model.configure_dfun_fused()
+    return kernel
+
+
+def _get_parameters(model, names):
+    return [getattr(model, name) for name in names]
+
+
+def _couple_Iext1(Iext1, local_coupling, x1):
+    if numpy.isscalar(local_coupling) and local_coupling == 0.0:
+        return Iext1
+    else:
+        return Iext1 + local_coupling * x1
+
+
+def _fz_lin(x1, z, x0, out, buffer, mask):
+    # 4 * (x1 - x0) + where(z < 0.0, -0.1 * z ** 7, 0.0)
+    numpy.subtract(x1, x0, out=out)
+    out *= 4.0
+    numpy.less(z, 0.0, out=mask)
+    if mask.any():
+        numpy.power(z, 7, out=buffer)
+        buffer *= -0.1
+        numpy.add(out, buffer, out=out, where=mask)
+    return out
+
+
+def _fz_sig(x1, z, x0, out, buffer, mask):
+    # 3.0 / (1.0 + exp(-10.0 * (x1 + 0.5))) - x0
+    numpy.add(x1, 0.5, out=out)
+    out *= -10.0
+    numpy.exp(out, out=out)
+    out += 1.0
+    numpy.divide(3.0, out, out=out)
+    out -= x0
+    return out
+
+
+fz_kernels_dict = {"lin": (_fz_lin, "4.0 * (x1 - x0) + where(z < 0.0, -0.1 * z ** 7, 0.0)"),
+                   "sig": (_fz_sig, "3.0 / (1.0 + exp(-10.0 * (x1 + 0.5))) - x0")}
+
+
+def _get_fz_kernel(zmode):
+    fz_kernel = fz_kernels_dict.get(str(zmode), None)
+    if fz_kernel is None:
+        raise_value_error("zmode has to be either ""lin"" or ""sig"" for linear and sigmoidal fz(), respectively")
+    return fz_kernel
+
+
+def _get_slope_Iext2_kernel(pmode):
+    pmode = str(pmode)
+    return lambda z, g, slope, Iext2: eqtn_slope_Iext2(z, g, pmode, slope, Iext2)
+
+
+# The derivatives of the first 6 state variables of the EpileptorDP and EpileptorDPrealistic models:
+dp_expressions = ["tau1 * (y1 - z + Iext1 + Kvf * c1 + where(x1 < 0.0, -a * x1 ** 2 + b * x1, "
+                  "slope - x2 + 0.6 * (z - 4.0) ** 2) * x1)",
+                  "tau1 * (yc - d * x1 ** 2 - y1)",
+                  "tau1 * (({fz}) - z + K * c1) / tau0",
+                  "tau1 * (-y2 + x2 - x2 ** 3 + Iext2 + 2.0 * g - 0.3 * (z - 3.5) + Kf * c2)",
+                  "tau1 * (-y2 + where(x2 < -0.25, 0.0, s * (x2 + 0.25))) / tau2",
+                  "tau1 * (-0.01 * (g - gamma * x1))"]
+
+
+def _dfun_dp_numpy(y, c_pop1, c_pop2, ydot, kernel, a, b, yc, d, Iext1, slope, Kvf, x0, K, tau1, tau0, Iext2, Kf, s,
+                   tau2, gamma):
+    buffer1, buffer2, mask = kernel.get_workspace(y)
+    x1, y1, z, x2, y2, g = y[:6]
+
+    # population 1
+    # where(x1 < 0.0, -a * x1 ** 2 + b * x1, slope - x2 + 0.6 * (z - 4.0) ** 2) * x1
+    numpy.subtract(z, 4.0, out=buffer1)
+    numpy.multiply(buffer1, buffer1, out=buffer1)
+    buffer1 *= 0.6
+    buffer1 += slope
+    buffer1 -= x2
+    numpy.less(x1, 0.0, out=mask)
+    if mask.any():
+        numpy.multiply(a, x1, out=buffer2)
+        numpy.subtract(b, buffer2, out=buffer2)
+        buffer2 *= x1
+        numpy.copyto(buffer1, buffer2, where=mask)
+    buffer1 *= x1
+    numpy.multiply(Kvf, c_pop1, out=ydot[0])
+    ydot[0] += y1
+    ydot[0] -= z
+    ydot[0] += Iext1
+    ydot[0] += buffer1
+    ydot[0] *= tau1
+    # yc - d * x1 ** 2 - y1
+    numpy.multiply(x1, x1, out=buffer1)
+    buffer1 *= d
+    numpy.subtract(yc, buffer1, out=ydot[1])
+    ydot[1] -= y1
+    ydot[1] *= tau1
+
+    # energy
+    kernel.fz(x1, z, x0, buffer1, buffer2, mask)
+    buffer1 -= z
+    numpy.multiply(K, c_pop1, out=ydot[2])
+    ydot[2] += buffer1
+    ydot[2] /= tau0
+    ydot[2] *= tau1
+
+    # population 2
+    # -y2 + x2 - x2 ** 3 + Iext2 + 2.0 * g - 0.3 * (z - 3.5) + Kf * c2
+    numpy.multiply(x2, x2, out=buffer1)
+    buffer1 *= x2
+    numpy.subtract(x2, buffer1, out=buffer1)
+    buffer1 -= y2
+    buffer1 += Iext2
+    numpy.multiply(g, 2.0, out=buffer2)
+    buffer1 += buffer2
+    numpy.subtract(z, 3.5, out=buffer2)
+    buffer2 *= 0.3
+    buffer1 -= buffer2
+    numpy.multiply(Kf, c_pop2, out=ydot[3])
+    ydot[3] += buffer1
+    ydot[3] *= tau1
+    # (-y2 + where(x2 < -0.25, 0.0, s * (x2 + 0.25))) / tau2
+    numpy.add(x2, 0.25, out=buffer1)
+    buffer1 *= s
+    numpy.less(x2, -0.25, out=mask)
+    numpy.copyto(buffer1, 0.0, where=mask)
+    buffer1 -= y2
+    buffer1 /= tau2
+    numpy.multiply(tau1, buffer1, out=ydot[4])
+
+    # filter
+    numpy.multiply(gamma, x1, out=buffer1)
+    numpy.subtract(g, buffer1, out=buffer1)
+    buffer1 *= -0.01
+    numpy.multiply(tau1, buffer1, out=ydot[5])
+
+    return ydot
+
+
+def _jacobian_dp(y, jac, zmode, a, b, yc, d, slope, tau1, tau0, s, tau2, gamma, local_coupling=0.0):
+    # The derivatives of the first 6 state variables of the EpileptorDP and EpileptorDPrealistic models,
+    # with respect to the first 6 state variables
+    x1, y1, z, x2, y2, g = y[:6]
+
+    # population 1
+    jac[0, 0], jac[0, 2], jac[0, 3] = eqtn_jac_x1_6d_diag(x1, z, x2, slope, a, b, tau1, x1 < 0.0)
+    jac[0, 0] += tau1 * local_coupling
+    jac[0, 1] = tau1
+    jac[1, 0] = -2.0 * d * x1 * tau1
+    jac[1, 1] = -tau1
+
+    # energy
+    jac[2, 0], jac[2, 2] = eqtn_jac_fz_2d_diag(x1, z, tau1, tau0, zmode, z >= 0.0)
+
+    # population 2
+    jac[3, 2] = -0.3 * tau1
+    jac[3, 3] = tau1 * (1.0 - 3.0 * x2 ** 2)
+    jac[3, 4] = -tau1
+    jac[3, 5] = 2.0 * tau1
+    jac[4, 3] = tau1 * numpy.where(x2 < -0.25, 0.0, s) / tau2
+    jac[4, 4] = -tau1 / tau2
+
+    # filter
+    jac[5, 0] = 0.01 * gamma * tau1
+    jac[5, 5] = -0.01 * tau1
+
+    return jac
+
 
 class EpileptorDP(Model):
     r"""
@@ -247,6 +466,41 @@ class EpileptorDP(Model):
     _nvar = 6
     cvar = numpy.array([0, 3], dtype=numpy.int32)
 
+    def configure(self):
+        super(EpileptorDP, self).configure()
+        self.configure_dfun_fused()
+
+    def configure_dfun_fused(self):
+        fz, fz_expression = _get_fz_kernel(self.zmode)
+        expressions = [expression.format(fz=fz_expression) for expression in dp_expressions]
+        _dfun_fused_kernels[self] = DfunFusedKernel(fz, expressions)
+        return _dfun_fused_kernels[self]
+
+    def dfun_fused(self, state_variables, coupling, local_coupling=0.0, ydot=None):
+        # The dfun, computed by the kernel of the model, and written to ydot, if given
+
+        kernel = _get_dfun_fused_kernel(self)
+        y = state_variables
+        if ydot is None:
+            ydot = numpy.empty_like(state_variables)
+
+        a, b, yc, d, Iext1, slope, Kvf, x0, K, tau1, tau0, Iext2, Kf, s, tau2, gamma = \
+            _get_parameters(self, ["a", "b", "yc", "d", "Iext1", "slope", "Kvf", "x0", "K", "tau1", "tau0", "Iext2",
+                                   "Kf", "s", "tau2", "gamma"])
+        Iext1 = _couple_Iext1(Iext1, local_coupling, y[0])
+        c_pop1 = coupling[0]
+        c_pop2 = coupling[1]
+
+        if kernel.use_numexpr(y):
+            return kernel.evaluate(ydot, {"x1": y[0], "y1": y[1], "z": y[2], "x2": y[3], "y2": y[4], "g": y[5],
+                                          "c1": c_pop1, "c2": c_pop2, "a": a, "b": b, "yc": yc, "d": d,
+                                          "Iext1": Iext1, "slope": slope, "Kvf": Kvf, "x0": x0, "K": K,
+                                          "tau1": tau1, "tau0": tau0, "Iext2": Iext2, "Kf": Kf, "s": s,
+                                          "tau2": tau2, "gamma": gamma})
+
+        return _dfun_dp_numpy(y, c_pop1, c_pop2, ydot, kernel, a, b, yc, d, Iext1, slope, Kvf, x0, K, tau1, tau0,
+                              Iext2, Kf, s, tau2, gamma)
+
     def dfun(self, state_variables, coupling, local_coupling=0.0,
              array=numpy.array, where=numpy.where, concat=numpy.concatenate):
         r"""
@@ -298,6 +552,9 @@ class EpileptorDP(Model):
 
         """
 
+        if FUSED_DFUN_FLAG:
+            return self.dfun_fused(state_variables, coupling, local_coupling)
+
         y = state_variables
         ydot = numpy.empty_like(state_variables)
 
@@ -355,7 +612,21 @@ class EpileptorDP(Model):
 
     def jacobian(self, state_variables, coupling, local_coupling=0.0,
                  array=numpy.array, where=numpy.where, concat=numpy.concatenate):
-        raise_not_implemented_error("Jacobian calculation of model " + self._ui_name + " is not implemented yet!")
+        r"""
+        Computes the Jacobians of the nodes of the Epileptor, i.e., the derivatives of the state variables of every
+        node with respect to its own state variables, for the given state and coupling.
+
+        The coupling is treated as an input, so that the Jacobian of the network is the one returned here,
+        plus the coupling terms. The returned array has a shape of (nvar, nvar) + state_variables.shape[1:],
+        where jacobian[i, j] = d dfun[i] / d state_variables[j].
+
+        """
+
+        y = state_variables
+        jac = numpy.zeros((self.nvar,) + y.shape, dtype=y.dtype)
+
+        return _jacobian_dp(y, jac, self.zmode, self.a, self.b, self.yc, self.d, self.slope, self.tau1, self.tau0,
+                            self.s, self.tau2, self.gamma, local_coupling)
 
 
 class EpileptorDPrealistic(Model):
@@ -617,33 +888,74 @@ class EpileptorDPrealistic(Model):
     @staticmethod
     def fun_slope_Iext2(z, g, pmode, slope, Iext2):
 
-        from tvb_epilepsy.base.computations.analyzers_utils import interval_scaling
+        return eqtn_slope_Iext2(z, g, pmode, slope, Iext2)
 
-        if (pmode == numpy.array(['g', 'z', 'z*g'])).any():
+    def configure(self):
+        super(EpileptorDPrealistic, self).configure()
+        self.configure_dfun_fused()
 
-            if pmode == 'g':
-                xp = 1.0 / (1.0 + numpy.exp(1) ** (-10 * (g + 0.0)))
-                xp1 = 0  # -0.175
-                xp2 = 1  # 0.025
+    def configure_dfun_fused(self):
+        fz, fz_expression = _get_fz_kernel(self.zmode)
+        expressions = [expression.format(fz=fz_expression) for expression in dp_expressions] + \
+                      ["tau1 * (-x0 + x0_par)",
+                       "10.0 * tau1 * (-slope + slope_eq)",
+                       "tau1 * (-Iext1_t + Iext1_par) / tau0",
+                       "5.0 * tau1 * (-Iext2 + Iext2_eq)",
+                       "tau1 * (-K + K_par) / tau0"]
+        _dfun_fused_kernels[self] = DfunFusedKernel(fz, expressions, _get_slope_Iext2_kernel(self.pmode))
+        return _dfun_fused_kernels[self]
 
-            elif pmode == 'z':
-                xp = 1.0 / (1.0 + numpy.exp(1) ** (-10 * (z - 3.00)))
-                xp1 = 0
-                xp2 = 1
+    def dfun_fused(self, state_variables, coupling, local_coupling=0.0, ydot=None):
+        # The dfun, computed by the kernel of the model, and written to ydot, if given
 
-            elif pmode == 'z*g':
-                xp = z * g
-                xp1 = -0.7
-                xp2 = 0.1
-            slope_eq = interval_scaling(xp, xp1, 1.0, xp2, slope)
-            # slope_eq = self.slope
-            Iext2_eq = interval_scaling(xp, xp1, 0.0, xp2, Iext2)
+        kernel = _get_dfun_fused_kernel(self)
+        y = state_variables
+        if ydot is None:
+            ydot = numpy.empty_like(state_variables)
+
+        a, b, yc, d, Iext1_par, slope_par, Kvf, x0_par, K_par, tau1, tau0, Iext2_par, Kf, s, tau2, gamma = \
+            _get_parameters(self, ["a", "b", "yc", "d", "Iext1", "slope", "Kvf", "x0", "K", "tau1", "tau0", "Iext2",
+                                   "Kf", "s", "tau2", "gamma"])
+        Iext1 = _couple_Iext1(Iext1_par, local_coupling, y[0])
+        c_pop1 = coupling[0]
+        c_pop2 = coupling[1]
+        # The parameters following their own dynamics:
+        x0, slope, Iext2, K = y[6], y[7], y[9], y[10]
+
+        slope_eq, Iext2_eq = kernel.slope_Iext2(y[2], y[5], slope_par, Iext2_par)
+
+        if kernel.use_numexpr(y):
+            return kernel.evaluate(ydot, {"x1": y[0], "y1": y[1], "z": y[2], "x2": y[3], "y2": y[4], "g": y[5],
+                                          "Iext1_t": y[8], "c1": c_pop1, "c2": c_pop2, "a": a, "b": b, "yc": yc,
+                                          "d": d, "Iext1": Iext1, "slope": slope, "Kvf": Kvf, "x0": x0, "K": K,
+                                          "tau1": tau1, "tau0": tau0, "Iext2": Iext2, "Kf": Kf, "s": s,
+                                          "tau2": tau2, "gamma": gamma, "x0_par": x0_par, "slope_eq": slope_eq,
+                                          "Iext1_par": Iext1_par, "Iext2_eq": Iext2_eq, "K_par": K_par})
+
+        _dfun_dp_numpy(y, c_pop1, c_pop2, ydot, kernel, a, b, yc, d, Iext1, slope, Kvf, x0, K, tau1, tau0, Iext2,
+                       Kf, s, tau2, gamma)
 
-        else:
-            slope_eq = slope
-            Iext2_eq = Iext2
+        # x0_values
+        numpy.subtract(x0_par, x0, out=ydot[6])
+        ydot[6] *= tau1
+        # slope
+        numpy.subtract(slope_eq, slope, out=ydot[7])
+        ydot[7] *= tau1
+        ydot[7] *= 10.0
+        # Iext1
+        numpy.subtract(Iext1_par, y[8], out=ydot[8])
+        ydot[8] *= tau1
+        ydot[8] /= tau0
+        # Iext2
+        numpy.subtract(Iext2_eq, Iext2, out=ydot[9])
+        ydot[9] *= tau1
+        ydot[9] *= 5.0
+        # K
+        numpy.subtract(K_par, K, out=ydot[10])
+        ydot[10] *= tau1
+        ydot[10] /= tau0
 
-        return slope_eq, Iext2_eq
+        return ydot
 
     def dfun(self, state_variables, coupling, local_coupling=0.0,
              array=numpy.array, where=numpy.where, concat=numpy.concatenate):
@@ -696,6 +1008,9 @@ class EpileptorDPrealistic(Model):
 
         """
 
+        if FUSED_DFUN_FLAG:
+            return self.dfun_fused(state_variables, coupling, local_coupling)
+
         y = state_variables
         ydot = numpy.empty_like(state_variables)
 
@@ -754,9 +1069,61 @@ class EpileptorDPrealistic(Model):
 
         return ydot
 
+    @staticmethod
+    def fun_slope_Iext2_diff(z, g, pmode, slope, Iext2):
+
+        return eqtn_slope_Iext2_diff(z, g, pmode, slope, Iext2)
+
     def jacobian(self, state_variables, coupling, local_coupling=0.0,
                  array=numpy.array, where=numpy.where, concat=numpy.concatenate):
-        raise_not_implemented_error("Jacobian calculation of model " + self._ui_name + " is not implemented yet!")
+        r"""
+        Computes the Jacobians of the nodes of the Epileptor, i.e., the derivatives of the state variables of every
+        node with respect to its own state variables, for the given state and coupling.
+
+        The coupling is treated as an input, so that the Jacobian of the network is the one returned here,
+        plus the coupling terms. The returned array has a shape of (nvar, nvar) + state_variables.shape[1:],
+        where jacobian[i, j] = d dfun[i] / d state_variables[j].
+
+        """
+
+        y = state_variables
+        jac = numpy.zeros((self.nvar,) + y.shape, dtype=y.dtype)
+
+        # The parameters x0, slope, Iext2 and K following their own dynamics (the one for Iext1 is not used):
+        _jacobian_dp(y, jac, self.zmode, self.a, self.b, self.yc, self.d, y[7], self.tau1, self.tau0, self.s,
+                     self.tau2, self.gamma, local_coupling)
+
+        tau = self.tau1 / self.tau0
+
+        # population 1 and energy, with respect to slope, x0 and K
+        jac[0, 7] = self.tau1 * numpy.where(y[0] < 0.0, 0.0, y[0])
+        if self.zmode == 'lin':
+            jac[2, 6] = -4.0 * tau
+        else:
+            jac[2, 6] = -tau
+        jac[2, 10] = tau * coupling[0]
+        # population 2, with respect to Iext2
+        jac[3, 9] = self.tau1
+
+        dslope_dz, dslope_dg, dIext2_dz, dIext2_dg = \
+            self.fun_slope_Iext2_diff(y[2], y[5], self.pmode, self.slope, self.Iext2)
+
+        # x0_values
+        jac[6, 6] = -self.tau1
+        # slope
+        jac[7, 2] = 10 * self.tau1 * dslope_dz
+        jac[7, 5] = 10 * self.tau1 * dslope_dg
+        jac[7, 7] = -10 * self.tau1
+        # Iext1
+        jac[8, 8] = -tau
+        # Iext2
+        jac[9, 2] = 5 * self.tau1 * dIext2_dz
+        jac[9, 5] = 5 * self.tau1 * dIext2_dg
+        jac[9, 9] = -5 * self.tau1
+        # K
+        jac[10, 10] = -tau
+
+        return jac
 
 
 class EpileptorDP2D(Model):
@@ -952,6 +1319,72 @@ class EpileptorDP2D(Model):
     _nvar = 2
     cvar = numpy.array([0, 1], dtype=numpy.int32)
 
+    def configure(self):
+        super(EpileptorDP2D, self).configure()
+        self.configure_dfun_fused()
+
+    def configure_dfun_fused(self):
+        fz, fz_expression = _get_fz_kernel(self.zmode)
+        expressions = ["tau1 * (yc - z + Iext1 + Kvf * c1 - where(x1 < 0.0, a * x1 ** 2 + (d - b) * x1, "
+                       "d * x1 - 0.6 * (z - 4.0) ** 2 - slope) * x1)",
+                       "tau1 * (({fz}) - z + K * c1) / tau0".format(fz=fz_expression)]
+        _dfun_fused_kernels[self] = DfunFusedKernel(fz, expressions)
+        return _dfun_fused_kernels[self]
+
+    def dfun_fused(self, state_variables, coupling, local_coupling=0.0, ydot=None):
+        # The dfun, computed by the kernel of the model, and written to ydot, if given
+
+        kernel = _get_dfun_fused_kernel(self)
+        y = state_variables
+        if ydot is None:
+            ydot = numpy.empty_like(state_variables)
+
+        a, b, d, yc, Iext1, slope, Kvf, K, x0, tau1, tau0 = \
+            _get_parameters(self, ["a", "b", "d", "yc", "Iext1", "slope", "Kvf", "K", "x0", "tau1", "tau0"])
+        Iext1 = _couple_Iext1(Iext1, local_coupling, y[0])
+        c_pop1 = coupling[0]
+
+        if kernel.use_numexpr(y):
+            return kernel.evaluate(ydot, {"x1": y[0], "z": y[1], "c1": c_pop1, "a": a, "b": b, "d": d, "yc": yc,
+                                          "Iext1": Iext1, "slope": slope, "Kvf": Kvf, "K": K, "x0": x0,
+                                          "tau1": tau1, "tau0": tau0})
+
+        buffer1, buffer2, mask = kernel.get_workspace(y)
+        x1, z = y
+
+        # population 1
+        # where(x1 < 0.0, a * x1 ** 2 + (d - b) * x1, d * x1 - 0.6 * (z - 4.0) ** 2 - slope) * x1
+        numpy.subtract(z, 4.0, out=buffer1)
+        numpy.multiply(buffer1, buffer1, out=buffer1)
+        buffer1 *= -0.6
+        numpy.multiply(d, x1, out=buffer2)
+        buffer1 += buffer2
+        buffer1 -= slope
+        numpy.less(x1, 0.0, out=mask)
+        if mask.any():
+            numpy.multiply(a, x1, out=buffer2)
+            buffer2 += d
+            buffer2 -= b
+            buffer2 *= x1
+            numpy.copyto(buffer1, buffer2, where=mask)
+        buffer1 *= x1
+        numpy.multiply(Kvf, c_pop1, out=ydot[0])
+        ydot[0] += yc
+        ydot[0] -= z
+        ydot[0] += Iext1
+        ydot[0] -= buffer1
+        ydot[0] *= tau1
+
+        # energy
+        kernel.fz(x1, z, x0, buffer1, buffer2, mask)
+        buffer1 -= z
+        numpy.multiply(K, c_pop1, out=ydot[1])
+        ydot[1] += buffer1
+        ydot[1] *= tau1
+        ydot[1] /= tau0
+
+        return ydot
+
     def dfun(self, state_variables, coupling, local_coupling=0.0,
              array=numpy.array, where=numpy.where, concat=numpy.concatenate):
         r"""
@@ -993,6 +1426,9 @@ class EpileptorDP2D(Model):
 
         """
 
+        if FUSED_DFUN_FLAG:
+            return self.dfun_fused(state_variables, coupling, local_coupling)
+
         y = state_variables
         ydot = numpy.empty_like(state_variables)
 
@@ -1024,66 +1460,25 @@ class EpileptorDP2D(Model):
 
     def jacobian(self, state_variables, coupling, local_coupling=0.0,
                  array=numpy.array, where=numpy.where, concat=numpy.concatenate):
-        raise_not_implemented_error("Jacobian calculation of model " + self._ui_name + " is not implemented yet!")
-    #     r"""
-    #     Computes the Jacobian of the state variables of the Epileptor
-    #     with respect to time.
-    #
-    #     Implementation note: we expect this version of the Epileptor to be used
-    #     in a vectorized manner. Concretely, y has a shape of (2, n) where n is
-    #     the number of nodes in the network. An consequence is that
-    #     the original use of if/else is translated by calculated both the true
-    #     and false forms and mixing them using a boolean mask.
-    #
-    #     Variables of interest to be used by monitors: -y[0] + y[3]
-    #
-    #         .. math::
-    #         \dot{y_{0}} &=& yc - f_{1}(y_{0}, y_{1}) - y_{2} + I_{ext1} \\
-    #         \dot{y_{1}} &=&
-    #         \begin{cases}
-    #         (f_z(y_{0}) - y_{1}-0.1 y_{1}^{7})/tau0 & \text{if } y_{0}<5/3 \\
-    #         (f_z(y_{0}) - y_{1})/tau0           & \text{if } y_{0} \geq 5/3
-    #         \end{cases} \\
-    #
-    #     where:
-    #         .. math::
-    #             f_{1}(y_{0}, y_{3}) =
-    #             \begin{cases}
-    #             a ( y_{0} -5/3 )^{3} - b ( y_{0} -5/3 )^2 & \text{if } y_{0} <5/3\\
-    #             ( 5*( y_{0} -5/3 ) - 0.6(y_{1}-4)^2 -slope) ( y_{0} - 5/3 ) &\text{if }y_{0} \geq 5/3
-    #             \end{cases}
-    #     and:
-    #
-    #         .. math::
-    #             f_z(y_{0})  =
-    #             \begin{cases}
-    #             4 * (y_{0} - r*x0_values + x0_{cr}) & \text{linear} \\
-    #             \frac{3}{1+e^{-10*(y_{0}-7/6)}} - r*x0_values + x0_{cr} & \text{sigmoidal} \\
-    #             \end{cases}
-    #
-    #
-    #     """
-    #
-    #     y = state_variables
-    #
-    #     n_ep = state_variables.shape[1]
-    #
-    #     # population 1
-    #     jac_xx = where(y[0] < 0.0, numpy.diag(3*y[0]**2 + 4.0*y[0]), numpy.diag(5*y[0]+0.6*(y[1]-4.0)**2-self.slope))
-    #     jac_xz = where(y[0] < 0.0, numpy.diag(numpy.zeros((n_ep,), dtype=y.dtype)), numpy.diag(1.2*(y[1]-4.0)*y[0]))
-    #
-    #     # energy
-    #     # The terms resulting from coupling from other regions, have to be added later on
-    #     if_fz = - 0.1 * y[1] ** 7
-    #     else_fz = 0
-    #     jac_zz = -numpy.diag(numpy.ones((n_ep,)), dtype=y.dtype) / self.tau0
-    #     if self.zmode == 'lin':
-    #         jac_zx = numpy.diag(4.0) / self.tau0
-    #         jac_zz -= numpy.diag(where(y[1] < 0.0, if_fz, else_fz))
-    #     elif self.zmode == 'sig':
-    #         exp_fun = numpy.exp(-10.0 * (y[0] + 0.5))
-    #         jac_zx = numpy.diag(30.0 * exp_fun / (1.0 + exp_fun) ** 2)/ self.tau0
-    #     else:
-    #         raise_value_error('zmode has to be either ""lin"" or ""sig"" for linear and sigmoidal fz(), respectively')
-    #
-    #     return concat([numpy.hstack([jac_xx, jac_xz]),numpy.hstack([jac_zx, jac_zz])],axis=0)
+        r"""
+        Computes the Jacobians of the nodes of the Epileptor, i.e., the derivatives of the state variables of every
+        node with respect to its own state variables, for the given state and coupling.
+
+        The coupling is treated as an input, so that the Jacobian of the network is the one returned here,
+        plus the coupling terms. The returned array has a shape of (nvar, nvar) + state_variables.shape[1:],
+        where jacobian[i, j] = d dfun[i] / d state_variables[j].
+
+        """
+
+        y = state_variables
+        jac = numpy.zeros((self.nvar,) + y.shape, dtype=y.dtype)
+
+        # population 1
+        jac[0, 0], jac[0, 1] = eqtn_jac_x1_2d_diag(y[0], y[1], self.slope, self.a, self.b, self.d, self.tau1,
+                                                   y[0] < 0.0)
+        jac[0, 0] += self.tau1 * local_coupling
+
+        # energy
+        jac[1, 0], jac[1, 1] = eqtn_jac_fz_2d_diag(y[0], y[1], self.tau1, self.tau0, self.zmode, y[1] >= 0.0)
+
+        return jac
@@ -0,0 +1,199 @@
+# coding=utf-8
+"""
+Extend TVB Integrators, with linearly implicit and adaptive step ones, for the stiff, slow-fast, Epileptor models.
+"""
+
+import numpy
+from tvb.basic.traits import types_basic as basic
+from tvb.simulator import integrators
+from tvb_epilepsy.base.utils import raise_value_error
+
+# The gamma of the L-stable, 2nd order, ROS2 Rosenbrock method
+ROS2_GAMMA = 1.0 + 1.0 / numpy.sqrt(2.0)
+
+
+def _ros2_step(X, dfun, coupling, local_coupling, dt):
+    # One ROS2 step of the deterministic part of the dynamics.
+    # The coupling, computed once per time step by TVB, is treated as an input (IMEX),
+    # so only the per-node Jacobians of the model are needed, and the linear systems are solved node by node.
+    model = getattr(dfun, "__self__", None)
+    if not hasattr(model, "jacobian"):
+        raise_value_error("Rosenbrock integration requires a model with an analytic jacobian method!")
+    f0 = dfun(X, coupling, local_coupling)
+    jac = model.jacobian(X, coupling, local_coupling)
+    # (nvar, nvar, nodes, modes) -> (nodes, modes, nvar, nvar)
+    W = numpy.eye(X.shape[0]) - ROS2_GAMMA * dt * numpy.moveaxis(jac, (0, 1), (-2, -1))
+    W_inv = numpy.linalg.inv(W)
+    # (nvar, nodes, modes) -> (nodes, modes, nvar, 1) and back
+    solve = lambda b: numpy.moveaxis(numpy.matmul(W_inv, numpy.moveaxis(b, 0, -1)[..., numpy.newaxis])[..., 0],
+                                     -1, 0)
+    k1 = solve(f0)
+    k2 = solve(dfun(X + dt * k1, coupling, local_coupling) - 2.0 * k1)
+    return X + dt * (1.5 * k1 + 0.5 * k2)
+
+
+class RosenbrockDeterministic(integrators.Integrator):
+    """
+    The linearly implicit, L-stable, 2nd order, ROS2 Rosenbrock method of Verwer et al. 1999,
+    which allows for larger integration steps than the explicit methods for the stiff Epileptor models.
+    The model has to provide a jacobian method.
+
+    """
+
+    _ui_name = "Rosenbrock"
+
+    def scheme(self, X, dfun, coupling, local_coupling, stimulus):
+        r"""
+
+        .. math::
+            W = I - \gamma dt J(X_n), \gamma = 1 + 1/\sqrt{2}
+            W k_1 = dX(X_n)
+            W k_2 = dX(X_n + dt k_1) - 2 k_1
+            X_{n+1} = X_n + dt (3/2 k_1 + 1/2 k_2)
+
+        """
+        X_next = _ros2_step(X, dfun, coupling, local_coupling, self.dt) + self.dt * stimulus
+        self.clamp_state(X_next)
+        return X_next
+
+
+class RosenbrockStochastic(integrators.IntegratorStochastic):
+    """
+    The ROS2 Rosenbrock method of RosenbrockDeterministic for the deterministic part of the dynamics,
+    with the noise added as in the Euler-Maruyama method.
+
+    """
+
+    _ui_name = "Stochastic Rosenbrock"
+
+    def scheme(self, X, dfun, coupling, local_coupling, stimulus):
+        r"""
+
+        .. math::
+            X_{n+1} = X_n + dt (3/2 k_1 + 1/2 k_2) + g(X_n) Z_1
+
+        """
+        noise = self.noise.generate(X.shape)
+        noise *= self.noise.gfun(X)
+        X_next = _ros2_step(X, dfun, coupling, local_coupling, self.dt) + noise + self.dt * stimulus
+        self.clamp_state(X_next)
+        return X_next
+
+
+class AdaptiveDeterministic(integrators.Integrator):
+    """
+    The explicit, 3rd order, Bogacki-Shampine Runge-Kutta method, with an embedded 2nd order error estimate
+    for step size control and cubic Hermite dense output.
+
+    The dt of the integrator is the time grid of the simulator, which should be the sampling period of the monitors,
+    whereas the integration steps are adapted to the dynamics, so that the interictal periods close to the slow
+    manifold are crossed with large steps, which may span several samples of the grid, and seizure onsets are still
+    resolved with small ones. The states on the grid are computed from the dense output. They are point samples,
+    to be observed with SubSample (or Raw) monitors, and not with TemporalAverage ones, which would time them half
+    a period early (SimulatorTVB replaces the latter with SubSample monitors).
+    If configure_coupling is called, the instantaneous (i.e., without time delays) Difference coupling is computed
+    at every integration step; otherwise, the coupling of the simulator is held constant between the samples of the grid.
+
+    """
+
+    _ui_name = "Adaptive Bogacki-Shampine"
+
+    rtol = basic.Float(
+        label="Relative tolerance",
+        default=1e-6,
+        required=True,
+        doc="""The relative tolerance of the local error of the integration steps.""")
+
+    atol = basic.Float(
+        label="Absolute tolerance",
+        default=1e-6,
+        required=True,
+        doc="""The absolute tolerance of the local error of the integration steps.""")
+
+    initial_step = basic.Float(
+        label="Initial integration step size (ms)",
+        default=0.01220703125,
+        required=True,
+        doc="""The size of the first integration step, which is adapted afterwards.""")
+
+    # The last accepted step, i.e., (t0, X0, dX0, t1, X1, dX1), the next step size and the last state on the grid:
+    _step = None
+    _h = None
+    _t_grid = 0.0
+    _X_grid = None
+    # The weights, their row sums, the scaling and the coupling variables of the instantaneous Difference coupling:
+    _coupling = None
+
+    def configure_coupling(self, weights, a, cvar):
+        weights = numpy.array(weights, dtype="float64")
+        self._coupling = (weights, numpy.sum(weights, axis=1)[:, numpy.newaxis], a, cvar)
+
+    def _dfun(self, dfun, X, coupling, local_coupling):
+        if self._coupling is not None:
+            # a * sum_j w_ij * (x_j - x_i), for every coupling variable
+            weights, weights_sum, a, cvar = self._coupling
+            x = X[cvar]
+            coupling = a * (numpy.matmul(weights, x) - weights_sum * x)
+        return dfun(X, coupling, local_coupling)
+
+    def _restart(self, X, dfun, coupling, local_coupling):
+        dX = self._dfun(dfun, X, coupling, local_coupling)
+        self._step = (0.0, X, dX, 0.0, X, dX)
+        self._h = min(self.initial_step, self.dt)
+        self._t_grid = 0.0
+
+    def _advance(self, dfun, coupling, local_coupling, new_coupling=False):
+        # Accept one integration step from the end of the last one, with the current coupling,
+        # reusing the last derivative (first same as last), unless the coupling of the simulator has changed since
+        t0, X0, dX0 = self._step[3:]
+        if new_coupling and self._coupling is None:
+            dX0 = dfun(X0, coupling, local_coupling)
+        h = self._h
+        while True:
+            k2 = self._dfun(dfun, X0 + 0.5 * h * dX0, coupling, local_coupling)
+            k3 = self._dfun(dfun, X0 + 0.75 * h * k2, coupling, local_coupling)
+            X1 = X0 + h * (2.0 / 9.0 * dX0 + 1.0 / 3.0 * k2 + 4.0 / 9.0 * k3)
+            dX1 = self._dfun(dfun, X1, coupling, local_coupling)
+            # The maximum, over all state variables and nodes, of the scaled local error:
+            err = numpy.max(numpy.abs(h * (-5.0 / 72.0 * dX0 + 1.0 / 12.0 * k2 + 1.0 / 9.0 * k3 - 0.125 * dX1)) /
+                            (self.atol + self.rtol * numpy.maximum(numpy.abs(X0), numpy.abs(X1))))
+            if numpy.isnan(err):
+                raise_value_error("Adaptive integration failed with a NaN local error at t = " + str(t0) + " ms!")
+            factor = 0.9 * (err + 1e-16) ** (-1.0 / 3.0)
+            if err <= 1.0:
+                self._step = (t0, X0, dX0, t0 + h, X1, dX1)
+                self._h = h * min(5.0, max(0.2, factor))
+                return
+            h *= max(0.2, factor)
+            if t0 + h == t0:
+                raise_value_error("Adaptive integration step size underflow at t = " + str(t0) + " ms!")
+
+    def scheme(self, X, dfun, coupling, local_coupling, stimulus):
+        r"""
+
+        .. math::
+            k_1 = dX(X_n), k_2 = dX(X_n + h/2 k_1), k_3 = dX(X_n + 3h/4 k_2)
+            X_{n+1} = X_n + h (2/9 k_1 + 1/3 k_2 + 4/9 k_3)
+            err = h (-5/72 k_1 + 1/12 k_2 + 1/9 k_3 - 1/8 dX(X_{n+1}))
+
+        and the state at the next sample of the grid, t + dt, from the cubic Hermite interpolation
+        of the step that spans it.
+
+        """
+        # (Re)start from X, unless it is the state returned by the previous call:
+        if X is not self._X_grid:
+            self._restart(X, dfun, coupling, local_coupling)
+        t_grid = self._t_grid + self.dt
+        new_coupling = self._t_grid > 0.0
+        while self._step[3] < t_grid:
+            self._advance(dfun, coupling, local_coupling, new_coupling)
+            new_coupling = False
+        t0, X0, dX0, t1, X1, dX1 = self._step
+        h = t1 - t0
+        theta = (t_grid - t0) / h
+        X_next = (1.0 + 2.0 * theta) * (1.0 - theta) ** 2 * X0 + theta * (1.0 - theta) ** 2 * h * dX0 + \
+                 theta ** 2 * (3.0 - 2.0 * theta) * X1 + theta ** 2 * (theta - 1.0) * h * dX1 + self.dt * stimulus
+        self.clamp_state(X_next)
+        self._t_grid = t_grid
+        self._X_grid = X_next
+        return X_next
@@ -2,19 +2,33 @@
 Mechanism for launching TVB simulations.
 """
 
+import hashlib
 import sys
 import time
+from collections import OrderedDict
+from copy import copy, deepcopy
 
 import numpy
 from tvb.datatypes import connectivity
 from tvb.simulator import coupling, integrators, monitors, noise, simulator
 
-from tvb_epilepsy.base.constants import TIME_DELAYS_FLAG
-from tvb_epilepsy.base.utils import warning
+from tvb_epilepsy.base.constants import TIME_DELAYS_FLAG, CONDUCTION_SPEED, SIMULATOR_CACHE_SIZE
+from tvb_epilepsy.base.utils import warning, raise_value_error, raise_not_implemented_error
 from tvb_epilepsy.base.h5_model import convert_to_h5_model
-from tvb_epilepsy.base.simulators import ABCSimulator
-from tvb_epilepsy.custom.read_write import epileptor_model_attributes_dict
+from tvb_epilepsy.base.simulators import ABCSimulator, DelayedCoupling
+from tvb_epilepsy.custom.read_write import epileptor_model_attributes_dict, write_simulation_checkpoint, \
+    read_simulation_checkpoint
 from tvb_epilepsy.service.epileptor_model_factory import model_build_dict
+from tvb_epilepsy.tvb_api.integrators_tvb import RosenbrockDeterministic, RosenbrockStochastic, \
+    AdaptiveDeterministic
+
+
+# An LRU cache of configured TVB simulators, keyed by SimulatorTVB._simulator_key, with the noise type they set:
+_simulator_cache = OrderedDict()
+
+
+def clear_simulator_cache():
+    _simulator_cache.clear()
 
 
 class SimulatorTVB(ABCSimulator):
@@ -30,39 +44,25 @@ class SimulatorTVB(ABCSimulator):
             connectivity_matrix = vep_conn.normalized_weights
         return connectivity.Connectivity(use_storage=False, weights=connectivity_matrix,
                                          tract_lengths=TIME_DELAYS_FLAG*vep_conn.tract_lengths,
+                                         speed=numpy.array([CONDUCTION_SPEED]),
                                          region_labels=vep_conn.region_labels,
                                          centres=vep_conn.centers, hemispheres=vep_conn.hemispheres,
                                          orientations=vep_conn.orientations, areas=vep_conn.areas)
 
-    def config_simulation(self, initial_conditions=None):
-
-        if isinstance(self.model_configuration.connectivity_matrix, numpy.ndarray):
-            tvb_connectivity = self._vep2tvb_connectivity(self.connectivity,
-                                                          self.model_configuration.connectivity_matrix)
-        else:
-            tvb_connectivity = self._vep2tvb_connectivity(self.connectivity)
-        tvb_coupling = coupling.Difference(a=1.)
-
-        # Set noise:
-        if isinstance(self.simulation_settings.noise_preconfig, noise.Noise):
-            integrator = integrators.HeunStochastic(dt=self.simulation_settings.integration_step,
-                                                    noise=self.simulation_settings.noise_preconfig)
+    def _integrator_classes(self, integrator_type):
+        if integrator_type in ["", "heun"]:
+            return integrators.HeunStochastic, integrators.HeunDeterministic
+        elif integrator_type == "rosenbrock":
+            # The linearly implicit Rosenbrock method allows for larger integration steps for the stiff Epileptors
+            return RosenbrockStochastic, RosenbrockDeterministic
+        elif integrator_type == "adaptive":
+            # The adaptive step method is deterministic only
+            return None, AdaptiveDeterministic
         else:
-            self.simulation_settings.noise_intensity = numpy.array(self.simulation_settings.noise_intensity)
-            if self.simulation_settings.noise_intensity.size == 1:
-                self.simulation_settings.noise_intensity = numpy.repeat(
-                    numpy.squeeze(self.simulation_settings.noise_intensity), self.model.nvar)
-            if numpy.min(self.simulation_settings.noise_intensity) > 0:
-                thisNoise = noise.Additive(nsig=self.simulation_settings.noise_intensity,
-                                           random_stream=numpy.random.RandomState(
-                                               seed=self.simulation_settings.noise_seed))
-                self.simulation_settings.noise_type = "Additive"
-                integrator = integrators.HeunStochastic(dt=self.simulation_settings.integration_step, noise=thisNoise)
-            else:
-                integrator = integrators.HeunDeterministic(dt=self.simulation_settings.integration_step)
-                self.simulation_settings.noise_type = "None"
+            raise_value_error("Integrator type " + integrator_type +
+                              " is not one of 'heun', 'rosenbrock' and 'adaptive'!")
 
-        # Set monitors:
+    def _monitors(self):
         what_to_watch = []
         if isinstance(self.simulation_settings.monitors_preconfig, monitors.Monitor):
             what_to_watch = (self.simulation_settings.monitors_preconfig,)
@@ -72,66 +72,352 @@ class SimulatorTVB(ABCSimulator):
                 if isinstance(monitor, monitors.Monitor):
                     what_to_watch.append(monitor)
                 what_to_watch = tuple(what_to_watch)
+        return what_to_watch
 
-        self.simTVB = simulator.Simulator(model=self.model, connectivity=tvb_connectivity, coupling=tvb_coupling,
-                                          integrator=integrator, monitors=what_to_watch,
-                                          simulation_length=self.simulation_settings.simulated_period)
-        self.simTVB.configure()
+    @staticmethod
+    def _adaptive_monitors(what_to_watch):
+        # The adaptive integrator samples the states on a time grid of the monitor period, where a TemporalAverage
+        # monitor (with one integration step per period) would time each point sample half a period early,
+        # and return one sample more than the Heun integration. Therefore, it is replaced by a SubSample monitor.
+        adaptive_monitors = []
+        for monitor in what_to_watch:
+            if isinstance(monitor, monitors.TemporalAverage):
+                monitor = monitors.SubSample(period=monitor.period,
+                                             variables_of_interest=monitor.variables_of_interest)
+            adaptive_monitors.append(monitor)
+        return tuple(adaptive_monitors)
+
+    def _simulator_key(self, connectivity_matrix, integrator_type, what_to_watch):
+
+        # A digest of everything a configured TVB simulator depends on, apart from the model's parameters,
+        # and the initial conditions: the connectivity, the integration step, the integrator, the noise
+        # (including the seed of its random stream, unless it is a preconfigured noise, whose own random stream is
+        # used by every simulation), the monitors and the model's variables.
+        # Monitors and noises other than the standard ones are identified by the objects themselves,
+        # which the cached simulator holds, so that their ids cannot be reused while in the cache.
+
+        def update(*values):
+            for value in values:
+                if isinstance(value, numpy.ndarray):
+                    key.update(str(value.shape) + str(value.dtype))
+                    key.update(numpy.ascontiguousarray(value))
+                else:
+                    key.update(repr(value))
+
+        key = hashlib.sha1()
+        update(numpy.array(connectivity_matrix, dtype="float64"),
+               numpy.array(TIME_DELAYS_FLAG * self.connectivity.tract_lengths, dtype="float64"),
+               float(self.simulation_settings.integration_step), integrator_type,
+               self.model.__class__.__name__, self.model.nvar, self.model.number_of_modes,
+               numpy.array(self.model.cvar), numpy.array(self.model.variables_of_interest))
+        noise_preconfig = self.simulation_settings.noise_preconfig
+        if isinstance(noise_preconfig, noise.Noise):
+            update(noise_preconfig.__class__.__name__, numpy.array(noise_preconfig.nsig),
+                   float(noise_preconfig.ntau))
+            if not isinstance(noise_preconfig, noise.Additive):
+                update(id(noise_preconfig))
+        else:
+            update(numpy.array(self.simulation_settings.noise_intensity), self.simulation_settings.noise_seed)
+        for monitor in what_to_watch:
+            if isinstance(monitor, (monitors.Raw, monitors.SubSample, monitors.TemporalAverage)):
+                update(monitor.__class__.__name__, float(monitor.period), numpy.array(monitor.variables_of_interest))
+            else:
+                update(id(monitor))
+        return key.hexdigest()
 
-        self.configure_initial_conditions(initial_conditions=initial_conditions)
+    def _configure_simulator(self, tvb_connectivity, integrator_type, what_to_watch):
 
-    def launch_simulation(self, n_report_blocks=1):
+        # Configure a new TVB simulator, which is only to be copied to the simulations, and never launched itself
 
-        self.simTVB._configure_history(initial_conditions=self.simTVB.initial_conditions)
+        tvb_coupling = coupling.Difference(a=1.)
 
-        status = True
+        # Set integrator:
+        integrator_stochastic, integrator_deterministic = self._integrator_classes(integrator_type)
 
-        if n_report_blocks < 2:
-            try:
-                tavg_time, tavg_data = self.simTVB.run()[0]
+        # Set noise:
+        noise_type = None
+        if integrator_stochastic is None:
+            if isinstance(self.simulation_settings.noise_preconfig, noise.Noise):
+                noise_intensity = self.simulation_settings.noise_preconfig.nsig
+            else:
+                noise_intensity = self.simulation_settings.noise_intensity
+            if numpy.max(noise_intensity) > 0:
+                warning("Noise is ignored by the deterministic " + integrator_type + " integrator!")
+            integrator = integrator_deterministic(dt=self.simulation_settings.integration_step)
+            noise_type = "None"
+        elif isinstance(self.simulation_settings.noise_preconfig, noise.Noise):
+            # A copy of the noise, so that its random stream is not advanced by the configuration and the simulations
+            integrator = integrator_stochastic(dt=self.simulation_settings.integration_step,
+                                               noise=deepcopy(self.simulation_settings.noise_preconfig))
+        elif numpy.min(self.simulation_settings.noise_intensity) > 0:
+            thisNoise = noise.Additive(nsig=self.simulation_settings.noise_intensity,
+                                       random_stream=numpy.random.RandomState(
+                                           seed=self.simulation_settings.noise_seed))
+            noise_type = "Additive"
+            integrator = integrator_stochastic(dt=self.simulation_settings.integration_step, noise=thisNoise)
+        else:
+            integrator = integrator_deterministic(dt=self.simulation_settings.integration_step)
+            noise_type = "None"
+
+        if isinstance(integrator, AdaptiveDeterministic):
+            # The time grid of the simulator is the sampling period of the monitors, on which the dense output
+            # of the adaptive integration is resampled, whereas the integration step is only the initial one
+            integrator.initial_step = self.simulation_settings.integration_step
+            if len(what_to_watch) > 0:
+                integrator.dt = float(numpy.min([monitor.period for monitor in what_to_watch]))
+            else:
+                integrator.dt = self.simulation_settings.monitor_sampling_period
+
+        simTVB = simulator.Simulator(model=self.model, connectivity=tvb_connectivity, coupling=tvb_coupling,
+                                     integrator=integrator, monitors=what_to_watch,
+                                     simulation_length=self.simulation_settings.simulated_period)
+        simTVB.configure()
+        if isinstance(integrator, AdaptiveDeterministic) and simTVB.horizon == 1:
+            # Without time delays, the coupling is computed at every adaptive integration step
+            integrator.configure_coupling(simTVB.connectivity.weights, simTVB.coupling.a, self.model.cvar)
+
+        return simTVB, noise_type
+
+    def _copy_simulator(self, simTVB):
+
+        # A shallow copy of a configured TVB simulator, which shares its connectivity, coupling and time delays,
+        # with its own integrator, noise and monitors, completed with the model of this simulator.
+        # The random stream of a preconfigured noise is shared by all simulations, and advanced by each one of them,
+        # whereas the noise built from the noise intensity and seed gets a copy of its seeded random stream,
+        # i.e., every simulation replays the same noise realization.
+        # Its history is configured anew, from the initial conditions, by launch_simulation.
+
+        simTVB = copy(simTVB)
+        simTVB.integrator = copy(simTVB.integrator)
+        if isinstance(simTVB.integrator, integrators.IntegratorStochastic):
+            simTVB.integrator.noise = copy(simTVB.integrator.noise)
+            if isinstance(self.simulation_settings.noise_preconfig, noise.Noise):
+                simTVB.integrator.noise.random_stream = self.simulation_settings.noise_preconfig.random_stream
+            else:
+                simTVB.integrator.noise.random_stream = deepcopy(simTVB.integrator.noise.random_stream)
+        simTVB.monitors = tuple([copy(monitor) for monitor in simTVB.monitors])
+        simTVB.simulation_length = self.simulation_settings.simulated_period
 
-            except Exception, error_message:
-                status = False
-                warning("Something went wrong with this simulation...:" + "\n" + error_message)
-                return None, None, status
+        # Configure the model, and reshape its spatialized parameters, as Simulator.configure does for regions:
+        simTVB.model = self.model
+        self.model.configure()
+        for param in self.model.trait.keys():
+            if param in ("state_variable_range", "variables_of_interest", "noise", "psi_table", "nerf_table"):
+                continue
+            region_parameters = getattr(self.model, param)
+            if region_parameters.size == simTVB.number_of_nodes:
+                setattr(self.model, param, region_parameters.reshape(self.model.spatial_param_reshape))
+        simTVB._configure_monitors()
 
-            return tavg_time, tavg_data, status
+        return simTVB
 
+    def config_simulation(self, initial_conditions=None, integrator_type=None):
+
+        # The connectivity, integrator, noise and monitors are configured only once for all simulations that share
+        # them, e.g., the samples of a simulation PSE, in a cached TVB simulator, which is copied and completed with
+        # the model of each simulation, and then with its initial conditions.
+
+        if isinstance(self.model_configuration.connectivity_matrix, numpy.ndarray):
+            connectivity_matrix = self.model_configuration.connectivity_matrix
         else:
+            connectivity_matrix = self.connectivity.normalized_weights
 
-            sim_length = self.simTVB.simulation_length / self.simTVB.monitors[0].period
-            block_length = sim_length / n_report_blocks
-            curr_time_step = 0.0
-            curr_block = 1.0
+        if integrator_type is None:
+            integrator_type = self.simulation_settings.integrator_type
+        integrator_type = str(integrator_type).lower()
+        self._integrator_classes(integrator_type)
 
-            # Perform the simulation
-            tavg_data, tavg_time = [], []
+        if not isinstance(self.simulation_settings.noise_preconfig, noise.Noise):
+            self.simulation_settings.noise_intensity = numpy.array(self.simulation_settings.noise_intensity)
+            if self.simulation_settings.noise_intensity.size == 1:
+                self.simulation_settings.noise_intensity = numpy.repeat(
+                    numpy.squeeze(self.simulation_settings.noise_intensity), self.model.nvar)
 
-            start = time.time()
+        what_to_watch = self._monitors()
+        # Whether a TemporalAverage monitor is replaced, which is warned about only when a new simulator is configured
+        temporal_average = False
+        if integrator_type == "adaptive":
+            temporal_average = any([isinstance(monitor, monitors.TemporalAverage) for monitor in what_to_watch])
+            what_to_watch = self._adaptive_monitors(what_to_watch)
+
+        key = self._simulator_key(connectivity_matrix, integrator_type, what_to_watch)
+        cached = _simulator_cache.pop(key, None)
+        if cached is None:
+            if temporal_average:
+                warning("A TemporalAverage monitor is replaced by a SubSample one for the adaptive integrator!")
+            cached = self._configure_simulator(self._vep2tvb_connectivity(self.connectivity, connectivity_matrix),
+                                               integrator_type, what_to_watch)
+            while len(_simulator_cache) >= SIMULATOR_CACHE_SIZE:
+                _simulator_cache.popitem(last=False)
+        _simulator_cache[key] = cached
+
+        simTVB, noise_type = cached
+        if noise_type is not None:
+            self.simulation_settings.noise_type = noise_type
+        self.simulation_settings.integrator_type = integrator_type
+        self.simTVB = self._copy_simulator(simTVB)
 
-            try:
-                for tavg in self.simTVB():
+        self.configure_initial_conditions(initial_conditions=initial_conditions)
 
-                    curr_time_step += 1.0
+    # The integrator, noise and monitor attributes that hold the state of a simulation, besides its current state,
+    # step and history, to be checkpointed (if they are set):
+    _integrator_state = ("_step", "_h", "_t_grid")
+    _noise_state = ("_eta", "_h")
+    _monitor_state = ("_stock", "_interim_stock", "_state", "_last_step")
 
-                    if not tavg is None:
-                        tavg_time.append(tavg[0][0])
-                        tavg_data.append(tavg[0][1])
+    @staticmethod
+    def _get_state(obj, attributes):
+        state = {}
+        for attribute in attributes:
+            value = getattr(obj, attribute, None)
+            if value is not None:
+                state[attribute] = value
+        return state
+
+    def _write_checkpoint(self, path, n_report_blocks, block, tavg_time=None, tavg_data=None):
+        checkpoint = {"n_report_blocks": n_report_blocks, "block": block,
+                      "current_step": self.simTVB.current_step, "current_state": self.simTVB.current_state,
+                      "history": self.simTVB.history.buffer,
+                      "integrator": self._get_state(self.simTVB.integrator, self._integrator_state),
+                      "monitors": tuple([self._get_state(monitor, self._monitor_state)
+                                         for monitor in self.simTVB.monitors]),
+                      "time": tavg_time, "data": tavg_data}
+        if isinstance(self.simTVB.integrator, integrators.IntegratorStochastic):
+            noise_state = self._get_state(self.simTVB.integrator.noise, self._noise_state)
+            noise_state["random_state"] = self.simTVB.integrator.noise.random_stream.get_state()
+            checkpoint["noise"] = noise_state
+        write_simulation_checkpoint(checkpoint, path)
+
+    def _read_checkpoint(self, path, n_report_blocks):
+        checkpoint = read_simulation_checkpoint(path)
+        if checkpoint["n_report_blocks"] != n_report_blocks:
+            raise_value_error("The checkpoint " + path + " is of a simulation of " +
+                              str(checkpoint["n_report_blocks"]) + " report blocks, instead of " +
+                              str(n_report_blocks) + "!")
+        if checkpoint["history"].shape != self.simTVB.history.buffer.shape:
+            raise_value_error("The history of the checkpoint " + path + " is of shape " +
+                              str(checkpoint["history"].shape) + ", instead of " +
+                              str(self.simTVB.history.buffer.shape) + "!")
+        self.simTVB.current_step = int(checkpoint["current_step"])
+        self.simTVB.current_state = checkpoint["current_state"]
+        self.simTVB.history.buffer[:] = checkpoint["history"]
+        for attribute, value in checkpoint["integrator"].iteritems():
+            setattr(self.simTVB.integrator, attribute, value)
+        if isinstance(self.simTVB.integrator, AdaptiveDeterministic):
+            # Continue the last integration step, instead of restarting from the current state
+            self.simTVB.integrator._X_grid = self.simTVB.current_state
+        for monitor, monitor_state in zip(self.simTVB.monitors, checkpoint["monitors"]):
+            for attribute, value in monitor_state.iteritems():
+                setattr(monitor, attribute, value)
+        noise_state = checkpoint.get("noise", None)
+        if noise_state is not None:
+            self.simTVB.integrator.noise.random_stream.set_state(noise_state.pop("random_state"))
+            for attribute, value in noise_state.iteritems():
+                setattr(self.simTVB.integrator.noise, attribute, value)
+        return int(checkpoint["block"]), checkpoint.get("time", None), checkpoint.get("data", None)
+
+    def launch_simulation(self, n_report_blocks=1, sink=None, checkpoint_path=None, resume_from=None):
+
+        # If a sink (e.g., a TimeSeriesH5Writer) is given, the monitor samples of each report block are appended to it
+        # and flushed at the end of the block, instead of being returned, so that memory is bounded to one block.
+        # If a checkpoint_path is given, the state of the simulation (current state and step, history, integrator,
+        # noise random state and monitors, and, without a sink, the output so far) is written to it at the end
+        # of each report block, and the simulation can be resumed from it with resume_from, after the same
+        # config_simulation, and with a sink opened with resume=True, if any.
 
-                    if curr_time_step >= curr_block * block_length:
-                        end_block = time.time()
-                        # TODO: correct this part to print percentage of simulation at the same line by erasing previous
-                        print_this = "\r" + "..." + str(100 * curr_time_step / sim_length) + "% done in " + \
-                                     str(end_block - start) + " secs"
-                        sys.stdout.write(print_this)
-                        sys.stdout.flush()
-                        curr_block += 1.0
-            except Exception, error_message:
-                status = False
-                warning("Something went wrong with this simulation...:" + "\n" + error_message)
-                return None, None, status
+        self.simTVB._configure_history(initial_conditions=self.simTVB.initial_conditions)
+
+        status = True
 
-            return numpy.array(tavg_time), numpy.array(tavg_data), status
+        n_report_blocks = max(int(n_report_blocks), 1)
+        simulation_length = self.simTVB.simulation_length
+        dt = self.simTVB.integrator.dt
+        n_steps = int(numpy.ceil(simulation_length / dt))
+        sim_length = simulation_length / self.simTVB.monitors[0].period
+        block_length = sim_length / n_report_blocks
+
+        # Preallocate the output for the expected number of monitor samples (of one report block, for a sink)
+        # and fill it in place, instead of appending the samples to lists, which would be copied to arrays only
+        # at the end, so that at most one copy of the output is held in memory
+        if sink is None:
+            n_samples = int(numpy.ceil(sim_length)) + 1
+        else:
+            n_samples = int(numpy.ceil(block_length)) + 1
+        tavg_time, tavg_data = numpy.array([]), numpy.array([])
+        i_sample = 0
+
+        first_block = 0
+        if resume_from is not None:
+            first_block, resumed_time, resumed_data = self._read_checkpoint(resume_from, n_report_blocks)
+            if resumed_time is not None and resumed_time.shape[0] > 0:
+                i_sample = resumed_time.shape[0]
+                tavg_time = numpy.empty((max(n_samples, i_sample),), dtype=resumed_time.dtype)
+                tavg_data = numpy.empty((tavg_time.shape[0],) + resumed_data.shape[1:], dtype=resumed_data.dtype)
+                tavg_time[:i_sample] = resumed_time
+                tavg_data[:i_sample] = resumed_data
+
+        # Perform the simulation, one report block of integration steps at a time
+        start = time.time()
+
+        try:
+            for block in range(first_block, n_report_blocks):
+
+                block_steps = int(round(n_steps * (block + 1.0) / n_report_blocks)) - \
+                              int(round(n_steps * float(block) / n_report_blocks))
+                if block_steps > 0:
+                    # Half a step less, so that the simulator rounds up to exactly block_steps steps:
+                    for tavg in self.simTVB(simulation_length=(block_steps - 0.5) * dt):
+
+                        if not tavg is None:
+                            if tavg_time.shape[0] == 0:
+                                tavg_time = numpy.empty((n_samples,), dtype=numpy.array(tavg[0][0]).dtype)
+                                tavg_data = numpy.empty((n_samples,) + tavg[0][1].shape, dtype=tavg[0][1].dtype)
+                            elif i_sample == tavg_time.shape[0]:
+                                if sink is None:
+                                    # More samples than expected, e.g., due to rounding of the monitor's period:
+                                    tavg_time = numpy.resize(tavg_time, (2 * i_sample,))
+                                    tavg_data = numpy.resize(tavg_data, (2 * i_sample,) + tavg_data.shape[1:])
+                                else:
+                                    sink.append(tavg_time, tavg_data)
+                                    i_sample = 0
+                            tavg_time[i_sample] = tavg[0][0]
+                            tavg_data[i_sample] = tavg[0][1]
+                            i_sample += 1
+
+                if sink is not None:
+                    sink.append(tavg_time[:i_sample], tavg_data[:i_sample])
+                    sink.flush()
+                    i_sample = 0
+                if checkpoint_path is not None and block < n_report_blocks - 1:
+                    if sink is None:
+                        self._write_checkpoint(checkpoint_path, n_report_blocks, block + 1,
+                                               tavg_time[:i_sample], tavg_data[:i_sample])
+                    else:
+                        self._write_checkpoint(checkpoint_path, n_report_blocks, block + 1)
+                if n_report_blocks >= 2:
+                    end_block = time.time()
+                    # TODO: correct this part to print percentage of simulation at the same line by erasing previous
+                    print_this = "\r" + "..." + str(100.0 * (block + 1) / n_report_blocks) + "% done in " + \
+                                 str(end_block - start) + " secs"
+                    sys.stdout.write(print_this)
+                    sys.stdout.flush()
+        except Exception, error_message:
+            status = False
+            warning("Something went wrong with this simulation...:" + "\n" + str(error_message))
+            if checkpoint_path is not None:
+                warning("It can be resumed from the last checkpoint, with resume_from=" + checkpoint_path)
+            if sink is not None:
+                # Keep the results up to the failure
+                sink.append(tavg_time[:i_sample], tavg_data[:i_sample])
+                sink.flush()
+            return None, None, status
+        finally:
+            self.simTVB.simulation_length = simulation_length
+
+        if sink is not None:
+            return None, None, status
+
+        return tavg_time[:i_sample], tavg_data[:i_sample], status
 
     def _prepare_for_h5(self):
 
@@ -166,3 +452,191 @@ class SimulatorTVB(ABCSimulator):
 
         else:
             self.simTVB.initial_conditions = self.prepare_initial_conditions(self.simTVB.good_history_shape[0])
+
+
+class SimulatorTVBBatch(object):
+
+    # Simulates S instances of the model of a configured SimulatorTVB, which differ only in their model parameters
+    # (e.g., the samples of a simulation PSE), all together, sharing the connectivity, coupling, integrator, noise and
+    # monitor of the simulator.
+    # The state has a shape of (nvar, S, n_regions, modes), i.e., the samples' axis follows the state variables' one,
+    # so that the vectorized dfun and observe functions of the model apply unchanged, to model parameters stacked to a
+    # shape of (S, n_regions, 1), and one Heun step of numpy operations integrates all instances.
+    # Only Difference coupling (with or without time delays), Heun (deterministic, or stochastic with white additive
+    # noise) integration, and Raw, SubSample or TemporalAverage monitors are supported.
+
+    # The models' parameters that are never stacked:
+    excluded_params = ("state_variable_range", "variables_of_interest", "noise", "psi_table", "nerf_table")
+
+    def __init__(self, simulator, models, initial_conditions=None):
+        self.simulator = simulator
+        self.simTVB = simulator.simTVB
+        self.n_samples = len(models)
+        self.n_regions = self.simTVB.connectivity.number_of_regions
+        self._validate_simulator()
+        self.model = self._stack_models(models)
+        self.weights = numpy.array(self.simTVB.connectivity.weights, dtype="float64")
+        self.weights_sum = numpy.sum(self.weights, axis=1)[:, numpy.newaxis]
+        self.initial_conditions = self._stack_initial_conditions(initial_conditions)
+
+    def _validate_simulator(self):
+        if not isinstance(self.simTVB.coupling, coupling.Difference):
+            raise_not_implemented_error("Batch simulation is implemented only for Difference coupling!")
+        if isinstance(self.simTVB.integrator, integrators.HeunStochastic):
+            if not isinstance(self.simTVB.integrator.noise, noise.Additive) or self.simTVB.integrator.noise.ntau > 0.0:
+                raise_not_implemented_error("Batch simulation is implemented only for white additive noise!")
+        elif not isinstance(self.simTVB.integrator, integrators.HeunDeterministic):
+            raise_not_implemented_error("Batch simulation is implemented only for Heun integrators!")
+        if not isinstance(self.simTVB.monitors[0], (monitors.Raw, monitors.SubSample, monitors.TemporalAverage)):
+            raise_not_implemented_error("Batch simulation is implemented only for Raw, SubSample and TemporalAverage "
+                                        "monitors!")
+
+    def _stack_models(self, models):
+        model = deepcopy(self.simTVB.model)
+        for param in model.trait.keys():
+            if param in self.excluded_params:
+                continue
+            values = [numpy.array(getattr(m, param)) for m in models]
+            if values[0].dtype.kind not in "iuf":
+                # e.g., zmode and pmode, which select equations, and have to be the same for all samples
+                for value in values[1:]:
+                    if not numpy.array_equal(value, values[0]):
+                        raise_value_error("Parameter " + param + " differs among the models of a batch simulation!")
+                continue
+            # Spatialized parameters to the shape (n_regions, 1):
+            values = [value.reshape((-1, 1)) if value.size == self.n_regions else value for value in values]
+            if numpy.all([numpy.array_equal(value, values[0]) for value in values[1:]]):
+                setattr(model, param, values[0])
+            elif numpy.all([value.size in (1, self.n_regions) for value in values]):
+                # Stack the different values to a shape of (S, n_regions, 1), or (S, 1, 1) for scalars:
+                shape = numpy.broadcast(*[value.reshape((-1, 1)) for value in values]).shape
+                setattr(model, param,
+                        numpy.array([numpy.broadcast_to(value.reshape((-1, 1)), shape) for value in values]))
+            else:
+                raise_value_error("Parameter " + param + " of shape " + str(values[0].shape) +
+                                  " cannot be stacked for a batch simulation!")
+        return model
+
+    def _stack_initial_conditions(self, initial_conditions):
+        # One initial state (nvar, n_regions, modes) (or history of states) per sample,
+        # or the initial conditions of the simulator for all samples,
+        # to a history of states (time, nvar, S, n_regions, modes), of the length of the longest one
+        if initial_conditions is None:
+            initial_conditions = [self.simTVB.initial_conditions] * self.n_samples
+        initial_conditions = [numpy.array(ic, dtype="float64") for ic in initial_conditions]
+        initial_conditions = [ic if ic.ndim == 4 else ic[numpy.newaxis] for ic in initial_conditions]
+        history_length = max([ic.shape[0] for ic in initial_conditions])
+        initial_conditions = [numpy.concatenate([ic[:1]] * (history_length - ic.shape[0]) + [ic[-history_length:]])
+                              for ic in initial_conditions]
+        return numpy.stack(initial_conditions, axis=2)
+
+    def _coupling(self, state):
+        # Difference coupling without delays: a * sum_j w_ij * (x_j - x_i), for every sample and coupling variable
+        x = state[self.model.cvar]
+        return self.simTVB.coupling.a * (numpy.matmul(self.weights, x) - self.weights_sum * x)
+
+    def _delayed_coupling(self):
+        # Difference coupling with time delays, for all coupling variables, samples and modes at once,
+        # from the history of the coupling variables of the initial conditions, with the regions' axis first
+        history = self.initial_conditions[-self.simTVB.horizon:, self.model.cvar]
+        shape = history.shape[1:]
+        delayed_coupling = DelayedCoupling(self.weights, self.simTVB.connectivity.idelays,
+                                           numpy.moveaxis(history, 3, 1).reshape((history.shape[0], shape[2], -1)))
+
+        def to_regions(x):
+            return numpy.moveaxis(x, 2, 0).reshape((shape[2], -1))
+
+        def coupling(state):
+            x = state[self.model.cvar]
+            return self.simTVB.coupling.a * numpy.moveaxis(
+                delayed_coupling(to_regions(x)).reshape((shape[2],) + x.shape[:2] + x.shape[3:]), 0, 2)
+
+        def update(state):
+            delayed_coupling.update(to_regions(state[self.model.cvar]))
+
+        return coupling, update
+
+    def launch_simulation(self):
+
+        integrator = self.simTVB.integrator
+        dt = integrator.dt
+        monitor = self.simTVB.monitors[0]
+        istep = monitor.istep if not isinstance(monitor, monitors.Raw) else 1
+        n_steps = int(numpy.ceil(self.simTVB.simulation_length / dt))
+        state = numpy.array(self.initial_conditions[-1])
+        if isinstance(integrator, integrators.HeunStochastic):
+            noise_gfun = integrator.noise.gfun(None)
+            # The noise of each sample has a shape of (nvar, n_regions, modes):
+            noise_shape = (state.shape[0],) + state.shape[2:]
+            if isinstance(self.simulator.simulation_settings.noise_preconfig, noise.Noise):
+                # The random stream of a preconfigured noise is shared by the serial runs, and advanced by each one of
+                # them. Every sample gets the noise realization of the respective serial run, from a copy of the
+                # stream, advanced by the noise of the previous samples, and the stream is left as after all of them:
+                random_stream = integrator.noise.random_stream
+                n_draws = n_steps * int(numpy.prod(noise_shape))
+                samples_noises = []
+                for i_noise in range(self.n_samples):
+                    sample_noise = copy(integrator.noise)
+                    sample_noise.random_stream = deepcopy(random_stream)
+                    samples_noises.append(sample_noise)
+                    for i_draw in range(0, n_draws, 2 ** 20):
+                        random_stream.normal(size=min(2 ** 20, n_draws - i_draw))
+                noise_sample_fun = lambda: numpy.stack([sample_noise.generate(noise_shape) * noise_gfun
+                                                        for sample_noise in samples_noises], axis=1)
+            else:
+                # Every sample gets the same noise realization that a serial run would get from the (copied) seeded
+                # random stream, from (nvar, n_regions, modes) to (nvar, 1, n_regions, modes):
+                integrator_noise = deepcopy(integrator.noise)
+                noise_sample_fun = lambda: numpy.expand_dims(integrator_noise.generate(noise_shape) * noise_gfun, 1)
+        else:
+            noise_gfun = None
+
+        if self.simTVB.horizon > 1:
+            node_coupling_fun, update_history = self._delayed_coupling()
+        else:
+            node_coupling_fun, update_history = self._coupling, None
+        observed = self.simTVB.model.observe(state)[monitor.voi]
+        # As in TVB, the time steps are counted from the first time point of the initial conditions
+        first_step = self.initial_conditions.shape[0]
+        n_samples = (first_step + n_steps - 1) // istep - (first_step - 1) // istep
+        tavg_time = numpy.empty((n_samples,), dtype="float64")
+        # The output has the samples' axis first, i.e., a shape of (S, time, voi, n_regions, modes), so that tavg_data[s]
+        # is the output of the simulation of sample s, as returned by SimulatorTVB.launch_simulation
+        tavg_data = numpy.empty((self.n_samples, n_samples, observed.shape[0]) + observed.shape[2:],
+                                dtype=observed.dtype)
+        if isinstance(monitor, monitors.TemporalAverage):
+            average = numpy.zeros(observed.shape, dtype=observed.dtype)
+        i_sample = 0
+
+        try:
+            for step in range(first_step, first_step + n_steps):
+                node_coupling = node_coupling_fun(state)
+                m_dx_tn = self.model.dfun(state, node_coupling)
+                if noise_gfun is None:
+                    inter = state + dt * m_dx_tn
+                    state = state + (m_dx_tn + self.model.dfun(inter, node_coupling)) * dt / 2.0
+                else:
+                    noise_sample = noise_sample_fun()
+                    inter = state + dt * m_dx_tn + noise_sample
+                    state = state + (m_dx_tn + self.model.dfun(inter, node_coupling)) * dt / 2.0 + noise_sample
+                integrator.clamp_state(state)
+                if update_history is not None:
+                    update_history(state)
+
+                if isinstance(monitor, monitors.TemporalAverage):
+                    average += self.simTVB.model.observe(state)[monitor.voi]
+                    if step % istep == 0:
+                        tavg_time[i_sample] = (step - istep / 2.0) * dt
+                        tavg_data[:, i_sample] = numpy.swapaxes(average, 0, 1) / istep
+                        average[:] = 0.0
+                        i_sample += 1
+                elif step % istep == 0:
+                    tavg_time[i_sample] = step * dt
+                    tavg_data[:, i_sample] = numpy.swapaxes(self.simTVB.model.observe(state)[monitor.voi], 0, 1)
+                    i_sample += 1
+
+        except Exception, error_message:
+            warning("Something went wrong with this batch simulation...:" + "\n" + str(error_message))
+            return None, None, False
+
+        return tavg_time, tavg_data, True